@@ -20,13 +20,81 @@
 
 from __future__ import absolute_import
 
-from elasticsearch import ElasticsearchException, TransportError
-from elasticsearch.helpers import bulk
-from threading import Thread, Event, Lock
+from threading import Thread, Event, Lock, Condition, local
+from collections import deque
+from itertools import islice
 from json import dumps
 import traceback
 import logging
-from copy import deepcopy
+import os
+import time
+import weakref
+
+from .bulk import (BulkChunk, bulk_chunk, is_retryable, make_writer,
+                   rejected_docs, retry_backoff)
+from .controller import FlushController
+from .fallback import FallbackReplayer
+from .pipeline import run_postprocessors, run_postprocessors_in_worker, split
+from .spool import Spool
+
+QUEUE_FULL_POLICIES = ('block', 'drop_newest', 'drop_oldest', 'spill')
+SPOOL_MODES = ('enqueue', 'failure')
+
+
+def _process_context():
+    """The multiprocessing context for worker processes.
+
+    Forking this process, which has other threads, could leave the workers
+    with locks which will never be released (e.g. those of logging handlers
+    and connection pools), and a copy of the queue.  So the workers are
+    started by a fork server where there is one, and spawned otherwise.
+    Python 2 can only fork.
+
+    """
+    import multiprocessing
+    if not hasattr(multiprocessing, 'get_context'):
+        return multiprocessing
+    try:
+        return multiprocessing.get_context('forkserver')
+    except ValueError:
+        return multiprocessing.get_context('spawn')
+
+
+class _ThreadBuffer(object):
+
+    """The queued items of one thread, with ``thread_local_buffers``.
+
+    Only the owning thread appends, and only the flush thread pops, so each
+    byte counter has a single writer, and their difference is the size of
+    the buffer.
+
+    ``alive`` becomes ``False`` once ``owner``, which only the owning thread's
+    local storage refers to, is freed: that is, once the thread has exited.
+    Unlike ``Thread.is_alive()``, this also works for threads not started by
+    ``threading``, such as those of some application servers.
+
+    """
+
+    __slots__ = ('alive', 'items', 'added_bytes', 'drained_bytes',
+                 '_owner_ref')
+
+    def __init__(self, owner):
+        """Init method.  See class docstring."""
+        self.alive = True
+        self.items = deque()
+        self.added_bytes = 0
+        self.drained_bytes = 0
+        self._owner_ref = weakref.ref(owner, self._owner_freed)
+
+    def _owner_freed(self, ref):
+        self.alive = False
+
+
+class _ThreadBufferOwner(object):
+
+    """Stands for a thread, in its local storage.  See ``_ThreadBuffer``."""
+
+    __slots__ = ('__weakref__',)
 
 
 class ActionQueue(Thread):
@@ -39,10 +107,50 @@ class ActionQueue(Thread):
 
     1. It has waited ``interval`` seconds without flushing, or
 
-    2. The length of the queue has exceeded ``max_queue_length``, or
+    2. The length of the queue has exceeded ``max_queue_length``, or the
+       estimated size of the queued documents has exceeded
+       ``max_queue_bytes``, or
 
     3. A flush is triggered manually.
 
+    With ``adaptive_flush`` enabled, ``max_queue_length`` and ``interval`` are
+    only starting points: a ``lumberjack.controller.FlushController``
+    (available as ``controller``) adjusts them after every flush.
+
+    Each flush is cut into bulk requests of at most ``max_bulk_bytes`` bytes
+    of serialised actions.  With ``bulk_workers`` greater than one, that many
+    bulk requests are kept in flight at once, so the order in which the
+    chunks of a flush reach Elasticsearch is not guaranteed.
+
+    The queue can also be given a hard capacity, in documents
+    (``queue_capacity``) and/or estimated bytes (``queue_capacity_bytes``).
+    What happens to a document which would not fit is decided by
+    ``queue_full_policy``; the number of documents dropped or spilled is kept
+    in ``stats``.
+
+    If ``spool_dir`` is set, actions are also written to a
+    ``lumberjack.spool.Spool`` in that directory, either as they are queued
+    (``spool_mode = 'enqueue'``) or when they fail to be flushed
+    (``spool_mode = 'failure'``).  Actions left in the spool by a previous
+    process, and in ``failure`` mode those spooled since, are read back and
+    sent a chunk at a time after each healthy flush, like the fallback log.
+
+    With ``fallback_replay`` enabled, once bulk requests succeed again after
+    a failure, the fallback log is read back and indexed, a chunk at a time,
+    at no more than ``fallback_replay_rate`` documents per second.
+
+    With ``thread_local_buffers`` enabled, and no capacity or ``enqueue``
+    spool configured, each thread queues into a buffer of its own, without
+    taking ``queue_lock``, and the flush thread collects them all.  The
+    buffers of threads which have exited are dropped once emptied.
+
+    The queue survives ``os.fork()``, e.g. under an application server which
+    loads the application before forking its workers.  In the child, the
+    queue starts afresh: the documents queued in the parent are left to the
+    parent, and the thread is started again when the first document is
+    queued.  The spool and the replaying of the fallback log stay with the
+    parent.
+
     :note: You should not need to instantiate, or even interact with, this
         yourself.  It is intended to be wrapped by ``lumberjack.Lumberjack``.
         If you do, for some reason, use this yourself, it is a subclass of
@@ -64,17 +172,93 @@ class ActionQueue(Thread):
         self.elasticsearch = elasticsearch
         self.config = config
 
-        self.queue = []
+        # The active buffer.  Emitting threads append to it; the flush thread
+        # swaps it out for an empty one (see ``_swap_queue``).
+        self.queue = deque()
+        self.queue_bytes = 0
         self._flush_event = Event()
         self.queue_lock = Lock()
+        self._queue_not_full = Condition(self.queue_lock)
+        self._fallback_lock = Lock()
+        self._sender_pool = None
+        self._sender_pool_size = None
+        self._postprocessor_pool = None
+        # Set if the postprocessors turn out not to work in other processes.
+        self._postprocessor_pool_unusable = False
         self.exceptions = []
+        self.stats = {
+            'dropped_newest': 0,
+            'dropped_oldest': 0,
+            'spilled': 0,
+            'retried': 0,
+            'rejected': 0,
+            'replayed': 0
+        }
+        self._stats_lock = Lock()
+
+        # Per-thread buffers, with ``thread_local_buffers``.  The lock is only
+        # taken to register and unregister them.
+        self._local = local()
+        self._thread_buffers = []
+        self._thread_buffers_lock = Lock()
+
+        if config['adaptive_flush']:
+            self.controller = FlushController(config)
+        else:
+            self.controller = None
+
+        if config['queue_full_policy'] not in QUEUE_FULL_POLICIES:
+            raise ValueError('Unknown queue_full_policy %r.' %
+                             config['queue_full_policy'])
         self.running = True
         self.logger = logging.getLogger(__name__)
 
+        # FallbackWriters, by config key.  See ``_get_writer``.
+        self._writers = {}
+        # Whether the last bulk request got through.
+        self._healthy = True
+        if config['fallback_replay']:
+            self.replayer = FallbackReplayer(
+                self._get_writer('fallback_log_file'), self._fallback_lock,
+                rate=config['fallback_replay_rate'])
+        else:
+            self.replayer = None
+
+        self.spool = None
+        # Where everything spooled before the last swap ends (``enqueue``).
+        self._spool_ack_position = None
+        # How far the spool has been read back and sent.
+        self._spool_position = None
+        # Where the spool of previous processes ends.
+        self._spool_replay_end = None
+        # How far the spool has been acknowledged.
+        self._spool_acked = None
+        if config['spool_dir'] is not None:
+            self._open_spool()
+
         self.daemon = True
         # So we can monkey-patch these in testing
-        self._bulk = bulk
+        self._bulk = bulk_chunk
         self._open = open
+        self._sleep = time.sleep
+
+        # Whether start() has been called, in this process or a parent.
+        self._started_once = False
+        # The thread running ``run()`` in a forked child, if any.
+        self._child_thread = None
+        self._start_after_fork = False
+        self._pid = os.getpid()
+        # Without os.register_at_fork, forks are noticed by a change of pid.
+        self._check_pid = not hasattr(os, 'register_at_fork')
+        if not self._check_pid:
+            # Don't keep the queue alive just for this.
+            queue_ref = weakref.ref(self)
+
+            def after_in_child():
+                queue = queue_ref()
+                if queue is not None:
+                    queue._after_fork()
+            os.register_at_fork(after_in_child=after_in_child)
 
     @property
     def last_exception(self):
@@ -84,46 +268,712 @@ class ActionQueue(Thread):
         else:
             return self.exceptions[-1]
 
+    def _open_spool(self):
+        """Open the spool.  See ``_replay_spool`` for what is left in it."""
+        if self.config['spool_mode'] not in SPOOL_MODES:
+            raise ValueError('Unknown spool_mode %r.' %
+                             self.config['spool_mode'])
+        self.spool = Spool(self.config['spool_dir'],
+                           segment_bytes=self.config['spool_segment_bytes'],
+                           fsync=self.config['spool_fsync'],
+                           fsync_interval=self.config['spool_fsync_interval'])
+
+        self._spool_position = self._spool_acked = self.spool.checkpoint()
+        # Nothing has been appended yet.
+        self._spool_replay_end = self.spool.tell()
+
+    def _after_fork(self):
+        """Reset the queue in a child process.
+
+        Only the thread which forked exists in the child, so locks held by
+        any other thread will never be released, the flush thread and thread
+        pools are gone, and the fallback log and spool files are shared with
+        the parent.  Called by ``os.register_at_fork``, or on the next use of
+        the queue where that is not available.
+
+        """
+        self._pid = os.getpid()
+
+        self.queue_lock = Lock()
+        self._queue_not_full = Condition(self.queue_lock)
+        self._fallback_lock = Lock()
+        self._stats_lock = Lock()
+        self._flush_event = Event()
+        self._local = local()
+        self._thread_buffers = []
+        self._thread_buffers_lock = Lock()
+
+        # The parent is still responsible for these.
+        self.queue = deque()
+        self.queue_bytes = 0
+        for writer in self._writers.values():
+            writer.abandon()
+        self._writers = {}
+        self.replayer = None
+        if self.spool is not None:
+            self.logger.warning('Not spooling in forked process %d.',
+                                self._pid)
+            self.spool = None
+            self._spool_ack_position = None
+
+        # Their threads or processes belong to the parent.
+        self._sender_pool = None
+        self._sender_pool_size = None
+        self._postprocessor_pool = None
+
+        self.exceptions = []
+        self.stats = dict((stat, 0) for stat in self.stats)
+
+        # A Thread cannot be started twice, so the queue is run by a new
+        # thread in the child.
+        self._child_thread = None
+        self._start_after_fork = self._started_once and self.running
+
+    def _check_fork(self):
+        """Make sure the queue is usable in this process."""
+        if self._check_pid and self._pid != os.getpid():
+            self._after_fork()
+        if self._start_after_fork:
+            with self.queue_lock:
+                if self._start_after_fork:
+                    self._start_after_fork = False
+                    self._child_thread = Thread(target=self.run,
+                                                name=self.name)
+                    self._child_thread.daemon = True
+                    self._child_thread.start()
+
+    def start(self):
+        """Start the thread.  See ``threading.Thread.start()``."""
+        self._started_once = True
+        super(ActionQueue, self).start()
+
+    def is_alive(self):
+        """Whether the queue's thread is running, in this process."""
+        if self._child_thread is not None:
+            return self._child_thread.is_alive()
+        return super(ActionQueue, self).is_alive()
+
+    def join(self, timeout=None):
+        """Wait for the queue's thread, in this process, to finish."""
+        if self._child_thread is not None:
+            self._child_thread.join(timeout)
+        else:
+            super(ActionQueue, self).join(timeout)
+
     def _run_postprocessors(self, queue_item):
-        action, postprocessors = queue_item
-        for postprocessor in postprocessors:
-            try:
-                action['_source'] = postprocessor(deepcopy(action['_source']))
-            except Exception:
-                self.logger.error('Postprocessor %s raised an exception.' %
-                                  repr(postprocessor), exc_info=True)
-        return action
+        return run_postprocessors([queue_item], self.logger)[0]
 
-    def _flush(self):
-        """Perform all actions in the queue.
+    def _swap_queue(self):
+        """Swap the active buffer for an empty one and return the old one.
 
-        Uses elasticsearch.helpers.bulk, and empties the queue on success.
-        Uses the ``self.queue_lock`` to prevent a race condition.
+        The lock is only held for the swap itself, which is O(1) regardless of
+        the length of the queue, so emitting threads never wait on a flush in
+        progress.  The contents of the per-thread buffers are then moved to
+        the end of the old buffer.
 
         """
         with self.queue_lock:
-            queue = list(self.queue)
-            self.queue = []
+            queue, self.queue = self.queue, deque()
+            self.queue_bytes = 0
+            self._queue_not_full.notify_all()
+            if self.spool is not None and \
+                    self.config['spool_mode'] == 'enqueue':
+                # Everything spooled so far is in the swapped-out buffer.
+                self._spool_ack_position = self.spool.tell()
+        self._drain_thread_buffers(queue)
+        return queue
+
+    def _use_thread_buffer(self):
+        """Whether documents can be queued in per-thread buffers."""
+        return self.config['thread_local_buffers'] and \
+            self.config['queue_capacity'] is None and \
+            self.config['queue_capacity_bytes'] is None and \
+            (self.spool is None or self.config['spool_mode'] != 'enqueue')
+
+    def _thread_buffer(self):
+        """Get the calling thread's buffer, registering it if need be."""
+        thread_buffer = getattr(self._local, 'buffer', None)
+        if thread_buffer is None:
+            owner = _ThreadBufferOwner()
+            thread_buffer = _ThreadBuffer(owner)
+            with self._thread_buffers_lock:
+                self._thread_buffers.append(thread_buffer)
+            self._local.owner = owner
+            self._local.buffer = thread_buffer
+        return thread_buffer
+
+    def _drain_thread_buffers(self, queue):
+        """Move everything in the per-thread buffers to ``queue``.
+
+        Buffers of threads which have exited are unregistered.
+
+        """
+        with self._thread_buffers_lock:
+            thread_buffers = list(self._thread_buffers)
+        dead = []
+        for thread_buffer in thread_buffers:
+            # Checked first: a thread which has exited appends nothing more.
+            alive = thread_buffer.alive
+            items = thread_buffer.items
+            for _ in range(len(items)):
+                item = items.popleft()
+                thread_buffer.drained_bytes += item[2]
+                queue.append(item)
+            if not alive:
+                dead.append(thread_buffer)
+        if dead:
+            with self._thread_buffers_lock:
+                self._thread_buffers = [
+                    thread_buffer for thread_buffer in self._thread_buffers
+                    if thread_buffer not in dead]
 
-        actions = map(self._run_postprocessors, queue)
+    def _queued(self):
+        """The number of documents queued, including per-thread buffers."""
+        return len(self.queue) + sum([len(thread_buffer.items)
+                                      for thread_buffer in
+                                      list(self._thread_buffers)])
 
+    def _ack_spool(self):
+        """Acknowledge the spooled actions which have been dealt with.
+
+        Those are the ones sent by ``_replay_spool`` and, in ``enqueue`` mode
+        once the spool of previous processes has all been sent, those queued
+        before the last flush.
+
+        """
+        if self.spool is None:
+            return
+        position = self._spool_position
+        if self._spool_ack_position is not None and \
+                position >= self._spool_replay_end:
+            position = max(position, self._spool_ack_position)
+        if position <= self._spool_acked:
+            return
         try:
-            self._bulk(self.elasticsearch, actions)
-        except TransportError:
-            self.logger.error('Error in flushing queue. Falling back to file.',
+            self.spool.ack(position)
+        except (IOError, OSError):
+            self.logger.error('Error writing the spool checkpoint.',
                               exc_info=True)
-            try:
-                with self._open(self.config['fallback_log_file'],
-                                'a') as log_file:
-                    json_lines = map(lambda doc: dumps(doc) + '\n', actions)
-                    for line in json_lines:
-                        log_file.write(line)
-            except IOError:
-                self.logger.error('Error in fallback log. Lost %d logs.',
-                                  len(actions), exc_info=True)
         else:
-            self.logger.debug('Flushed %d logs into Elasticsearch.',
+            self._spool_acked = position
+
+    def _spool_pending(self):
+        """Whether there are spooled actions left to send."""
+        if self.spool is None:
+            return False
+        return self._spool_position < self._spool_end()
+
+    def _spool_end(self):
+        """Where the actions ``_replay_spool`` should send end.
+
+        In ``enqueue`` mode, actions spooled by this process are sent from the
+        queue, so only the spool of previous processes is replayed.
+
+        """
+        if self.config['spool_mode'] == 'failure':
+            return self.spool.tell()
+        return self._spool_replay_end
+
+    def _replay_spool(self):
+        """Send a chunk of the spooled actions left to send, if healthy.
+
+        At most ``spool_replay_chunk`` actions are read at a time, so a big
+        spool does not have to fit in memory.  Replayed actions have been
+        through their postprocessors already if they were spooled on failure,
+        and lose them otherwise (functions cannot be spooled).  Actions which
+        fail but may succeed later are queued again, to go through the usual
+        retries.
+
+        """
+        if not self._healthy or not self._spool_pending():
+            return
+        from elasticsearch import TransportError
+
+        try:
+            (actions, position) = self.spool.read(
+                self._spool_position, self.config['spool_replay_chunk'],
+                end=self._spool_end())
+        except (IOError, OSError):
+            self.logger.error('Error reading the spool.', exc_info=True)
+            return
+        if actions:
+            try:
+                failures = self._bulk(self.elasticsearch, actions)
+            except TransportError:
+                self._healthy = False
+                self.logger.warning('Error replaying the spool.',
+                                    exc_info=True)
+                return
+            retry = self._split_failures(failures)
+            with self.queue_lock:
+                for action in retry:
+                    self.queue.append((action, [], 0))
+            self.logger.debug('Replayed %d logs from the spool.',
                               len(actions))
+        self._spool_position = position
+        self._ack_spool()
+
+    def _count(self, stat, number=1):
+        with self._stats_lock:
+            self.stats[stat] += number
+
+    def _get_writer(self, config_key):
+        """Get the FallbackWriter for the file named in the config.
+
+        Writers are kept open between calls, and replaced if the config
+        changes.  Must be called with ``self._fallback_lock`` held, except
+        during initialisation.
+
+        """
+        path = self.config[config_key]
+        writer = self._writers.get(config_key)
+        if writer is None or writer.path != path:
+            if writer is not None:
+                writer.close()
+            writer = make_writer(
+                self.config, path,
+                # Look _open up at call time, so it can be monkey-patched.
+                opener=lambda path, mode: self._open(path, mode))
+            self._writers[config_key] = writer
+        return writer
+
+    def _append_json_lines(self, config_key, docs):
+        with self._fallback_lock:
+            self._get_writer(config_key).write(docs)
+
+    def close_writers(self):
+        """Close the fallback and rejected log files.
+
+        The thread does this when it stops; call it yourself after using
+        ``send_batch()`` without starting the thread.
+
+        """
+        with self._fallback_lock:
+            for writer in self._writers.values():
+                writer.close()
+            if self.replayer is not None:
+                self.replayer.close()
+
+    def _write_fallback(self, actions):
+        """Append ``actions`` to the fallback log file as JSON lines.
+
+        If the spool is in ``failure`` mode, they are spooled instead.
+
+        """
+        if self.spool is not None and self.config['spool_mode'] == 'failure':
+            try:
+                self.spool.append(actions)
+                return
+            except (IOError, OSError):
+                self.logger.error('Error in spool. Falling back to file.',
+                                  exc_info=True)
+        try:
+            self._append_json_lines('fallback_log_file', actions)
+        except (IOError, OSError):
+            self.logger.error('Error in fallback log. Lost %d logs.',
+                              len(actions), exc_info=True)
+
+    def _write_rejected(self, failures):
+        """Append documents Elasticsearch will never accept to a file.
+
+        These are kept apart from the fallback log, since sending them again
+        would fail again.  The status and error are kept alongside each action
+        as ``_status`` and ``_error``.
+
+        """
+        self._count('rejected', len(failures))
+        self.logger.error('Elasticsearch rejected %d logs.  Writing them to '
+                          'the rejected log.', len(failures))
+        try:
+            self._append_json_lines('rejected_log_file',
+                                    rejected_docs(failures))
+        except (IOError, OSError):
+            self.logger.error('Error in rejected log. Lost %d logs.',
+                              len(failures), exc_info=True)
+
+    def _split_failures(self, failures):
+        """Deal with the documents which failed in a bulk request.
+
+        Documents which will never succeed go to the rejected log.  The
+        actions for those which may succeed if sent again are returned.
+
+        """
+        retry = []
+        rejected = []
+        for failure in failures or ():
+            (action, status, error) = failure
+            if is_retryable(status):
+                retry.append(action)
+            else:
+                rejected.append(failure)
+        if rejected:
+            self._write_rejected(rejected)
+        return retry
+
+    def _replay_fallback(self):
+        """Index a rate-limited part of the fallback log, if healthy.
+
+        Documents which fail but may succeed later are queued again, to go
+        through the usual retries.
+
+        """
+        if self.replayer is None or not self._healthy:
+            return
+        from elasticsearch import TransportError
+
+        while self.replayer.pending():
+            max_docs = min(self.replayer.allowance(),
+                           self.config['fallback_replay_chunk'])
+            if max_docs <= 0:
+                return
+            (actions, offset) = self.replayer.read(max_docs)
+            if actions:
+                try:
+                    failures = self._bulk(self.elasticsearch, actions)
+                except TransportError:
+                    self._healthy = False
+                    self.logger.warning('Error replaying the fallback log.',
+                                        exc_info=True)
+                    return
+                retry = self._split_failures(failures)
+                with self.queue_lock:
+                    for action in retry:
+                        self.queue.append((action, [], 0))
+                self._count('replayed', len(actions))
+                self.logger.debug('Replayed %d logs from the fallback log.',
+                                  len(actions))
+            self.replayer.commit(offset)
+            if not actions:
+                return
+
+    def _retry_backoff(self, attempt):
+        """Seconds to wait before retry number ``attempt`` (from 1)."""
+        return retry_backoff(self.config, attempt)
+
+    def _bulk_serializer(self):
+        """The client's serializer, if actions can be serialised for it here.
+
+        That is only known to be the case for elasticsearch-py's
+        ``JSONSerializer``, which leaves strings as they are.
+
+        """
+        try:
+            from elasticsearch.serializer import JSONSerializer
+        except ImportError:
+            return None
+        serializer = getattr(getattr(self.elasticsearch, 'transport', None),
+                             'serializer', None)
+        if isinstance(serializer, JSONSerializer):
+            return serializer
+        return None
+
+    def _chunk_actions(self, actions):
+        """Split ``actions`` into chunks of at most ``max_bulk_bytes``.
+
+        Where the client's serializer allows, the actions are serialised to
+        their bulk API lines here, once: the sizes are taken from the lines,
+        which are kept on the ``BulkChunk`` to be sent as they are.
+        Otherwise sizes are estimated from the serialised actions.  A single
+        action bigger than ``max_bulk_bytes`` gets a chunk of its own.
+
+        """
+        from elasticsearch.helpers import expand_action
+        from elasticsearch.exceptions import SerializationError
+
+        max_bulk_bytes = self.config['max_bulk_bytes']
+        serializer = self._bulk_serializer()
+        chunk = BulkChunk()
+        chunk_bytes = 0
+        for action in actions:
+            lines = None
+            if serializer is not None:
+                (action_line, data) = expand_action(action)
+                try:
+                    lines = (serializer.dumps(action_line),
+                             None if data is None else serializer.dumps(data))
+                except SerializationError:
+                    # Leave it to the client to report.
+                    pass
+            if max_bulk_bytes is not None:
+                if lines is not None:
+                    size = sum([len(line) + 1 for line in lines
+                                if line is not None])
+                else:
+                    size = self._estimate_size(action)
+                if chunk and chunk_bytes + size > max_bulk_bytes:
+                    yield chunk
+                    chunk = BulkChunk()
+                    chunk_bytes = 0
+                chunk_bytes += size
+            chunk.append(action)
+            if lines is None:
+                chunk.lines = None
+            elif chunk.lines is not None:
+                chunk.lines.append(lines)
+        if chunk:
+            yield chunk
+
+    def _send_chunk(self, chunk):
+        """Send one chunk of actions, falling back to file on error.
+
+        If the request as a whole fails, the chunk goes to the fallback log.
+        If only some documents fail, those which may succeed later (e.g.
+        rejected with a 429 because the cluster is overloaded) are sent again
+        after a backoff, up to ``bulk_max_retries`` times, and then go to the
+        fallback log.  Those which never will (e.g. mapping errors) go to the
+        rejected log straight away.
+
+        Returns a dict counting the documents ``indexed``, ``retried``,
+        ``rejected`` and sent to the ``fallback`` log.
+
+        """
+        from elasticsearch import TransportError
+
+        result = {'indexed': 0, 'retried': 0, 'rejected': 0, 'fallback': 0}
+        pending = chunk
+        attempt = 0
+        while True:
+            try:
+                failures = self._bulk(self.elasticsearch, pending)
+            except TransportError:
+                self._healthy = False
+                self.logger.error(
+                    'Error in flushing queue. Falling back to file.',
+                    exc_info=True)
+                self._write_fallback(pending)
+                result['fallback'] += len(pending)
+                return result
+            self._healthy = True
+
+            retry = self._split_failures(failures)
+            rejected_count = len(failures or ()) - len(retry)
+            result['indexed'] += len(pending) - len(retry) - rejected_count
+            result['rejected'] += rejected_count
+
+            self.logger.debug('Flushed %d logs into Elasticsearch.',
+                              len(pending) - len(retry) - rejected_count)
+            if not retry:
+                return result
+
+            attempt += 1
+            if attempt > self.config['bulk_max_retries']:
+                self.logger.error('Gave up retrying %d logs. Falling back '
+                                  'to file.', len(retry))
+                self._write_fallback(retry)
+                result['fallback'] += len(retry)
+                return result
+
+            backoff = self._retry_backoff(attempt)
+            self.logger.warning('Elasticsearch failed %d logs.  Retrying in '
+                                '%.2fs.', len(retry), backoff)
+            self._count('retried', len(retry))
+            result['retried'] += len(retry)
+            self._sleep(backoff)
+            pending = retry
+
+    def _get_sender_pool(self):
+        """Get the pool of sender threads, or None if there is only one."""
+        workers = self.config['bulk_workers']
+        if workers is None or workers <= 1:
+            return None
+        if self._sender_pool is None or self._sender_pool_size != workers:
+            self._close_sender_pool()
+            from multiprocessing.pool import ThreadPool
+            self._sender_pool = ThreadPool(workers)
+            self._sender_pool_size = workers
+        return self._sender_pool
+
+    def _close_sender_pool(self):
+        if self._sender_pool is not None:
+            self._sender_pool.close()
+            self._sender_pool.join()
+            self._sender_pool = None
+
+    def _get_postprocessor_pool(self):
+        """Get the pool of postprocessor processes, or None if disabled."""
+        if not self.config['postprocessor_processes'] or \
+                self._postprocessor_pool_unusable:
+            return None
+        if self._postprocessor_pool is None:
+            self._postprocessor_pool = _process_context().Pool(
+                self.config['postprocessor_processes'])
+        return self._postprocessor_pool
+
+    def _close_postprocessor_pool(self, terminate=False):
+        if self._postprocessor_pool is not None:
+            if terminate:
+                self._postprocessor_pool.terminate()
+            else:
+                self._postprocessor_pool.close()
+            self._postprocessor_pool.join()
+            self._postprocessor_pool = None
+
+    def _postprocess(self, queue):
+        """Run the postprocessors of the queued actions.
+
+        If ``postprocessor_processes`` is set, the actions with postprocessors
+        are split between that many worker processes.  If the workers take
+        longer than ``postprocessor_timeout``, the postprocessors are run in
+        this thread instead, and the pool is replaced.  If they fail in any
+        other way, usually because a postprocessor or document cannot be
+        pickled, the pool is given up on for good, rather than forking a new
+        one for every flush.
+
+        """
+        from multiprocessing import TimeoutError
+
+        pool = self._get_postprocessor_pool()
+        items = [item for item in queue if item[1]]
+        if pool is None or not items:
+            return run_postprocessors(queue, self.logger)
+
+        try:
+            results = pool.map_async(
+                run_postprocessors_in_worker,
+                split(items, self.config['postprocessor_processes'])).get(
+                    self.config['postprocessor_timeout'])
+        except TimeoutError:
+            self.logger.warning('Timed out running postprocessors in worker '
+                                'processes.  Running them in-thread.')
+            # The workers may be stuck; start afresh next time.
+            self._close_postprocessor_pool(terminate=True)
+            return run_postprocessors(queue, self.logger)
+        except Exception:
+            self.logger.warning('Error running postprocessors in worker '
+                                'processes.  Running them in-thread from '
+                                'now on.', exc_info=True)
+            self._postprocessor_pool_unusable = True
+            self._close_postprocessor_pool()
+            return run_postprocessors(queue, self.logger)
+
+        processed = iter([action for result in results for action in result])
+        return [next(processed) if item[1] else item[0] for item in queue]
+
+    def _flush(self):
+        """Perform all actions in the queue.
+
+        Uses elasticsearch.helpers.bulk, one request per chunk (see
+        ``_chunk_actions``), with up to ``bulk_workers`` requests in flight.
+        The queue is emptied by swapping in a fresh buffer (see
+        ``_swap_queue``) rather than by copying it.
+
+        """
+        queue = self._swap_queue()
+
+        actions = self._postprocess(queue)
+        chunks = self._chunk_actions(actions)
+
+        retried = self.stats['retried']
+        start_time = time.time()
+
+        pool = self._get_sender_pool()
+        if pool is None:
+            for chunk in chunks:
+                self._send_chunk(chunk)
+        else:
+            # Consume the iterator to wait for every chunk to be sent.
+            for _ in pool.imap_unordered(self._send_chunk, chunks):
+                pass
+        # Before replaying the fallback log, whose rate-limited requests
+        # say nothing about how long flushes take.
+        latency = time.time() - start_time
+
+        self._ack_spool()
+        self._replay_spool()
+        self._replay_fallback()
+
+        if self.controller is not None:
+            self.controller.update(latency=latency,
+                                   sent=len(actions),
+                                   rejected=self.stats['retried'] - retried,
+                                   queue_depth=len(queue))
+
+    def _max_queue_length(self):
+        if self.controller is not None:
+            return self.controller.batch_size
+        return self.config['max_queue_length']
+
+    def _interval(self):
+        if self.controller is not None:
+            interval = self.controller.interval
+        else:
+            interval = self.config['interval']
+        if self._healthy and (self._spool_pending() or (
+                self.replayer is not None and self.replayer.pending())):
+            # Come back soon for the next part of the spool or fallback log.
+            interval = 1 if interval is None else min(interval, 1)
+        return interval
+
+    def _spool_action(self, action):
+        """Write an action to the spool as it is queued.
+
+        Called with ``self.queue_lock`` held, so that everything spooled
+        before a swap is in the swapped-out buffer.
+
+        """
+        try:
+            self.spool.append([action])
+        except (IOError, OSError, TypeError, ValueError):
+            self.logger.error('Error in spool. Queueing anyway.',
+                              exc_info=True)
+
+    def _estimate_size(self, body):
+        """Estimate the size in bytes of a document once serialised."""
+        try:
+            return len(dumps(body, default=repr))
+        except (TypeError, ValueError):
+            return len(repr(body))
+
+    def _is_full(self, size):
+        """Whether a document of ``size`` bytes would exceed the capacity.
+
+        Must be called with ``self.queue_lock`` held.
+
+        """
+        capacity = self.config['queue_capacity']
+        capacity_bytes = self.config['queue_capacity_bytes']
+        if capacity is not None and len(self.queue) >= capacity:
+            return True
+        # Always admit a document into an empty queue, however big it is.
+        if capacity_bytes is not None and len(self.queue) > 0 and \
+                self.queue_bytes + size > capacity_bytes:
+            return True
+        return False
+
+    def _make_room(self, size):
+        """Apply ``queue_full_policy`` if a new document would not fit.
+
+        Must be called with ``self.queue_lock`` held.  Returns whether the
+        document should be appended to the queue.
+
+        """
+        if not self._is_full(size):
+            return True
+
+        policy = self.config['queue_full_policy']
+        self.trigger_flush()
+
+        if policy == 'block':
+            deadline = time.time() + self.config['queue_block_timeout']
+            while self._is_full(size):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._queue_not_full.wait(remaining)
+            if not self._is_full(size):
+                return True
+        elif policy == 'drop_oldest':
+            while len(self.queue) > 0 and self._is_full(size):
+                (_, _, old_size) = self.queue.popleft()
+                self.queue_bytes -= old_size
+                self.stats['dropped_oldest'] += 1
+            return True
+        elif policy == 'spill':
+            self.stats['spilled'] += 1
+            return False
+
+        self.stats['dropped_newest'] += 1
+        return False
 
     def run(self):
         """The main method for the ActionQueue thread.
@@ -131,7 +981,10 @@ class ActionQueue(Thread):
         Called by the ``start()`` method.  Not to be called directly.
 
         """
-        while (self.running or len(self.queue) > 0):
+        while (self.running or self._queued() > 0):
+            # Clear before flushing, so that a trigger arriving mid-flush is
+            # not lost.
+            self._flush_event.clear()
             try:
                 self._flush()
             except Exception as exc:
@@ -141,21 +994,28 @@ class ActionQueue(Thread):
                     exc_info=True)
                 self.exceptions.append(exc)
             finally:
-                self._flush_event.clear()
-                interval = self.config['interval']
-                try:
-                    triggered = self._flush_event.wait(interval)
-                # Catch a weird bug in Python threading.  See tests.
-                except TypeError:
-                    self.logger.debug('Caught TypeError from Event.wait().  ' +
-                                      'This is expected only during ' +
-                                      'interpreter shutdown.', exc_info=True)
-                    return
-                if triggered:
-                    self.logger.debug('Flushing on external trigger.')
-                else:
-                    self.logger.debug(
-                        'Flushing after timeout of %.1fs.', interval)
+                if self.running:
+                    interval = self._interval()
+                    try:
+                        triggered = self._flush_event.wait(interval)
+                    # Catch a weird bug in Python threading.  See tests.
+                    except TypeError:
+                        self.logger.debug(
+                            'Caught TypeError from Event.wait().  ' +
+                            'This is expected only during ' +
+                            'interpreter shutdown.', exc_info=True)
+                        return
+                    if triggered:
+                        self.logger.debug('Flushing on external trigger.')
+                    else:
+                        self.logger.debug(
+                            'Flushing after timeout of %.1fs.', interval)
+
+        self._close_sender_pool()
+        self._close_postprocessor_pool()
+        self.close_writers()
+        if self.spool is not None:
+            self.spool.close()
 
     # These two methods to be called externally, i.e. from the main thread.
     # TODO: Consider refactoring.
@@ -170,14 +1030,114 @@ class ActionQueue(Thread):
         switched to by the Python interpreter.
 
         """
+        self._check_fork()
         self.logger.debug('Flush triggered; setting event object.')
         self._flush_event.set()
 
+    def _make_action(self, suffix, doc_type, body):
+        return {
+            '_op_type': 'index',
+            '_index': self.config['index_prefix'] + suffix,
+            '_type': doc_type,
+            '_source': body
+        }
+
+    def send_batch(self, actions, chunk_size, pool=None):
+        """Send actions in chunks of up to ``chunk_size``, and wait for them.
+
+        This bypasses the queue, and runs in the calling thread, with the
+        usual retries and fallback.  The chunks are sent by ``pool`` (e.g. a
+        ``multiprocessing.pool.ThreadPool``) if given, or one after the other.
+        Returns a dict with the numbers of documents ``indexed``, ``retried``,
+        ``rejected`` and sent to the ``fallback`` log.
+
+        """
+        chunks = []
+        for i in range(0, len(actions), chunk_size):
+            chunks.extend(self._chunk_actions(actions[i:i + chunk_size]))
+        if pool is None:
+            results = [self._send_chunk(chunk) for chunk in chunks]
+        else:
+            results = pool.map(self._send_chunk, chunks)
+
+        stats = {'indexed': 0, 'retried': 0, 'rejected': 0, 'fallback': 0}
+        for result in results:
+            for (key, count) in result.items():
+                stats[key] += count
+        return stats
+
+    def index_many(self, docs, doc_type, suffix, postprocessors=None):
+        """Index documents from an iterable, bypassing the queue.
+
+        This runs in the calling thread, and returns once every document has
+        been dealt with.  The iterable is consumed lazily, ``index_many_chunk``
+        documents per worker at a time, so it can be a generator over more
+        documents than fit in memory.  Each batch is postprocessed and sent in
+        bulk requests of up to ``index_many_chunk`` documents (and
+        ``max_bulk_bytes``), by up to ``bulk_workers`` threads, with the usual
+        retries and fallback.
+
+        Returns a dict with the numbers of documents ``indexed``, ``retried``,
+        ``rejected`` and sent to the ``fallback`` log, and the ``seconds``
+        taken.
+
+        :param docs: An iterable of documents, as dicts.
+
+        :param doc_type: The Elasticsearch type of the documents.
+
+        :param suffix: The suffix of the index for the documents, or a function
+            taking a document and returning its suffix.
+
+        :param postprocessors: Any post-processing functions to be run on the
+            documents before indexing.
+
+        """
+        postprocessors = postprocessors if postprocessors is not None else []
+        workers = max(self.config['bulk_workers'] or 1, 1)
+        chunk_size = self.config['index_many_chunk']
+        batch_size = chunk_size * workers
+
+        stats = {'indexed': 0, 'retried': 0, 'rejected': 0, 'fallback': 0}
+        start_time = time.time()
+        pool = None
+        if workers > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(workers)
+        try:
+            docs = iter(docs)
+            while True:
+                batch = [(self._make_action(suffix(doc) if callable(suffix)
+                                            else suffix, doc_type, doc),
+                          postprocessors, 0)
+                         for doc in islice(docs, batch_size)]
+                if not batch:
+                    break
+                result = self.send_batch(self._postprocess(batch),
+                                         chunk_size, pool)
+                for (key, count) in result.items():
+                    stats[key] += count
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        stats['seconds'] = time.time() - start_time
+        self.logger.debug('Indexed %d of a stream of logs in %.1fs.',
+                          stats['indexed'], stats['seconds'])
+        return stats
+
     def queue_index(self, suffix, doc_type, body, postprocessors=None):
         """Queue a new document to be added to Elasticsearch.
 
-        If the queue becomes longer than self.max_queue_length then a flush is
-        automatically triggered.
+        If the queue becomes longer than ``max_queue_length``, or bigger than
+        ``max_queue_bytes``, then a flush is automatically triggered.
+
+        If the queue is at capacity, ``queue_full_policy`` decides what
+        happens to the document: ``block`` waits up to ``queue_block_timeout``
+        seconds for a flush to make room (and drops the document if none
+        does), ``drop_newest`` drops the document, ``drop_oldest`` drops
+        queued documents to make room, and ``spill`` writes the document
+        straight to the fallback log file.
 
         :param suffix: The suffix of the index into which we should index the
             document.
@@ -192,25 +1152,56 @@ class ActionQueue(Thread):
             document before indexing.
 
         """
+        self._check_fork()
         postprocessors = postprocessors if postprocessors is not None else []
 
-        action = {
-            '_op_type': 'index',
-            '_index': self.config['index_prefix'] + suffix,
-            '_type': doc_type,
-            '_source': body
-        }
+        action = self._make_action(suffix, doc_type, body)
 
-        with self.queue_lock:
-            self.queue.append((action, postprocessors))
+        if self.config['queue_capacity_bytes'] is not None or \
+                self.config['max_queue_bytes'] is not None:
+            size = self._estimate_size(body)
+        else:
+            size = 0
+        item = (action, postprocessors, size)
+
+        if self._use_thread_buffer():
+            # No capacity to enforce, so no need for the shared lock.  The
+            # flush thresholds apply to each thread's buffer.
+            thread_buffer = self._thread_buffer()
+            thread_buffer.items.append(item)
+            thread_buffer.added_bytes += size
+            queue_length = len(thread_buffer.items)
+            queue_bytes = thread_buffer.added_bytes - \
+                thread_buffer.drained_bytes
+        else:
+            with self.queue_lock:
+                admitted = self._make_room(size)
+                if admitted:
+                    if self.spool is not None and \
+                            self.config['spool_mode'] == 'enqueue':
+                        self._spool_action(action)
+                    self.queue.append(item)
+                    self.queue_bytes += size
+                queue_length = len(self.queue)
+                queue_bytes = self.queue_bytes
+
+            if not admitted:
+                if self.config['queue_full_policy'] == 'spill':
+                    self._write_fallback([self._run_postprocessors(item)])
+                return
 
         self.logger.debug(
             'Put an action in the queue. qlen = %d, doc_type = %s',
-            len(self.queue), doc_type)
+            queue_length, doc_type)
 
         # TODO: do default schema
 
-        if self.config['max_queue_length'] is not None and \
-                len(self.queue) >= self.config['max_queue_length']:
+        max_queue_length = self._max_queue_length()
+        if max_queue_length is not None and \
+                queue_length >= max_queue_length:
             self.logger.debug('Hit max_queue_length.')
             self.trigger_flush()
+        elif self.config['max_queue_bytes'] is not None and \
+                queue_bytes >= self.config['max_queue_bytes']:
+            self.logger.debug('Hit max_queue_bytes.')
+            self.trigger_flush()
@@ -0,0 +1,505 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Index logs from asyncio programs.
+
+``AsyncLumberjack`` is the asyncio counterpart of ``lumberjack.Lumberjack``:
+its queue is flushed by a task on the event loop instead of by a thread, and
+bulk requests are sent without blocking the loop, through an asynchronous
+Elasticsearch client.  Logging itself stays synchronous and never blocks, so
+the usual handlers and emitters work unchanged from code on the loop.
+
+This module needs Python 3.7 or later, and is not imported by ``lumberjack``
+itself.
+"""
+
+import asyncio
+import json
+import logging
+import ssl
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+
+from .bulk import (action_lines, bulk_failures, is_retryable, make_writer,
+                   rejected_docs, retry_backoff)
+from .config import get_default_config
+from .emitter import Emitter
+from .handler import ElasticsearchHandler
+from .pipeline import run_postprocessors
+
+LOG = logging.getLogger(__name__)
+
+
+class BulkError(Exception):
+
+    """A bulk request failed as a whole."""
+
+
+class HTTPBulkClient(object):
+
+    """A minimal asyncio client for the Elasticsearch bulk API.
+
+    It is used when no asynchronous Elasticsearch client is installed.  Each
+    request is sent on a new connection, to the next host in turn.
+
+    :param hosts: A list of Elasticsearch nodes, as for
+        ``lumberjack.Lumberjack``, or as URLs such as
+        ``'https://es1:9200'``.
+
+    :param timeout: The timeout for each request, in seconds.
+
+    """
+
+    def __init__(self, hosts, timeout=30):
+        """Init method.  See class docstring."""
+        self.hosts = [self._parse_host(host) for host in hosts]
+        self.timeout = timeout
+        self._next = 0
+
+    @staticmethod
+    def _parse_host(host):
+        if isinstance(host, dict):
+            return (host.get('scheme', 'http'), host['host'],
+                    host.get('port', 9200), host.get('url_prefix', ''))
+        if '://' not in host:
+            host = 'http://' + host
+        url = urlsplit(host)
+        return (url.scheme, url.hostname, url.port or 9200,
+                url.path.rstrip('/'))
+
+    async def bulk(self, body):
+        """Send a bulk request and return the decoded response."""
+        (scheme, host, port, prefix) = self.hosts[self._next]
+        self._next = (self._next + 1) % len(self.hosts)
+        return await asyncio.wait_for(
+            self._request(scheme, host, port, prefix + '/_bulk', body),
+            self.timeout)
+
+    async def _request(self, scheme, host, port, path, body):
+        context = ssl.create_default_context() if scheme == 'https' else None
+        (reader, writer) = await asyncio.open_connection(host, port,
+                                                         ssl=context)
+        try:
+            # HTTP/1.0, so that the response is not chunked.
+            writer.write((
+                'POST %s HTTP/1.0\r\n'
+                'Host: %s:%d\r\n'
+                'Content-Type: application/x-ndjson\r\n'
+                'Content-Length: %d\r\n'
+                '\r\n' % (path, host, port, len(body))).encode('ascii'))
+            writer.write(body)
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+
+        (head, _, payload) = response.partition(b'\r\n\r\n')
+        try:
+            status = int(head.split(None, 2)[1])
+        except (IndexError, ValueError):
+            raise BulkError('Malformed response from %s:%d.' % (host, port))
+        if status >= 300:
+            raise BulkError('Bulk request to %s:%d failed with status %d.' %
+                            (host, port, status))
+        return json.loads(payload.decode('utf-8'))
+
+    async def close(self):
+        """Nothing to close: connections are not kept open."""
+
+
+class AsyncActionQueue(object):
+
+    """Hold a queue of actions and a task to bulk-perform them.
+
+    This is the asyncio counterpart of ``lumberjack.actions.ActionQueue``, and
+    follows the same config: a flush happens every ``interval`` seconds, when
+    the queue reaches ``max_queue_length`` documents, or when ``flush()`` is
+    awaited.  Each flush is cut into bulk requests of at most
+    ``max_bulk_bytes``, up to ``bulk_workers`` of which are in flight at once.
+    Documents which fail are retried, or written to the fallback or rejected
+    logs, as by ``ActionQueue``.
+
+    ``queue_index()`` never blocks, so ``queue_capacity`` is enforced with
+    the ``drop_oldest`` policy if it is configured, and ``drop_newest``
+    otherwise.
+
+    The task is started by ``start()``, or by the first document queued from
+    a thread running an event loop.  Cancelling it, e.g. with ``close()``,
+    sends whatever is left in the queue first.  Documents queued after
+    ``close()`` are dropped, and counted as ``dropped_closed`` in ``stats``.
+
+    :param client: An asynchronous Elasticsearch client, with a coroutine
+        ``bulk(body)`` method.
+
+    :param config: The Lumberjack config.  See the Configuration section in the
+        docs for details.
+
+    """
+
+    def __init__(self, client, config):
+        """Init method.  See class docstring."""
+        self.client = client
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+        self.queue = deque()
+        self.stats = {
+            'dropped_newest': 0,
+            'dropped_oldest': 0,
+            'dropped_closed': 0,
+            'retried': 0,
+            'rejected': 0
+        }
+
+        self._loop = None
+        self._loop_thread = None
+        self._task = None
+        self._closed = False
+        self._flush_event = None
+        self._flush_lock = None
+
+        # Writers are used from executor threads.
+        self._writers = {}
+        self._writers_lock = threading.Lock()
+
+    def start(self):
+        """Start the flush task on the running event loop."""
+        if self._task is not None:
+            return
+        if self._closed:
+            raise RuntimeError('The queue has been closed.')
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._flush_event = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = self._loop.create_task(self._run())
+
+    def queue_index(self, suffix, doc_type, body, postprocessors=None):
+        """Queue a new document to be added to Elasticsearch.
+
+        This never blocks.  It is meant to be called from the event loop's
+        thread; documents queued from other threads are handed over to it.
+        See ``lumberjack.actions.ActionQueue.queue_index()`` for the
+        arguments.
+
+        """
+        if self._closed:
+            # Nothing would ever send it.
+            self.stats['dropped_closed'] += 1
+            return
+        if self._task is None:
+            try:
+                self.start()
+            except RuntimeError:
+                # No loop running here; start() must be called later.
+                pass
+
+        item = ({
+            '_op_type': 'index',
+            '_index': self.config['index_prefix'] + suffix,
+            '_type': doc_type,
+            '_source': body
+        }, postprocessors or [], 0)
+        if self._task is not None and \
+                threading.get_ident() != self._loop_thread:
+            self._loop.call_soon_threadsafe(self._queue_item, item)
+        else:
+            self._queue_item(item)
+
+    def _queue_item(self, item):
+        capacity = self.config['queue_capacity']
+        if capacity is not None and len(self.queue) >= capacity:
+            if self.config['queue_full_policy'] == 'drop_oldest':
+                self.queue.popleft()
+                self.stats['dropped_oldest'] += 1
+            else:
+                self.stats['dropped_newest'] += 1
+                return
+        self.queue.append(item)
+
+        max_queue_length = self.config['max_queue_length']
+        if max_queue_length is not None and \
+                len(self.queue) >= max_queue_length:
+            self.trigger_flush()
+
+    def trigger_flush(self):
+        """Wake the flush task up.  Safe to call from any thread."""
+        if self._task is None:
+            return
+        if threading.get_ident() == self._loop_thread:
+            self._flush_event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._flush_event.set)
+
+    async def _run(self):
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._flush_event.wait(),
+                                           self.config['interval'])
+                except asyncio.TimeoutError:
+                    pass
+                self._flush_event.clear()
+                try:
+                    # Let a flush in progress finish even if cancelled.
+                    await asyncio.shield(self.flush())
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.logger.error('Unexpected exception in flush task.  '
+                                      'Continuing anyway.', exc_info=True)
+        except asyncio.CancelledError:
+            # Send what is left before going.  This waits for any flush in
+            # progress first.
+            await self.flush()
+            raise
+
+    async def flush(self):
+        """Send everything queued so far, and wait for it to be dealt with."""
+        if self._flush_lock is None:
+            self.start()
+        async with self._flush_lock:
+            queue, self.queue = self.queue, deque()
+            if not queue:
+                return
+            if any(postprocessors for (_, postprocessors, _) in queue):
+                # Postprocessors may be slow, so keep them off the loop.
+                actions = await self._loop.run_in_executor(
+                    None, run_postprocessors, list(queue), self.logger)
+            else:
+                actions = [action for (action, _, _) in queue]
+
+            workers = asyncio.Semaphore(max(self.config['bulk_workers'] or 1,
+                                            1))
+
+            async def send(chunk):
+                async with workers:
+                    await self._send_chunk(chunk)
+            await asyncio.gather(*[send(chunk)
+                                   for chunk in self._chunk_actions(actions)])
+
+    def _chunk_actions(self, actions):
+        """Split ``actions`` into chunks of at most ``max_bulk_bytes``.
+
+        The chunks are ``(actions, lines)`` tuples, where ``lines`` is the
+        serialised actions.
+
+        """
+        max_bulk_bytes = self.config['max_bulk_bytes']
+        chunks = []
+        chunk = ([], [])
+        chunk_bytes = 0
+        for action in actions:
+            lines = action_lines(action)
+            if chunk[0] and max_bulk_bytes is not None and \
+                    chunk_bytes + len(lines) > max_bulk_bytes:
+                chunks.append(chunk)
+                chunk = ([], [])
+                chunk_bytes = 0
+            chunk[0].append(action)
+            chunk[1].append(lines)
+            chunk_bytes += len(lines)
+        if chunk[0]:
+            chunks.append(chunk)
+        return chunks
+
+    async def _send_chunk(self, chunk):
+        """Send one chunk of actions, retrying and falling back as needed."""
+        (pending, lines) = chunk
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.bulk(body=b''.join(lines))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.logger.error(
+                    'Error in flushing queue. Falling back to file.',
+                    exc_info=True)
+                await self._write('fallback_log_file', pending)
+                return
+            # elasticsearch-py 8 wraps the response.
+            response = getattr(response, 'body', response)
+
+            retry = []
+            rejected = []
+            for failure in bulk_failures(pending, response):
+                if is_retryable(failure[1]):
+                    retry.append(failure[0])
+                else:
+                    rejected.append(failure)
+            if rejected:
+                self.stats['rejected'] += len(rejected)
+                self.logger.error('Elasticsearch rejected %d logs.  Writing '
+                                  'them to the rejected log.', len(rejected))
+                await self._write('rejected_log_file',
+                                  rejected_docs(rejected))
+            if not retry:
+                return
+
+            attempt += 1
+            if attempt > self.config['bulk_max_retries']:
+                self.logger.error('Gave up retrying %d logs. Falling back '
+                                  'to file.', len(retry))
+                await self._write('fallback_log_file', retry)
+                return
+            backoff = retry_backoff(self.config, attempt)
+            self.logger.warning('Elasticsearch failed %d logs.  Retrying in '
+                                '%.2fs.', len(retry), backoff)
+            self.stats['retried'] += len(retry)
+            await asyncio.sleep(backoff)
+            pending = retry
+            lines = [action_lines(action) for action in retry]
+
+    def _append_json_lines(self, config_key, docs):
+        with self._writers_lock:
+            path = self.config[config_key]
+            writer = self._writers.get(config_key)
+            if writer is None or writer.path != path:
+                if writer is not None:
+                    writer.close()
+                writer = make_writer(self.config, path)
+                self._writers[config_key] = writer
+            writer.write(docs)
+
+    async def _write(self, config_key, docs):
+        """Append documents to a log file, off the loop."""
+        try:
+            await self._loop.run_in_executor(None, self._append_json_lines,
+                                             config_key, docs)
+        except (IOError, OSError):
+            self.logger.error('Error writing to %s. Lost %d logs.',
+                              self.config[config_key], len(docs),
+                              exc_info=True)
+
+    async def close(self):
+        """Stop the flush task, once it has sent everything queued."""
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            # In case the task was cancelled before it ever ran.
+            await self.flush()
+        with self._writers_lock:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers = {}
+
+
+class AsyncLumberjack(object):
+
+    """The asyncio counterpart of ``lumberjack.Lumberjack``.
+
+    Use it as an asynchronous context manager, or call ``start()`` from a
+    coroutine and await ``close()`` when done::
+
+        async with AsyncLumberjack(hosts=['localhost:9200']) as lj:
+            logging.getLogger('pageviews').addHandler(lj.get_handler())
+            ...
+
+    Given ``hosts``, it uses ``elasticsearch.AsyncElasticsearch`` if that is
+    installed, and a minimal built-in client (``HTTPBulkClient``) otherwise.
+    Schemas are not registered; use ``lumberjack.Lumberjack`` for that.
+
+    :param hosts: A list of Elasticsearch nodes to connect to.
+
+    :param elasticsearch: As an alternative to hosts, an asynchronous client,
+        e.g. an ``elasticsearch.AsyncElasticsearch`` object.
+
+    :param config: A configuration for Lumberjack.  See the Configuration
+        section in the docs for details.
+
+    """
+
+    def __init__(self, hosts=None, elasticsearch=None, config=None):
+        """Init method.  See class docstring."""
+        if elasticsearch is not None:
+            LOG.debug('Using provided client.')
+            self.elasticsearch = elasticsearch
+        elif hosts is None:
+            raise TypeError('You must provide either hosts or elasticsearch.')
+        else:
+            try:
+                from elasticsearch import AsyncElasticsearch
+            except ImportError:
+                LOG.debug('Using the built-in bulk client.')
+                self.elasticsearch = HTTPBulkClient(hosts)
+            else:
+                self.elasticsearch = AsyncElasticsearch(hosts=hosts)
+
+        if config is None:
+            self.config = get_default_config()
+        else:
+            self.config = config
+
+        self.action_queue = AsyncActionQueue(self.elasticsearch, self.config)
+
+    def start(self):
+        """Start the flush task.  Must be called with an event loop running."""
+        self.action_queue.start()
+
+    def get_handler(self, suffix_format='%Y.%m', copy_mode='deep',
+                    check_mutation=False):
+        """Spawn a new logging handler.
+
+        See ``lumberjack.Lumberjack.get_handler()``.
+
+        """
+        return ElasticsearchHandler(action_queue=self.action_queue,
+                                    suffix_format=suffix_format,
+                                    copy_mode=copy_mode,
+                                    check_mutation=check_mutation)
+
+    def get_emitter(self, doc_type, suffix_format='%Y.%m', copy_mode='deep',
+                    postprocessors=None):
+        """Get an emitter for logging documents without ``logging``.
+
+        See ``lumberjack.Lumberjack.get_emitter()``.
+
+        """
+        return Emitter(self.action_queue, doc_type,
+                       suffix_format=suffix_format, copy_mode=copy_mode,
+                       postprocessors=postprocessors)
+
+    def trigger_flush(self):
+        """Wake the flush task up, without waiting for the flush."""
+        self.action_queue.trigger_flush()
+
+    async def flush(self):
+        """Send everything logged so far, and wait for it to be dealt with."""
+        await self.action_queue.flush()
+
+    async def close(self):
+        """Send everything logged so far, and stop."""
+        await self.action_queue.close()
+        close = getattr(self.elasticsearch, 'close', None)
+        if close is not None:
+            await close()
+
+    async def __aenter__(self):
+        """Start the flush task."""
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """Send everything logged so far, and stop."""
+        await self.close()
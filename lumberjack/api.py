@@ -20,13 +20,14 @@
 
 from __future__ import absolute_import
 
-from elasticsearch import Elasticsearch
-from .handler import ElasticsearchHandler
+from .emitter import Emitter
+from .handler import ElasticsearchHandler, SuffixCache
 from .schemas import SchemaManager
 from .actions import ActionQueue
 from .config import get_default_config
 
 import logging
+import time
 from copy import deepcopy
 
 LOG = logging.getLogger(__name__)
@@ -70,6 +71,8 @@ class Lumberjack(object):
             raise TypeError('You must provide either hosts or elasticsearch.')
         else:
             LOG.debug('Using provided hosts.')
+            # Imported here so that importing lumberjack stays cheap.
+            from elasticsearch import Elasticsearch
             self.elasticsearch = Elasticsearch(hosts=hosts)
 
         if config is None:
@@ -79,6 +82,8 @@ class Lumberjack(object):
 
         self.schema_manager = SchemaManager(self.elasticsearch, self.config)
         self.action_queue = ActionQueue(self.elasticsearch, self.config)
+        # Emitters used by ``log``, by (doc_type, suffix_format).
+        self._emitters = {}
 
         self.action_queue.start()
 
@@ -91,7 +96,8 @@ class Lumberjack(object):
         """
         self.action_queue.trigger_flush()
 
-    def get_handler(self, suffix_format='%Y.%m'):
+    def get_handler(self, suffix_format='%Y.%m', copy_mode='deep',
+                    check_mutation=False):
         """Spawn a new logging handler.
 
         You should use this method to get a ``logging.Handler`` object to
@@ -105,11 +111,156 @@ class Lumberjack(object):
             the indices.  By default your indices will be called, e.g.,
             ``generic-logging-2014.09``.
 
+        :param copy_mode: How dict log data is copied when it is logged:
+            ``'deep'`` (the default) or ``'shallow'``.  Shallow copies are
+            faster, but you must not change nested values of a dict once it
+            has been logged.
+
+        :param check_mutation: If ``True``, log a warning when a document is
+            changed after being logged.  This is for debugging code using
+            ``copy_mode='shallow'``, and slows logging down.
+
         """
         handler = ElasticsearchHandler(action_queue=self.action_queue,
-                                       suffix_format=suffix_format)
+                                       suffix_format=suffix_format,
+                                       copy_mode=copy_mode,
+                                       check_mutation=check_mutation)
         return handler
 
+    def get_emitter(self, doc_type, suffix_format='%Y.%m', copy_mode='deep',
+                    postprocessors=None):
+        """Get an emitter for logging documents without ``logging``.
+
+        For high-volume streams of events, this skips the overhead of the
+        ``logging`` module: the emitter builds the document and queues it
+        directly.  The documents are the same as if they had been logged to a
+        logger called ``doc_type`` with a handler from ``get_handler()``::
+
+            pageviews = lj.get_emitter('pageviews')
+            pageviews({'url': '/index.html', 'status': 200})
+
+        :param doc_type: The Elasticsearch type of the documents.
+
+        :param suffix_format: As for ``get_handler()``.
+
+        :param copy_mode: As for ``get_handler()``.
+
+        :param postprocessors: Postprocessors to apply to every document.
+
+        """
+        return Emitter(self.action_queue, doc_type,
+                       suffix_format=suffix_format, copy_mode=copy_mode,
+                       postprocessors=postprocessors)
+
+    def log(self, doc_type, fields, level=logging.INFO, suffix_format='%Y.%m',
+            postprocessors=None):
+        """Log a document of type ``doc_type`` without ``logging``.
+
+        See ``get_emitter()``, which is slightly faster still for many
+        documents of the same type.
+
+        :param doc_type: The Elasticsearch type of the document.
+
+        :param fields: The document, as a ``dict``.
+
+        :param level: The log level, as an integer.
+
+        :param suffix_format: As for ``get_handler()``.
+
+        :param postprocessors: Postprocessors to apply to the document.
+
+        """
+        key = (doc_type, suffix_format)
+        emitter = self._emitters.get(key)
+        if emitter is None:
+            emitter = self._emitters.setdefault(
+                key, self.get_emitter(doc_type, suffix_format=suffix_format))
+        emitter.emit(fields, level=level, postprocessors=postprocessors)
+
+    def index_many(self, iterable, doc_type, suffix=None,
+                   suffix_format='%Y.%m', postprocessors=None):
+        """Index a stream of existing documents, e.g. to backfill old logs.
+
+        The documents are indexed as they are, so they should already have
+        ``@timestamp`` and ``level`` fields.  This blocks until every document
+        has been dealt with; see ``lumberjack.ActionQueue.index_many`` for
+        details.  Returns a dict of statistics::
+
+            with open('archive.ndjson') as archive:
+                stats = lj.index_many((json.loads(line) for line in archive),
+                                      'pageviews')
+            print('Indexed %(indexed)d logs in %(seconds).1fs.' % stats)
+
+        :param iterable: The documents, as dicts.  It is consumed lazily.
+
+        :param doc_type: The Elasticsearch type of the documents.
+
+        :param suffix: The index suffix for all the documents.  By default, it
+            is worked out for each document from its ``@timestamp`` (in
+            milliseconds, as logged by Lumberjack) using ``suffix_format``.
+
+        :param suffix_format: As for ``get_handler()``.
+
+        :param postprocessors: Postprocessors to apply to the documents.
+
+        """
+        if suffix is None:
+            suffix_cache = SuffixCache(suffix_format)
+
+            def suffix(doc):
+                timestamp = doc.get('@timestamp')
+                if isinstance(timestamp, (int, float)):
+                    return suffix_cache.suffix(timestamp / 1000.0)
+                return suffix_cache.suffix(time.time())
+
+        return self.action_queue.index_many(iterable, doc_type, suffix,
+                                            postprocessors=postprocessors)
+
+    def serve(self, path, postprocessors=None):
+        """Start receiving logs from other processes on a Unix socket.
+
+        Other processes log through a ``lumberjack.ipc.ForwardingHandler``
+        pointed at ``path``, and their documents are queued here, so that one
+        process does the indexing for all of them.
+
+        Returns the started ``lumberjack.ipc.ForwardingServer``.
+
+        :param path: The path of the socket to create.
+
+        :param postprocessors: A dict from document types to lists of
+            postprocessors to apply to the forwarded documents of that type.
+
+        """
+        from .ipc import ForwardingServer
+        server = ForwardingServer(self.action_queue, path,
+                                  postprocessors=postprocessors)
+        server.start()
+        return server
+
+    def serve_ring_buffer(self, path, capacity=16 * 1024 * 1024,
+                          postprocessors=None):
+        """Start receiving logs from other processes through shared memory.
+
+        Like ``serve()``, but other processes log through a
+        ``lumberjack.ringbuffer.RingBufferHandler`` pointed at ``path``.
+
+        Returns the started ``lumberjack.ringbuffer.RingBufferConsumer``.
+
+        :param path: The path of the buffer file to create.
+
+        :param capacity: The size of the buffer, in bytes.
+
+        :param postprocessors: A dict from document types to lists of
+            postprocessors to apply to the forwarded documents of that type.
+
+        """
+        from .ringbuffer import RingBufferConsumer
+        consumer = RingBufferConsumer(self.action_queue, path,
+                                      capacity=capacity,
+                                      postprocessors=postprocessors)
+        consumer.start()
+        return consumer
+
     def register_schema(self, logger, schema):
         """Register a new log entry schema.
 
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Helpers for bulk requests, shared by the synchronous and asyncio queues."""
+
+from __future__ import absolute_import
+
+from json import dumps
+import random
+
+from .fallback import FallbackWriter
+
+
+class BulkChunk(list):
+
+    """A list of actions, with the bulk API lines they were serialised to.
+
+    ``lines`` holds an ``(action line, data line)`` pair for each action, or
+    is ``None`` if they have not been serialised.
+
+    """
+
+    def __init__(self):
+        """Init method.  See class docstring."""
+        super(BulkChunk, self).__init__()
+        self.lines = []
+
+
+def _serialised(lines):
+    return lines
+
+
+def bulk_chunk(client, actions):
+    """Send ``actions`` to Elasticsearch in a single bulk request.
+
+    ``ActionQueue`` does its own size-based chunking, so stop
+    ``elasticsearch.helpers`` from splitting the chunk up again.  If
+    ``actions`` is a ``BulkChunk`` with its lines, they are sent as they
+    are, rather than serialising the actions again.
+
+    Errors on individual documents do not raise; instead a list of
+    ``(action, status, error)`` tuples is returned for the documents which
+    failed.
+
+    """
+    # Imported here so that importing lumberjack stays cheap.
+    from elasticsearch.helpers import streaming_bulk
+
+    lines = getattr(actions, 'lines', None)
+    if lines is not None:
+        results = streaming_bulk(client, lines,
+                                 chunk_size=max(len(actions), 1),
+                                 raise_on_error=False,
+                                 expand_action_callback=_serialised)
+    else:
+        results = streaming_bulk(client, actions,
+                                 chunk_size=max(len(actions), 1),
+                                 raise_on_error=False)
+    failures = []
+    for action, (ok, item) in zip(actions, results):
+        if not ok:
+            # item is {op_type: {'status': ..., 'error': ..., ...}}
+            result = list(item.values())[0]
+            failures.append((action, result.get('status'),
+                             result.get('error')))
+    return failures
+
+
+def is_retryable(status):
+    """Whether a failed document may succeed if sent again."""
+    return status is None or status == 429 or status >= 500
+
+
+def retry_backoff(config, attempt):
+    """Seconds to wait before retry number ``attempt`` (from 1).
+
+    Exponential backoff with full jitter, capped at
+    ``bulk_retry_max_backoff``.
+
+    """
+    backoff = min(config['bulk_retry_max_backoff'],
+                  config['bulk_retry_backoff'] * 2 ** (attempt - 1))
+    return random.uniform(0, backoff)
+
+
+def rejected_docs(failures):
+    """The lines of the rejected log for ``(action, status, error)`` tuples.
+
+    The status and error are kept alongside each action as ``_status`` and
+    ``_error``.
+
+    """
+    docs = []
+    for (action, status, error) in failures:
+        doc = dict(action)
+        doc['_status'] = status
+        doc['_error'] = error
+        docs.append(doc)
+    return docs
+
+
+def make_writer(config, path, opener=open):
+    """A ``FallbackWriter`` for ``path``, set up as in the config."""
+    return FallbackWriter(path,
+                          compress=config['fallback_compress'],
+                          max_bytes=config['fallback_max_bytes'],
+                          max_age=config['fallback_max_age'],
+                          backup_count=config['fallback_backup_count'],
+                          opener=opener)
+
+
+def action_lines(action):
+    """Serialise an action for the bulk API, as bytes."""
+    return (dumps({'index': {'_index': action['_index'],
+                             '_type': action['_type']}}) + '\n' +
+            dumps(action['_source'], default=repr) + '\n').encode('utf-8')
+
+
+def bulk_failures(actions, response):
+    """The ``(action, status, error)`` tuples of the documents which failed."""
+    if not response.get('errors'):
+        return []
+    failures = []
+    for (action, item) in zip(actions, response['items']):
+        # item is {op_type: {'status': ..., 'error': ..., ...}}
+        result = list(item.values())[0]
+        if 'error' in result:
+            failures.append((action, result.get('status'),
+                             result.get('error')))
+    return failures
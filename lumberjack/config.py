@@ -50,7 +50,41 @@ DEFAULT_CONFIG = {
     'index_prefix': 'generic-logging-',
     'interval': 30,
     'max_queue_length': None,
-    'fallback_log_file': '/tmp/lumberjack_fallback.log'
+    'max_queue_bytes': None,
+    'thread_local_buffers': False,
+    'max_bulk_bytes': 10 * 1024 * 1024,
+    'bulk_workers': 1,
+    'bulk_max_retries': 3,
+    'bulk_retry_backoff': 0.5,
+    'bulk_retry_max_backoff': 30,
+    'index_many_chunk': 500,
+    'postprocessor_processes': None,
+    'postprocessor_timeout': 10,
+    'adaptive_flush': False,
+    'adaptive_min_batch': 100,
+    'adaptive_max_batch': 10000,
+    'adaptive_min_interval': 1,
+    'adaptive_max_interval': 60,
+    'adaptive_target_latency': 1,
+    'queue_capacity': None,
+    'queue_capacity_bytes': None,
+    'queue_full_policy': 'drop_newest',
+    'queue_block_timeout': 1,
+    'spool_dir': None,
+    'spool_mode': 'enqueue',
+    'spool_fsync': 'interval',
+    'spool_fsync_interval': 1,
+    'spool_segment_bytes': 64 * 1024 * 1024,
+    'spool_replay_chunk': 500,
+    'fallback_log_file': '/tmp/lumberjack_fallback.log',
+    'fallback_compress': False,
+    'fallback_max_bytes': None,
+    'fallback_max_age': None,
+    'fallback_backup_count': None,
+    'fallback_replay': False,
+    'fallback_replay_rate': 1000,
+    'fallback_replay_chunk': 500,
+    'rejected_log_file': '/tmp/lumberjack_rejected.log'
 }
 
 
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Provide the FlushController class."""
+
+from __future__ import absolute_import
+
+import logging
+
+
+class FlushController(object):
+
+    """Adapt the batch size and flush interval to the health of the cluster.
+
+    This is an AIMD (additive increase, multiplicative decrease) controller,
+    used by ``lumberjack.actions.ActionQueue`` when ``adaptive_flush`` is
+    enabled.  After every flush it is told how long the bulk requests took,
+    how many documents were sent, and how many of them Elasticsearch asked to
+    be retried.
+
+    - If the requests were slower than ``adaptive_target_latency`` seconds or
+      any documents were rejected, the cluster is struggling: the batch size
+      is multiplied by ``decrease_factor`` and the interval is doubled.
+
+    - Otherwise, if the queue filled a whole batch since the last flush, the
+      batch size grows by ``adaptive_min_batch`` and the interval is halved.
+      If it did not, flushing sooner would only mean smaller bulk requests,
+      so the interval is doubled instead.
+
+    Both values always stay within their configured bounds.  The current
+    values are available as ``batch_size`` and ``interval``.
+
+    :param config: The Lumberjack config.  See the Configuration section in the
+        docs for details.
+
+    """
+
+    decrease_factor = 0.5
+
+    def __init__(self, config):
+        """Init method.  See class docstring."""
+        self.config = config
+        self.logger = logging.getLogger(__name__)
+
+        self.batch_size = self._clamp_batch(
+            config['max_queue_length'] or config['adaptive_min_batch'])
+        self.interval = self._clamp_interval(
+            config['interval'] or config['adaptive_max_interval'])
+
+    def _clamp_batch(self, batch_size):
+        return int(max(self.config['adaptive_min_batch'],
+                       min(self.config['adaptive_max_batch'], batch_size)))
+
+    def _clamp_interval(self, interval):
+        return max(self.config['adaptive_min_interval'],
+                   min(self.config['adaptive_max_interval'], interval))
+
+    def update(self, latency, sent, rejected, queue_depth):
+        """Adjust the batch size and interval after a flush.
+
+        :param latency: The time taken to send the flush, in seconds.
+
+        :param sent: The number of documents in the flush.
+
+        :param rejected: The number of documents Elasticsearch asked to be
+            retried.
+
+        :param queue_depth: The length of the queue when it was flushed.
+
+        """
+        if sent == 0:
+            return
+
+        if latency > self.config['adaptive_target_latency'] or rejected > 0:
+            self.batch_size = self._clamp_batch(
+                self.batch_size * self.decrease_factor)
+            self.interval = self._clamp_interval(self.interval * 2)
+        else:
+            if queue_depth >= self.batch_size:
+                self.batch_size = self._clamp_batch(
+                    self.batch_size + self.config['adaptive_min_batch'])
+                self.interval = self._clamp_interval(self.interval / 2.0)
+            else:
+                self.interval = self._clamp_interval(self.interval * 2)
+
+        self.logger.debug(
+            'Flush of %d logs took %.3fs with %d rejected.  Batch size is '
+            'now %d, interval %.1fs.', sent, latency, rejected,
+            self.batch_size, self.interval)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Provide the Emitter class, for logging without the logging module."""
+
+from __future__ import absolute_import
+
+import logging
+import time
+
+from .handler import COPY_MODES, SuffixCache, make_document
+
+
+class Emitter(object):
+
+    """Queue documents of one type straight into an ``ActionQueue``.
+
+    This is a cheaper alternative to going through ``logging``, for
+    high-volume streams of events.  The documents are the same as those
+    produced by ``ElasticsearchHandler``: they get ``@timestamp`` and
+    ``level`` fields, and go to an index with a time-based suffix.
+
+    Get one with ``lumberjack.Lumberjack.get_emitter()``.
+
+    :param action_queue: The ``lumberjack.ActionQueue`` to queue documents
+        on.
+
+    :param doc_type: The Elasticsearch type of the documents.  (With
+        ``logging``, this is the name of the logger.)
+
+    :param suffix_format: The ``strftime()`` format for the index suffixes.
+
+    :param copy_mode: How to copy the fields passed to ``emit()``:
+        ``'deep'`` or ``'shallow'``.  See ``ElasticsearchFormatter``.
+
+    :param postprocessors: Postprocessors to apply to every document.
+
+    """
+
+    def __init__(self, action_queue, doc_type, suffix_format='%Y.%m',
+                 copy_mode='deep', postprocessors=None):
+        """Init method.  See class docstring."""
+        if copy_mode not in COPY_MODES:
+            raise ValueError('Unknown copy_mode %r.' % copy_mode)
+        self.action_queue = action_queue
+        self.doc_type = doc_type
+        self.copy_mode = copy_mode
+        self.postprocessors = postprocessors
+        self._suffix_cache = SuffixCache(suffix_format)
+
+    def emit(self, fields, level=logging.INFO, postprocessors=None):
+        """Queue a document.
+
+        :param fields: The document, as a ``dict``.  Anything else is stored
+            in a ``message`` field.
+
+        :param level: The log level, as an integer.
+
+        :param postprocessors: Postprocessors to apply to this document, after
+            those of the emitter.
+
+        """
+        created = time.time()
+        if postprocessors is None:
+            postprocessors = self.postprocessors
+        elif self.postprocessors:
+            postprocessors = list(self.postprocessors) + list(postprocessors)
+        self.action_queue.queue_index(
+            suffix=self._suffix_cache.suffix(created),
+            doc_type=self.doc_type,
+            body=make_document(fields, created, level, self.copy_mode),
+            postprocessors=postprocessors)
+
+    __call__ = emit
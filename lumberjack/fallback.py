@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Provide classes to deal with the fallback log file."""
+
+from __future__ import absolute_import
+
+from json import dumps, loads
+import gzip
+import logging
+import os
+import re
+import time
+
+OFFSET_SUFFIX = '.offset'
+GZIP_SUFFIX = '.gz'
+
+
+def open_log(path):
+    """Open a (possibly gzipped) log file for reading in binary mode."""
+    if path.endswith(GZIP_SUFFIX):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class FallbackWriter(object):
+
+    """Append actions to a log file, with rotation and retention.
+
+    The file is kept open between writes, and each batch of documents is
+    written with a single call.
+
+    If ``compress`` is set, the file is gzipped, and ``.gz`` is appended to
+    its name.  Each batch is flushed as a gzip sync point, so the file can be
+    read back even if the process dies.
+
+    When the file reaches ``max_bytes`` (before compression), or is older than
+    ``max_age`` seconds, it is rotated: renamed with a timestamp suffix, e.g.
+    ``lumberjack_fallback.log.20150801T120000.000000``.  Only the newest
+    ``backup_count`` rotated files are kept.  Any of these can be ``None`` to
+    disable that limit.
+
+    :note: This class is not thread-safe; callers should hold a lock.
+
+    :param path: The path of the log file.
+
+    :param opener: The function used to open uncompressed files.
+
+    """
+
+    def __init__(self, path, compress=False, max_bytes=None, max_age=None,
+                 backup_count=None, opener=open):
+        """Init method.  See class docstring."""
+        self.path = path
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self.opener = opener
+        self.logger = logging.getLogger(__name__)
+
+        self._file = None
+        self._size = 0
+        self._opened_at = None
+
+        self._rotated_re = re.compile(
+            '^' + re.escape(os.path.basename(path)) +
+            r'\.\d{8}T\d{6}\.\d{6}(' + re.escape(GZIP_SUFFIX) + ')?$')
+
+    @property
+    def active_path(self):
+        """The path of the file currently being written to."""
+        return self.path + GZIP_SUFFIX if self.compress else self.path
+
+    def size(self):
+        """The size of the file currently being written to."""
+        if self._file is not None:
+            return self._size
+        try:
+            return os.path.getsize(self.active_path)
+        except OSError:
+            return 0
+
+    def _open(self):
+        if self.compress:
+            self._file = gzip.open(self.active_path, 'ab')
+        else:
+            self._file = self.opener(self.active_path, 'a')
+        try:
+            self._size = os.path.getsize(self.active_path)
+        except OSError:
+            self._size = 0
+        self._opened_at = time.time()
+
+    def write(self, docs):
+        """Append documents to the file as JSON lines."""
+        data = ''.join([dumps(doc) + '\n' for doc in docs])
+
+        if self._file is not None and self._size > 0 and (
+                (self.max_bytes is not None and
+                 self._size + len(data) > self.max_bytes) or
+                (self.max_age is not None and
+                 time.time() - self._opened_at >= self.max_age)):
+            self.rotate()
+
+        if self._file is None:
+            self._open()
+        try:
+            if self.compress:
+                self._file.write(data.encode('utf-8'))
+            else:
+                self._file.write(data)
+            self._file.flush()
+        except (IOError, OSError):
+            # Start afresh next time.
+            self.close()
+            raise
+        self._size += len(data)
+
+    def close(self):
+        """Close the file, if it is open."""
+        if self._file is not None:
+            try:
+                self._file.close()
+            except (IOError, OSError):
+                self.logger.warning('Error closing %s.', self.active_path,
+                                    exc_info=True)
+            self._file = None
+
+    def abandon(self):
+        """Forget the open file without flushing or closing it.
+
+        This is for a forked child process, which must leave the file it
+        shares with its parent alone.
+
+        """
+        if self._file is not None and self.compress:
+            # Closing the gzip file would write its trailer.
+            self._file.fileobj = None
+        self._file = None
+
+    def rotate(self):
+        """Move the current file aside, and apply the retention limit."""
+        self.close()
+        if self.size() == 0:
+            return
+
+        now = time.time()
+        while True:
+            rotated = '%s.%s.%06d%s' % (
+                self.path, time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)),
+                int(now % 1 * 1000000), GZIP_SUFFIX if self.compress else '')
+            if not os.path.exists(rotated):
+                break
+            now += 0.000001
+        os.rename(self.active_path, rotated)
+        self.logger.debug('Rotated %s to %s.', self.active_path, rotated)
+
+        if self.backup_count is not None:
+            rotated_files = self.rotated_files()
+            for old in rotated_files[:-self.backup_count or None]:
+                self.logger.warning('Removing old fallback log %s.', old)
+                try:
+                    os.remove(old)
+                except OSError:
+                    self.logger.error('Error removing %s.', old,
+                                      exc_info=True)
+
+    def rotated_files(self):
+        """The paths of the rotated files, oldest first."""
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            filenames = os.listdir(directory)
+        except OSError:
+            return []
+        return [os.path.join(os.path.dirname(self.path), filename)
+                for filename in sorted(filenames)
+                if self._rotated_re.match(filename)]
+
+
+class FallbackReplayer(object):
+
+    """Read the fallback log back, a chunk at a time.
+
+    The current fallback log is rotated (see ``FallbackWriter``) before being
+    read, so only complete files are ever read, oldest first, and each is
+    deleted once it has been replayed.
+
+    The replayer keeps track of how far into the current file it has got in a
+    file next to the fallback log (with an ``.offset`` suffix), so that a
+    replay interrupted by the process exiting carries on where it left off.
+
+    Reading is rate-limited: ``allowance()`` returns how many documents may be
+    replayed now, accumulating ``rate`` documents per second up to one
+    second's worth.
+
+    :param writer: The ``FallbackWriter`` for the fallback log.
+
+    :param lock: The lock held by users of ``writer``.
+
+    :param rate: The maximum number of documents to replay per second.
+
+    """
+
+    def __init__(self, writer, lock, rate=1000):
+        """Init method.  See class docstring."""
+        self.writer = writer
+        self.lock = lock
+        self.rate = rate
+        self.logger = logging.getLogger(__name__)
+
+        self._allowance = 0
+        self._last_allowance = time.time()
+
+        self._file = None
+        self._current = None
+        self._eof = False
+        (self._saved_name, self.offset) = self._load_offset()
+
+    def _offset_path(self):
+        return self.writer.path + OFFSET_SUFFIX
+
+    def _load_offset(self):
+        try:
+            with open(self._offset_path(), 'r') as offset_file:
+                saved = loads(offset_file.read())
+            return (saved['file'], saved['offset'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return (None, 0)
+
+    def _save_offset(self):
+        try:
+            if self._current is None:
+                if os.path.exists(self._offset_path()):
+                    os.remove(self._offset_path())
+            else:
+                with open(self._offset_path(), 'w') as offset_file:
+                    offset_file.write(dumps({
+                        'file': os.path.basename(self._current),
+                        'offset': self.offset}))
+        except (IOError, OSError):
+            self.logger.error('Error saving the fallback log offset.',
+                              exc_info=True)
+
+    def pending(self):
+        """Whether there is anything left to replay."""
+        return self._current is not None or \
+            len(self.writer.rotated_files()) > 0 or self.writer.size() > 0
+
+    def allowance(self):
+        """The number of documents which may be replayed now."""
+        now = time.time()
+        self._allowance = min(
+            self.rate,
+            self._allowance + (now - self._last_allowance) * self.rate)
+        self._last_allowance = now
+        return int(self._allowance)
+
+    def _next_file(self):
+        """Open the oldest rotated file, rotating the current one if needed."""
+        rotated_files = self.writer.rotated_files()
+        if not rotated_files:
+            with self.lock:
+                self.writer.rotate()
+            rotated_files = self.writer.rotated_files()
+            if not rotated_files:
+                return False
+
+        self._file = open_log(rotated_files[0])
+        self._current = rotated_files[0]
+        self._eof = False
+        if os.path.basename(self._current) != self._saved_name:
+            self.offset = 0
+        # Otherwise carry on from where a previous run got to.
+        self._saved_name = None
+        return True
+
+    def read(self, max_docs):
+        """Read up to ``max_docs`` documents.
+
+        Returns the documents and the offset just after them, to be passed to
+        ``commit()`` once they have been dealt with.  Until then, the same
+        documents will be read again.
+
+        """
+        docs = []
+        offset = self.offset
+        try:
+            if self._file is None and not self._next_file():
+                return (docs, self.offset)
+            offset = self.offset
+            if self._file.tell() != offset:
+                self._file.seek(offset)
+                self._eof = False
+            while len(docs) < max_docs:
+                line = self._file.readline()
+                if not line.endswith(b'\n'):
+                    if line:
+                        self.logger.warning('Skipping a truncated line at '
+                                            'the end of %s.', self._current)
+                    self._eof = True
+                    break
+                offset += len(line)
+                try:
+                    docs.append(loads(line.decode('utf-8')))
+                except ValueError:
+                    self.logger.error('Skipping a corrupt line in %s.',
+                                      self._current, exc_info=True)
+        except EOFError:
+            # A compressed file which was not closed properly.
+            self.logger.warning('Unexpected end of %s.', self._current)
+            self._eof = True
+        except (IOError, OSError):
+            if self._file is None:
+                # Try again on the next read.
+                self.logger.error('Error opening the fallback log to replay '
+                                  'it.', exc_info=True)
+            else:
+                self.logger.error('Error reading %s.  Skipping the rest of '
+                                  'it.', self._current, exc_info=True)
+                self._eof = True
+        self._allowance -= len(docs)
+        return (docs, offset)
+
+    def commit(self, offset):
+        """Record that everything up to ``offset`` has been replayed.
+
+        Once the whole of a file has been replayed, it is deleted.
+
+        """
+        self.offset = offset
+        if self._eof and self._current is not None:
+            self._file.close()
+            self._file = None
+            try:
+                os.remove(self._current)
+            except OSError:
+                self.logger.error('Error removing %s.', self._current,
+                                  exc_info=True)
+            self._current = None
+            self.offset = 0
+        self._save_offset()
+
+    def close(self):
+        """Close the file being replayed, if any."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
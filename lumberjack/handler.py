@@ -18,14 +18,182 @@
 
 """Provide classes to fit into the Python logging framework."""
 
+from json import dumps
+import calendar
 import logging
 import time
+import zlib
 from copy import deepcopy
 
+COPY_MODES = ('deep', 'shallow')
+
+(SECOND, MINUTE, HOUR, DAY, MONTH, YEAR) = range(6)
+
+# The time unit each strftime() directive changes with, in UTC.
+_DIRECTIVE_GRANULARITY = {
+    'S': SECOND, 's': SECOND, 'c': SECOND, 'T': SECOND, 'X': SECOND,
+    'r': SECOND,
+    'M': MINUTE, 'R': MINUTE,
+    'H': HOUR, 'I': HOUR, 'p': HOUR,
+    'd': DAY, 'e': DAY, 'j': DAY, 'a': DAY, 'A': DAY, 'w': DAY, 'u': DAY,
+    'D': DAY, 'F': DAY, 'x': DAY, 'U': DAY, 'W': DAY, 'V': DAY, 'G': DAY,
+    'g': DAY,
+    'm': MONTH, 'b': MONTH, 'B': MONTH, 'h': MONTH,
+    'Y': YEAR, 'y': YEAR, 'C': YEAR, 'z': YEAR, 'Z': YEAR, 'n': YEAR,
+    't': YEAR, '%': YEAR,
+}
+
+_UNIT_SECONDS = {SECOND: 1, MINUTE: 60, HOUR: 3600, DAY: 86400}
+
+
+def format_granularity(suffix_format):
+    """The smallest time unit a ``strftime()`` format changes with, in UTC.
+
+    Returns ``None`` if the format has a directive which is not understood,
+    in which case it should be formatted afresh every time.
+
+    """
+    granularity = YEAR
+    i = 0
+    while i < len(suffix_format):
+        if suffix_format[i] == '%':
+            directive = suffix_format[i + 1:i + 2]
+            if directive not in _DIRECTIVE_GRANULARITY:
+                return None
+            granularity = min(granularity, _DIRECTIVE_GRANULARITY[directive])
+            i += 2
+        else:
+            i += 1
+    return granularity
+
+
+class SuffixCache(object):
+
+    """Format index suffixes, reusing the last one while it is current.
+
+    The suffix of a document only changes when its time crosses into a new
+    unit of the smallest granularity used in the format: a new month for the
+    default ``'%Y.%m'``, a new day for ``'%Y.%m.%d'``, and so on.  So the
+    last suffix is kept with the bounds of its time bucket, and only
+    recomputed for a time outside them.  Formats with directives not known to
+    be safe are formatted every time.
+
+    :param suffix_format: The ``strftime()`` format for the suffixes.
+
+    """
+
+    def __init__(self, suffix_format):
+        """Init method.  See class docstring."""
+        self.suffix_format = suffix_format
+        self.granularity = format_granularity(suffix_format)
+        # (start, end, suffix), replaced as a whole so it is thread-safe.
+        self._bucket = (0, 0, None)
+
+    def _bounds(self, timestamp):
+        if self.granularity in _UNIT_SECONDS:
+            unit = _UNIT_SECONDS[self.granularity]
+            start = timestamp - timestamp % unit
+            return (start, start + unit)
+        tm = time.gmtime(timestamp)
+        if self.granularity == MONTH:
+            start = (tm.tm_year, tm.tm_mon)
+            end = (tm.tm_year + tm.tm_mon // 12, tm.tm_mon % 12 + 1)
+        else:
+            start = (tm.tm_year, 1)
+            end = (tm.tm_year + 1, 1)
+        return (calendar.timegm(start + (1, 0, 0, 0)),
+                calendar.timegm(end + (1, 0, 0, 0)))
+
+    def suffix(self, timestamp):
+        """Get the suffix for a Unix timestamp."""
+        (start, end, suffix) = self._bucket
+        if start <= timestamp < end:
+            return suffix
+        suffix = time.strftime(self.suffix_format, time.gmtime(timestamp))
+        if self.granularity is not None:
+            (start, end) = self._bounds(timestamp)
+            self._bucket = (start, end, suffix)
+        return suffix
+
+
+def _fingerprint(doc):
+    return zlib.crc32(dumps(doc, sort_keys=True, default=repr)
+                      .encode('utf-8')) & 0xffffffff
+
+
+class MutationCheck(object):
+
+    """Postprocessor warning if a document changed after it was logged.
+
+    Used by ``ElasticsearchHandler`` when ``check_mutation`` is set.  It runs
+    before any other postprocessors, and compares the document with a
+    fingerprint taken when it was logged.
+
+    :param doc: The document as it was logged.
+
+    """
+
+    copy_mode = 'none'
+
+    def __init__(self, doc):
+        """Init method.  See class docstring."""
+        self.fingerprint = _fingerprint(doc)
+
+    def __call__(self, doc):
+        """Check the document, and return it unchanged."""
+        if _fingerprint(doc) != self.fingerprint:
+            logging.getLogger(__name__).warning(
+                'Log document was changed after it was logged: %r', doc)
+        return doc
+
+
+def make_document(msg, created, levelno, copy_mode='deep'):
+    """Build the document to index for some log data.
+
+    See ``ElasticsearchFormatter.format``.
+
+    :param msg: The log data: a ``dict``, or anything else to be stored as
+        the ``message`` field.
+
+    :param created: The time of the event, as a Unix timestamp.
+
+    :param levelno: The log level, as an integer.
+
+    :param copy_mode: How to copy a ``dict``: ``'deep'`` or ``'shallow'``.
+
+    """
+    # TODO don't glomp @timestamp and level if they already exist?
+    if not type(msg) == dict:
+        es_document = {'message': msg}
+    elif copy_mode == 'shallow':
+        es_document = dict(msg)
+    else:
+        es_document = deepcopy(msg)
+
+    # Milliseconds
+    es_document['@timestamp'] = created * 1000
+    es_document['level'] = levelno
+    return es_document
+
 
 class ElasticsearchFormatter(logging.Formatter):
 
-    """Formatter which prepares logs for insertion into Elasticsearch."""
+    """Formatter which prepares logs for insertion into Elasticsearch.
+
+    :param copy_mode: How to copy dict log data, so that the logged document
+        is not changed by later changes to the dict: ``'deep'`` copies the
+        whole structure; ``'shallow'`` only copies the top level, which is
+        faster, but the caller must not change any nested values once they
+        have been logged.
+
+    """
+
+    def __init__(self, copy_mode='deep'):
+        """Init method.  See class docstring."""
+        logging.Formatter.__init__(self)
+        if copy_mode not in COPY_MODES:
+            raise ValueError('Unknown copy_mode %r.' % copy_mode)
+        self.copy_mode = copy_mode
 
     def format(self, record):
         """Add some metadata and deals with string logs.
@@ -41,15 +209,8 @@ class ElasticsearchFormatter(logging.Formatter):
         :param record: The ``logging.LogRecord`` object to be formatted.
 
         """
-        # TODO don't glomp @timestamp and level if they already exist?
-        if not type(record.msg) == dict:
-            es_document = {'message': record.msg}
-        else:
-            es_document = deepcopy(record.msg)
-
-        # Milliseconds
-        es_document['@timestamp'] = record.created * 1000
-        es_document['level'] = record.levelno
+        es_document = make_document(record.msg, record.created,
+                                    record.levelno, self.copy_mode)
 
         record.message = es_document
 
@@ -67,16 +228,33 @@ class ElasticsearchHandler(logging.Handler):
     :param suffix_format: The format from which to generate the time-based
         index suffixes for Elasticsearch.  `strftime()` format.
 
+    :param copy_mode: Passed to the ``ElasticsearchFormatter``.
+
+    :param check_mutation: If ``True``, warn when a logged document is
+        changed between being logged and being sent.  This is a debugging
+        aid for ``copy_mode='shallow'``, and slows logging down.
+
     """
 
     # TODO: suffix_format in config
-    def __init__(self, action_queue, suffix_format='%Y.%m'):
+    def __init__(self, action_queue, suffix_format='%Y.%m', copy_mode='deep',
+                 check_mutation=False):
         """Init method.  See class docstring."""
         logging.Handler.__init__(self)
         self.action_queue = action_queue
-        self.setFormatter(ElasticsearchFormatter())
+        self.setFormatter(ElasticsearchFormatter(copy_mode=copy_mode))
 
         self.suffix_format = suffix_format
+        self.check_mutation = check_mutation
+
+    @property
+    def suffix_format(self):
+        """The ``strftime()`` format for index suffixes."""
+        return self._suffix_cache.suffix_format
+
+    @suffix_format.setter
+    def suffix_format(self, suffix_format):
+        self._suffix_cache = SuffixCache(suffix_format)
 
     def emit(self, record):
         """Format the log and pass it to an ElasticsearchContext instance.
@@ -89,11 +267,14 @@ class ElasticsearchHandler(logging.Handler):
         """
         self.last_formatted_record = record
 
-        suffix = time.strftime(self.suffix_format, time.gmtime(record.created))
+        suffix = self._suffix_cache.suffix(record.created)
         (es_type, document) = self.format(record)
 
         postprocessors = record.args['postprocessors'] \
             if 'postprocessors' in record.args else None
+        if self.check_mutation:
+            postprocessors = [MutationCheck(document)] + \
+                list(postprocessors or [])
 
         self.action_queue.queue_index(suffix=suffix, doc_type=es_type,
                                       body=document,
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Forward logs from many processes to a single shipping process.
+
+Under a pre-forking server, each worker process would otherwise need its own
+``Lumberjack``, with its own queue, flush thread and Elasticsearch
+connections.  Instead, the workers can log through a ``ForwardingHandler``,
+which sends each formatted document as a datagram on a Unix domain socket,
+and a single process runs a ``ForwardingServer`` which queues them all into
+one ``ActionQueue``, for fewer, bigger bulk requests.
+"""
+
+from __future__ import absolute_import
+
+from json import dumps, loads
+from threading import Thread
+import errno
+import logging
+import os
+import socket
+
+from .handler import ElasticsearchFormatter, SuffixCache
+
+# The largest datagram the server will read.
+MAX_DATAGRAM = 256 * 1024
+
+
+def queue_message(action_queue, message, postprocessors):
+    """Queue a document sent by a ``ForwardingHandler``.
+
+    Returns whether the message could be decoded; if not, it is logged and
+    discarded.
+
+    :param action_queue: The ``lumberjack.ActionQueue`` to queue it on.
+
+    :param message: The message, as bytes.
+
+    :param postprocessors: A dict from document types to lists of
+        postprocessors.
+
+    """
+    try:
+        doc = loads(message.decode('utf-8'))
+        suffix = doc['suffix']
+        doc_type = doc['doc_type']
+        body = doc['body']
+    except (ValueError, KeyError, TypeError):
+        logging.getLogger(__name__).error('Discarding a malformed message.',
+                                          exc_info=True)
+        return False
+    action_queue.queue_index(suffix=suffix, doc_type=doc_type, body=body,
+                             postprocessors=postprocessors.get(doc_type))
+    return True
+
+
+class ForwardingHandler(logging.Handler):
+
+    """Handler sending logs to a ``ForwardingServer``.
+
+    Records are formatted as by ``lumberjack.handler.ElasticsearchHandler``,
+    and sent without blocking.  If the server is not running or cannot keep
+    up, or a document is too big for a datagram, the document is dropped and
+    counted in ``dropped``.
+
+    Postprocessors cannot be sent to another process, so any passed with a
+    log call are ignored; the server applies its own instead.
+
+    :param path: The path of the server's socket.
+
+    :param suffix_format: As for ``ElasticsearchHandler``.
+
+    :param copy_mode: As for ``ElasticsearchHandler``.
+
+    """
+
+    def __init__(self, path, suffix_format='%Y.%m', copy_mode='deep'):
+        """Init method.  See class docstring."""
+        logging.Handler.__init__(self)
+        self.path = path
+        self.setFormatter(ElasticsearchFormatter(copy_mode=copy_mode))
+        self.dropped = 0
+        self._suffix_cache = SuffixCache(suffix_format)
+        self._socket = None
+        self._pid = None
+
+    def _get_socket(self):
+        # Each process (e.g. a forked worker) gets its own socket.
+        if self._socket is None or self._pid != os.getpid():
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+            self._pid = os.getpid()
+        return self._socket
+
+    def encode(self, record):
+        """Format a record into a message for the server, as bytes."""
+        (doc_type, document) = self.format(record)
+        return dumps({
+            'suffix': self._suffix_cache.suffix(record.created),
+            'doc_type': doc_type,
+            'body': document
+        }, default=repr).encode('utf-8')
+
+    def send(self, message):
+        """Send a message to the server, returning whether it was sent."""
+        try:
+            self._get_socket().sendto(message, self.path)
+        except socket.error as error:
+            if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                   errno.ENOBUFS, errno.EMSGSIZE,
+                                   errno.ENOENT, errno.ECONNREFUSED):
+                raise
+            return False
+        return True
+
+    def emit(self, record):
+        """Format the log and send it to the server.
+
+        :param record: The ``logging.LogRecord`` object to send.
+
+        """
+        try:
+            if not self.send(self.encode(record)):
+                self.dropped += 1
+        except Exception:
+            self.dropped += 1
+            self.handleError(record)
+
+    def close(self):
+        """Close the socket."""
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        logging.Handler.close(self)
+
+
+class ForwardingServer(Thread):
+
+    """Thread receiving logs from ``ForwardingHandler`` objects.
+
+    Each document received is queued on ``action_queue``, with the
+    postprocessors given for its type.  Start it with ``start()``, and stop it
+    with ``stop()``.
+
+    :param action_queue: The ``lumberjack.ActionQueue`` to queue documents on.
+
+    :param path: The path of the socket to listen on.  Any existing file there
+        is replaced.
+
+    :param postprocessors: A dict from document types to lists of
+        postprocessors to apply to documents of that type.
+
+    :param receive_buffer: The size of the socket's receive buffer, in bytes,
+        or ``None`` for the system default.  Datagrams arriving when it is
+        full are dropped by the senders.
+
+    """
+
+    def __init__(self, action_queue, path, postprocessors=None,
+                 receive_buffer=4 * 1024 * 1024):
+        """Init method.  See class docstring."""
+        Thread.__init__(self)
+        self.action_queue = action_queue
+        self.path = path
+        self.postprocessors = postprocessors or {}
+        self.running = True
+        self.received = 0
+        self.logger = logging.getLogger(__name__)
+
+        if os.path.exists(path):
+            os.remove(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if receive_buffer is not None:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                    receive_buffer)
+        self._socket.bind(path)
+        # Wake up now and then to check whether to stop.
+        self._socket.settimeout(0.5)
+        self.daemon = True
+
+    def _handle(self, message):
+        if queue_message(self.action_queue, message, self.postprocessors):
+            self.received += 1
+
+    def run(self):
+        """Receive and queue documents until stopped."""
+        try:
+            while self.running:
+                try:
+                    message = self._socket.recv(MAX_DATAGRAM)
+                except socket.timeout:
+                    continue
+                except socket.error:
+                    if not self.running:
+                        break
+                    self.logger.error('Error receiving from %s.', self.path,
+                                      exc_info=True)
+                    continue
+                self._handle(message)
+        finally:
+            self._socket.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def stop(self):
+        """Stop the server, and wait for it to finish."""
+        self.running = False
+        self.join()
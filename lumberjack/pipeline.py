@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Run postprocessors over a batch of queued actions."""
+
+from __future__ import absolute_import
+
+from copy import deepcopy
+import logging
+
+
+class BatchPostprocessor(object):
+
+    """Base class for postprocessors which can handle many documents at once.
+
+    Ordinary postprocessors are functions called with one document at a time.
+    Subclasses of this class also implement ``batch()``, which is called once
+    per flush with all the documents using the postprocessor, so that
+    expensive lookups can be deduplicated or done in bulk.
+
+    Postprocessors which compare equal are batched together, so subclasses
+    taking parameters should define ``__eq__`` and ``__hash__`` accordingly.
+
+    ``copy_mode`` is as for ordinary postprocessors (see
+    ``lumberjack.postprocessors.base``), and applies to each document.
+
+    """
+
+    copy_mode = 'deep'
+
+    def __call__(self, doc):
+        """Process a single document."""
+        return self.batch([doc])[0]
+
+    def batch(self, docs):
+        """Process a list of documents, returning a list of the same length.
+
+        :param docs: The documents, copied according to ``copy_mode``.
+
+        """
+        raise NotImplementedError()
+
+
+def copy_source(postprocessor, source):
+    """Copy a document as much as ``postprocessor`` needs it to be."""
+    copy_mode = getattr(postprocessor, 'copy_mode', 'deep')
+    if copy_mode == 'none':
+        return source
+    elif copy_mode == 'shallow':
+        return dict(source)
+    else:
+        return deepcopy(source)
+
+
+def _run_one(postprocessor, action, logger):
+    try:
+        action['_source'] = postprocessor(copy_source(postprocessor,
+                                                      action['_source']))
+    except Exception:
+        logger.error('Postprocessor %s raised an exception.' %
+                     repr(postprocessor), exc_info=True)
+
+
+def _run_batch(postprocessor, actions, logger):
+    sources = [copy_source(postprocessor, action['_source'])
+               for action in actions]
+    try:
+        results = postprocessor.batch(sources)
+        if len(results) != len(sources):
+            raise ValueError('Got %d documents back from %d.' %
+                             (len(results), len(sources)))
+    except Exception:
+        logger.error('Postprocessor %s raised an exception.' %
+                     repr(postprocessor), exc_info=True)
+        return
+    for (action, result) in zip(actions, results):
+        action['_source'] = result
+
+
+def run_postprocessors(queue_items, logger):
+    """Run the postprocessors of queued actions, and return the actions.
+
+    The postprocessors are run a stage at a time: first everyone's first
+    postprocessor, then everyone's second, and so on, so the order within
+    each action's chain is kept.  At each stage, the actions using equal
+    ``BatchPostprocessor`` objects are passed to them together.
+
+    A postprocessor which raises an exception is logged and skipped, leaving
+    the documents as they were before it.
+
+    :param queue_items: ``(action, postprocessors, size)`` tuples, as queued
+        by ``lumberjack.actions.ActionQueue``.
+
+    :param logger: The logger to report exceptions to.
+
+    """
+    actions = [queue_item[0] for queue_item in queue_items]
+    chains = [queue_item[1] for queue_item in queue_items]
+
+    stage = 0
+    while True:
+        batches = {}
+        pending = False
+        for (action, chain) in zip(actions, chains):
+            if stage >= len(chain):
+                continue
+            pending = True
+            postprocessor = chain[stage]
+            if isinstance(postprocessor, BatchPostprocessor):
+                batches.setdefault(postprocessor, []).append(action)
+            else:
+                _run_one(postprocessor, action, logger)
+        if not pending:
+            break
+        for (postprocessor, batch_actions) in batches.items():
+            _run_batch(postprocessor, batch_actions, logger)
+        stage += 1
+
+    return actions
+
+
+def run_postprocessors_in_worker(queue_items):
+    """Run ``run_postprocessors`` in a worker process.
+
+    Only the actions are sent back, since postprocessors need not be
+    picklable both ways.
+
+    """
+    return run_postprocessors(queue_items, logging.getLogger(__name__))
+
+
+def split(items, parts):
+    """Split a list into at most ``parts`` slices of about the same length."""
+    size = max(1, -(-len(items) // parts))
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -20,6 +20,8 @@
 
 from __future__ import absolute_import
 
-from .geoip import geoip
+from ..pipeline import BatchPostprocessor
+from .base import inplace, pure
+from .geoip import GeoIP, geoip
 
-__all__ = ('geoip')
+__all__ = ('BatchPostprocessor', 'GeoIP', 'geoip', 'inplace', 'pure')
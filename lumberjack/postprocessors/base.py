@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Markers declaring how postprocessors treat the documents passed to them.
+
+Before running a postprocessor, Lumberjack copies the document, so that if
+the postprocessor raises an exception half-way through changing it, the
+document is left as it was.  By default the copy is a deep one, which is
+expensive for large documents.  Postprocessors can declare that they need
+less:
+
+- ``pure`` postprocessors never change the document passed to them (they may
+  return a new one), so they are passed the document itself.
+
+- ``inplace`` postprocessors only add, replace or delete top-level fields of
+  the document, so they are passed a shallow copy.
+
+The declaration is kept in the ``copy_mode`` attribute of the postprocessor,
+which can also be set directly.
+"""
+
+from __future__ import absolute_import
+
+COPY_MODES = ('none', 'shallow', 'deep')
+
+
+def pure(postprocessor):
+    """Declare that ``postprocessor`` does not change its argument."""
+    postprocessor.copy_mode = 'none'
+    return postprocessor
+
+
+def inplace(postprocessor):
+    """Declare that ``postprocessor`` only changes top-level fields."""
+    postprocessor.copy_mode = 'shallow'
+    return postprocessor
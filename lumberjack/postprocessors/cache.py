@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Provide the LRUCache class."""
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+_MISSING = object()
+
+
+class LRUCache(object):
+
+    """A bounded, thread-safe cache with least-recently-used eviction.
+
+    Entries also expire ``ttl`` seconds after being set.  ``None`` is a valid
+    value, so negative results can be cached too.  The numbers of hits and
+    misses are kept in ``hits`` and ``misses``.
+
+    :param max_size: The maximum number of entries.
+
+    :param ttl: The lifetime of an entry in seconds, or ``None`` for no
+        expiry.
+
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        """Init method.  See class docstring."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        # So we can monkey-patch it in testing
+        self._time = time.time
+
+    def __len__(self):
+        """The number of entries, including expired ones not yet evicted."""
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Get the value for ``key``, or ``default`` if missing or expired."""
+        with self._lock:
+            entry = self._entries.pop(key, _MISSING)
+            if entry is not _MISSING:
+                (value, expires) = entry
+                if expires is None or expires > self._time():
+                    # Move it to the most-recently-used end.
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Set the value for ``key``, evicting the oldest entry if full."""
+        if self.max_size <= 0:
+            return
+        expires = self._time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
@@ -19,23 +19,215 @@
 """Postprocessor to provide GeoIP lookup."""
 
 from __future__ import absolute_import
-from geoip import geolite2
+from threading import Lock
+import logging
+import socket
 
+from ..pipeline import BatchPostprocessor
+from .cache import LRUCache
+
+# The network prefixes, in bits, used by ``cache_by_prefix``.
+PREFIX_BITS = ((socket.AF_INET, 24), (socket.AF_INET6, 48))
+
+_MISSING = object()
+
+LOG = logging.getLogger(__name__)
+
+# Open databases, by path (None for the bundled GeoLite2 database).
+_databases = {}
+_databases_lock = Lock()
+
+# Caches shared between GeoIP objects with the same database and cache
+# settings.
+_caches = {}
+_caches_lock = Lock()
+
+
+def _shared_cache(database, max_size, ttl, by_prefix):
+    key = (database, max_size, ttl, by_prefix)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = LRUCache(max_size=max_size, ttl=ttl)
+        return _caches[key]
+
+
+def open_database(path=None):
+    """Open a GeoIP database, once per process.
+
+    ``python-geoip`` memory-maps the file read-only, so processes forked after
+    it has been opened share its pages.
+
+    :param path: The path of a MaxMind database file, or ``None`` for the
+        GeoLite2 database bundled with ``python-geoip-geolite2``.
+
+    """
+    with _databases_lock:
+        if path not in _databases:
+            if path is None:
+                from geoip import geolite2
+                _databases[path] = geolite2
+            else:
+                import geoip
+                _databases[path] = geoip.open_database(path)
+        return _databases[path]
+
+
+def prefix_key(ip):
+    """The network prefix of ``ip`` (see ``PREFIX_BITS``), for caching.
+
+    Returns ``ip`` itself if it is not a valid IP address.
+
+    """
+    for (family, bits) in PREFIX_BITS:
+        try:
+            packed = socket.inet_pton(family, ip)
+        except (socket.error, ValueError, TypeError):
+            continue
+        return (family, packed[:bits // 8])
+    return ip
+
+
+class GeoIP(BatchPostprocessor):
 
-def geoip(field='ip'):
     """Postprocessor to collect GeoIP data from an IP field in the log entry.
 
+    When a batch of documents is processed, each distinct IP is only looked up
+    once.  Documents without the field are left as they are.
+
+    The database is only opened when the first IP is looked up.
+
+    Results, including IPs not found in the database, are kept in an LRU
+    cache shared by all ``GeoIP`` objects with the same database and cache
+    settings.  Its
+    ``hits`` and ``misses`` are available as ``self.cache.hits`` and
+    ``self.cache.misses``.
+
     :param field: The name of the field which contains the IP.
+
+    :param database: The path of the MaxMind database file to use, or
+        ``None`` for the bundled GeoLite2 database.
+
+    :param cache_size: The maximum number of cached results.  ``0`` disables
+        the cache.
+
+    :param cache_ttl: How long to cache results for, in seconds, or ``None``
+        to keep them until evicted.
+
+    :param cache_by_prefix: If ``True``, cache results by network (``/24``
+        for IPv4, ``/48`` for IPv6) rather than by address.  This saves
+        lookups at the cost of giving every address in a network the result
+        of the first one looked up.
+
     """
-    def _inner(doc):
-        ip_data = geolite2.lookup(doc[field])
-        if ip_data is not None:
-            doc['geoip'] = {
-                'country_code': ip_data.country,
-                'location': {
-                    'lat': ip_data.location[0],
-                    'lon': ip_data.location[1]
+
+    copy_mode = 'shallow'
+
+    def __init__(self, field='ip', database=None, cache_size=10000,
+                 cache_ttl=3600, cache_by_prefix=False):
+        """Init method.  See class docstring."""
+        self.field = field
+        self.database = database
+        self._database = None
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache_by_prefix = cache_by_prefix
+        self.cache = _shared_cache(database, cache_size, cache_ttl,
+                                   cache_by_prefix)
+
+    def _settings(self):
+        return (self.field, self.database, self.cache_size, self.cache_ttl,
+                self.cache_by_prefix)
+
+    def __eq__(self, other):
+        """Equal if looking up the same field with the same cache."""
+        return type(other) is type(self) and \
+            other._settings() == self._settings()
+
+    def __ne__(self, other):
+        """Opposite of ``__eq__``."""
+        return not self == other
+
+    def __hash__(self):
+        """Hash consistently with ``__eq__``."""
+        return hash((type(self),) + self._settings())
+
+    def __repr__(self):
+        """Show the field."""
+        return '%s(field=%r)' % (type(self).__name__, self.field)
+
+    def __getstate__(self):
+        """Pickle the settings, but not the cache."""
+        return {'settings': self._settings()}
+
+    def __setstate__(self, state):
+        """Unpickle, sharing the cache of the current process."""
+        self.__init__(*state['settings'])
+
+    def _cache_key(self, ip):
+        return prefix_key(ip) if self.cache_by_prefix else ip
+
+    def cached_lookup(self, ip):
+        """Like ``lookup``, but using the cache."""
+        key = self._cache_key(ip)
+        result = self.cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = self.lookup(ip)
+            self.cache.set(key, result)
+        return result
+
+    def lookup(self, ip):
+        """Return the country and location of ``ip``, or ``None``."""
+        if self._database is None:
+            self._database = open_database(self.database)
+        ip_data = self._database.lookup(ip)
+        if ip_data is None:
+            return None
+        return (ip_data.country, ip_data.location)
+
+    def batch(self, docs):
+        """Add a ``geoip`` field to each document.
+
+        An address which cannot be looked up, such as a malformed one or a
+        list of addresses, is logged and treated as not found, without
+        affecting the others.
+
+        """
+        results = {}
+        for doc in docs:
+            if self.field not in doc:
+                continue
+            ip = doc[self.field]
+            try:
+                result = results.get(ip, _MISSING)
+                if result is _MISSING:
+                    result = results[ip] = self.cached_lookup(ip)
+            except (ValueError, TypeError):
+                LOG.warning('Could not look up %r in the GeoIP database.',
+                            ip, exc_info=True)
+                result = None
+                try:
+                    results[ip] = None
+                    self.cache.set(self._cache_key(ip), None)
+                except TypeError:
+                    # Not hashable, so not cached either.
+                    pass
+            if result is not None:
+                (country, location) = result
+                doc['geoip'] = {
+                    'country_code': country,
+                    'location': {
+                        'lat': location[0],
+                        'lon': location[1]
+                    }
                 }
-            }
-        return doc
-    return _inner
+        return docs
+
+
+def geoip(field='ip', **kwargs):
+    """Postprocessor to collect GeoIP data from an IP field in the log entry.
+
+    See ``GeoIP`` for the other (cache) parameters.
+
+    :param field: The name of the field which contains the IP.
+    """
+    return GeoIP(field=field, **kwargs)
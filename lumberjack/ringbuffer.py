@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Forward logs from many processes through a shared-memory ring buffer.
+
+This is an alternative to the Unix socket of ``lumberjack.ipc``, with no
+system call to copy each document into the kernel and out again.  The buffer
+is a file, mapped into memory by every process using it.  Worker processes
+log through a ``RingBufferHandler``, which appends each formatted document,
+already serialised, to the buffer, and a single process runs a
+``RingBufferConsumer``, which queues them all into one ``ActionQueue``.
+
+The file starts with a header holding the capacity of the buffer and three
+counters: the total number of bytes ever written to the buffer and read from
+it, and the number of documents dropped.  The data area follows, holding
+length-prefixed records, which wrap around at the end.
+
+Writers take an exclusive ``flock`` on the file while appending, so any
+number of processes (and threads) can write at once.  A writer updates the
+write position only after copying its record in, so a writer dying part way
+through leaves nothing behind.  There must be only one consumer.
+
+When there is not enough free space for a document, it is dropped, and the
+count in the header incremented; documents already in the buffer are never
+overwritten.
+"""
+
+from __future__ import absolute_import
+
+from threading import Event, Lock, Thread
+import fcntl
+import logging
+import mmap
+import os
+import struct
+
+from .ipc import ForwardingHandler, queue_message
+
+MAGIC = b'LJRING01'
+
+_U64 = struct.Struct('>Q')
+_LENGTH = struct.Struct('>I')
+
+# Offsets of the header fields.
+_CAPACITY = 8
+_WRITE = 16
+_READ = 24
+_DROPPED = 32
+_DATA = 64
+
+
+class RingBuffer(object):
+
+    """A multi-producer, single-consumer ring buffer in a shared file.
+
+    :param path: The path of the buffer file.
+
+    :param capacity: The size of the data area, in bytes.  If given, the
+        buffer is created, replacing any file at ``path`` unless it is a
+        buffer with the same capacity (whose unread documents are then kept).
+        Otherwise the buffer must already exist.
+
+    """
+
+    def __init__(self, path, capacity=None):
+        """Init method.  See class docstring."""
+        self.path = path
+        if capacity is not None and self._existing_capacity() != capacity:
+            self._create(capacity)
+
+        self._file = open(path, 'r+b')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        except Exception:
+            self._file.close()
+            raise
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('%s is not a Lumberjack ring buffer.' % path)
+        self.capacity = self._get(_CAPACITY)
+
+        # flock() only excludes other open files, so threads sharing this one
+        # need a lock of their own.
+        self._lock = Lock()
+
+    def _existing_capacity(self):
+        try:
+            with open(self.path, 'rb') as buffer_file:
+                header = buffer_file.read(_DATA)
+        except (IOError, OSError):
+            return None
+        if len(header) < _DATA or header[:len(MAGIC)] != MAGIC:
+            return None
+        return _U64.unpack_from(header, _CAPACITY)[0]
+
+    def _create(self, capacity):
+        # Build the new file aside, so that writers never see half of it.
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as buffer_file:
+            buffer_file.write(MAGIC + _U64.pack(capacity))
+            buffer_file.truncate(_DATA + capacity)
+        os.rename(tmp_path, self.path)
+
+    def _get(self, offset):
+        return _U64.unpack_from(self._map, offset)[0]
+
+    def _set(self, offset, value):
+        _U64.pack_into(self._map, offset, value)
+
+    def _acquire(self):
+        self._lock.acquire()
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except Exception:
+            self._lock.release()
+            raise
+
+    def _release(self):
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    def _copy_in(self, position, data):
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        self._map[_DATA + start:_DATA + start + first] = data[:first]
+        if first < len(data):
+            self._map[_DATA:_DATA + len(data) - first] = data[first:]
+
+    def _copy_out(self, position, length):
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        data = self._map[_DATA + start:_DATA + start + first]
+        if first < length:
+            data += self._map[_DATA:_DATA + length - first]
+        return data
+
+    @property
+    def dropped(self):
+        """The number of documents dropped because the buffer was full."""
+        return self._get(_DROPPED)
+
+    def put(self, data):
+        """Append a record, returning whether there was room for it.
+
+        :param data: The record, as bytes.
+
+        """
+        record = _LENGTH.pack(len(data)) + data
+        self._acquire()
+        try:
+            position = self._get(_WRITE)
+            if len(record) > self.capacity - (position - self._get(_READ)):
+                self._set(_DROPPED, self._get(_DROPPED) + 1)
+                return False
+            self._copy_in(position, record)
+            self._set(_WRITE, position + len(record))
+        finally:
+            self._release()
+        return True
+
+    def get_all(self):
+        """Remove and return all the records in the buffer, oldest first.
+
+        Only the single consumer may call this.
+
+        """
+        self._acquire()
+        try:
+            (start, end) = (self._get(_READ), self._get(_WRITE))
+        finally:
+            self._release()
+
+        # Writers never touch the records between the two positions, so they
+        # can be read without holding the lock.
+        records = []
+        position = start
+        while position < end:
+            (length,) = _LENGTH.unpack(self._copy_out(position,
+                                                      _LENGTH.size))
+            records.append(self._copy_out(position + _LENGTH.size, length))
+            position += _LENGTH.size + length
+
+        if position != start:
+            self._acquire()
+            try:
+                self._set(_READ, position)
+            finally:
+                self._release()
+        return records
+
+    def close(self):
+        """Unmap and close the buffer."""
+        self._map.close()
+        self._file.close()
+
+
+class RingBufferHandler(ForwardingHandler):
+
+    """Handler writing logs into a ``RingBuffer``.
+
+    Records are formatted as by ``lumberjack.ipc.ForwardingHandler``.  If the
+    buffer does not exist yet or is full, the document is dropped and counted
+    in ``dropped``.
+
+    If the consumer recreates the buffer with a different capacity, the
+    writing processes must be restarted to pick up the new file.
+
+    :param path: The path of the buffer file.
+
+    :param suffix_format: As for ``ElasticsearchHandler``.
+
+    :param copy_mode: As for ``ElasticsearchHandler``.
+
+    """
+
+    def __init__(self, path, suffix_format='%Y.%m', copy_mode='deep'):
+        """Init method.  See class docstring."""
+        ForwardingHandler.__init__(self, path, suffix_format=suffix_format,
+                                   copy_mode=copy_mode)
+        self._buffer = None
+
+    def _get_buffer(self):
+        # Each process (e.g. a forked worker) maps the file itself, as
+        # flock() would not exclude a parent sharing its open file.
+        if self._buffer is None or self._pid != os.getpid():
+            self._buffer = RingBuffer(self.path)
+            self._pid = os.getpid()
+        return self._buffer
+
+    def send(self, message):
+        """Write a message into the buffer, returning whether it fitted."""
+        try:
+            ring_buffer = self._get_buffer()
+        except (IOError, OSError, ValueError):
+            return False
+        return ring_buffer.put(message)
+
+    def close(self):
+        """Unmap the buffer."""
+        if self._buffer is not None and self._pid == os.getpid():
+            self._buffer.close()
+        self._buffer = None
+        ForwardingHandler.close(self)
+
+
+class RingBufferConsumer(Thread):
+
+    """Thread draining a ``RingBuffer`` into an ``ActionQueue``.
+
+    The buffer is created when the consumer is, so that handlers can start
+    writing to it straight away.  Each document read is queued on
+    ``action_queue``, with the postprocessors given for its type.  Start it
+    with ``start()``, and stop it with ``stop()``, which queues any documents
+    left in the buffer first.
+
+    :param action_queue: The ``lumberjack.ActionQueue`` to queue documents on.
+
+    :param path: The path of the buffer file.
+
+    :param capacity: The size of the buffer, in bytes.
+
+    :param postprocessors: A dict from document types to lists of
+        postprocessors to apply to documents of that type.
+
+    :param interval: How long to wait, in seconds, when the buffer is empty.
+
+    """
+
+    def __init__(self, action_queue, path, capacity=16 * 1024 * 1024,
+                 postprocessors=None, interval=0.1):
+        """Init method.  See class docstring."""
+        Thread.__init__(self)
+        self.action_queue = action_queue
+        self.path = path
+        self.postprocessors = postprocessors or {}
+        self.interval = interval
+        self.received = 0
+        self.buffer = RingBuffer(path, capacity=capacity)
+        self.logger = logging.getLogger(__name__)
+        self._stopping = Event()
+        self.daemon = True
+
+    @property
+    def dropped(self):
+        """The number of documents dropped because the buffer was full."""
+        return self.buffer.dropped
+
+    def _drain(self):
+        messages = self.buffer.get_all()
+        for message in messages:
+            if queue_message(self.action_queue, message,
+                             self.postprocessors):
+                self.received += 1
+        return len(messages)
+
+    def run(self):
+        """Queue documents from the buffer until stopped."""
+        try:
+            while not self._stopping.is_set():
+                try:
+                    if self._drain() == 0:
+                        self._stopping.wait(self.interval)
+                except Exception:
+                    self.logger.error('Error reading %s.', self.path,
+                                      exc_info=True)
+                    self._stopping.wait(self.interval)
+            self._drain()
+        finally:
+            self.buffer.close()
+
+    def stop(self):
+        """Stop the consumer, and wait for it to finish."""
+        self._stopping.set()
+        self.join()
@@ -21,7 +21,6 @@
 from __future__ import absolute_import
 
 import logging
-from elasticsearch import NotFoundError, TransportError
 from copy import deepcopy
 
 
@@ -61,6 +60,9 @@ class SchemaManager(object):
         :param schema: The schema data to be processed into a mapping.
 
         """
+        # Imported here so that importing lumberjack stays cheap.
+        from elasticsearch import NotFoundError, TransportError
+
         mapping = self._build_mapping(schema)
 
         template = {
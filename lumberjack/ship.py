@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Ship NDJSON files of actions into Elasticsearch from the command line.
+
+Installed as the ``lumberjack-ship`` command::
+
+    $ lumberjack-ship --hosts es1:9200,es2:9200 --workers 4 \\
+          --state ship-state.json /tmp/lumberjack_fallback.log.*
+
+Each line of the input files is an action as queued by Lumberjack (and
+written to the fallback and rejected logs), i.e. a JSON object with
+``_index``, ``_type`` and ``_source`` fields.  Files ending in ``.gz`` are
+decompressed on the fly.
+"""
+
+from __future__ import absolute_import, print_function
+
+from json import dumps, loads
+import argparse
+import logging
+import os
+import sys
+import time
+
+from .actions import ActionQueue
+from .config import get_default_config
+from .fallback import open_log
+
+# Fields added to actions in the rejected log, not to be sent.
+REJECTED_FIELDS = ('_status', '_error')
+
+
+class Shipper(object):
+
+    """Send the actions in NDJSON files to Elasticsearch.
+
+    Actions are read ``chunk_size`` per worker at a time and sent using the
+    bulk request path of ``action_queue`` (with its retries, fallback log and
+    rejected log), so memory use is bounded however big the files are.
+
+    If ``state_file`` is given, the offset reached in each file is saved to it
+    after every batch, and shipping resumes from there when run again.
+
+    :param action_queue: The ``lumberjack.ActionQueue`` to send with.  Its
+        thread need not be started.
+
+    :param chunk_size: The number of actions per bulk request.
+
+    :param workers: The number of bulk requests to send at once.
+
+    :param rate: The maximum number of actions to send per second, or
+        ``None`` for no limit.
+
+    :param state_file: The path of a JSON file to keep offsets in, or
+        ``None``.
+
+    """
+
+    def __init__(self, action_queue, chunk_size=500, workers=1, rate=None,
+                 state_file=None):
+        """Init method.  See class docstring."""
+        self.action_queue = action_queue
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.rate = rate
+        self.state_file = state_file
+        self.logger = logging.getLogger(__name__)
+
+        self.stats = {'files': 0, 'read': 0, 'bytes': 0, 'corrupt': 0,
+                      'indexed': 0, 'retried': 0, 'rejected': 0,
+                      'fallback': 0}
+        self.offsets = self._load_state()
+        self._start_time = None
+        # So we can monkey-patch it in testing
+        self._sleep = time.sleep
+
+    def _load_state(self):
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file, 'r') as state:
+            return loads(state.read())
+
+    def _save_state(self):
+        if self.state_file is None:
+            return
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w') as state:
+            state.write(dumps(self.offsets))
+        os.rename(tmp_path, self.state_file)
+
+    def _throttle(self):
+        """Sleep until the actions sent so far are within the rate limit."""
+        if self.rate is None:
+            return
+        ahead = self.stats['read'] / float(self.rate) - \
+            (time.time() - self._start_time)
+        if ahead > 0:
+            self._sleep(ahead)
+
+    def _read_batch(self, log_file, offset):
+        """Read up to a batch of actions.
+
+        Returns them, the new offset, and whether the file ended early: a
+        compressed file left unclosed by a process which died has no end
+        marker, but the complete lines before that are still returned.
+
+        Lines which are not JSON objects are counted as corrupt and skipped.
+        One at the end of the file may still be being written, so is left for
+        next time.
+
+        """
+        actions = []
+        while len(actions) < self.chunk_size * self.workers:
+            try:
+                line = log_file.readline()
+            except EOFError:
+                self.logger.warning('Unexpected end of compressed file at '
+                                    'offset %d.', offset)
+                return (actions, offset, True)
+            if not line:
+                break
+            try:
+                action = loads(line.decode('utf-8'))
+            except ValueError:
+                action = None
+            # Valid JSON which is not an object is no action either.
+            if not isinstance(action, dict):
+                if not line.endswith(b'\n'):
+                    break
+                self.logger.warning('Skipping a corrupt line at offset %d.',
+                                    offset)
+                self.stats['corrupt'] += 1
+                offset += len(line)
+                continue
+            for field in REJECTED_FIELDS:
+                action.pop(field, None)
+            actions.append(action)
+            offset += len(line)
+        return (actions, offset, False)
+
+    def ship_file(self, path, pool=None):
+        """Send the actions in one file, from where it was left off."""
+        key = os.path.abspath(path)
+        offset = self.offsets.get(key, 0)
+        self.stats['files'] += 1
+        with open_log(path) as log_file:
+            if offset:
+                self.logger.info('Resuming %s from offset %d.', path, offset)
+                log_file.seek(offset)
+            while True:
+                (actions, new_offset, truncated) = self._read_batch(
+                    log_file, offset)
+                if not actions and new_offset == offset:
+                    break
+                result = self.action_queue.send_batch(
+                    actions, self.chunk_size, pool)
+                for (stat, count) in result.items():
+                    self.stats[stat] += count
+                self.stats['read'] += len(actions)
+                self.stats['bytes'] += new_offset - offset
+                offset = new_offset
+                self.offsets[key] = offset
+                self._save_state()
+                if truncated:
+                    break
+                self._throttle()
+
+    def ship(self, paths):
+        """Send the actions in each of ``paths``, and return the stats."""
+        self._start_time = time.time()
+        pool = None
+        if self.workers > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.workers)
+        try:
+            for path in paths:
+                self.ship_file(path, pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.stats['seconds'] = time.time() - self._start_time
+        return self.stats
+
+    def report(self, stream=sys.stdout):
+        """Write a summary of the stats to ``stream``."""
+        seconds = max(self.stats['seconds'], 0.001)
+        print('Shipped %(files)d files in %(seconds).1fs.' % self.stats,
+              file=stream)
+        print('  read      %d actions (%.1f MB), %d corrupt lines' % (
+            self.stats['read'], self.stats['bytes'] / 1048576.0,
+            self.stats['corrupt']), file=stream)
+        print('  indexed   %(indexed)d' % self.stats, file=stream)
+        print('  retried   %(retried)d' % self.stats, file=stream)
+        print('  rejected  %(rejected)d' % self.stats, file=stream)
+        print('  fallback  %(fallback)d' % self.stats, file=stream)
+        print('  rate      %.0f actions/s, %.2f MB/s' % (
+            self.stats['read'] / seconds,
+            self.stats['bytes'] / 1048576.0 / seconds), file=stream)
+
+
+def parse_hosts(hosts):
+    """Parse ``'host:port,host:port'`` into a list of host dicts."""
+    parsed = []
+    for host in hosts.split(','):
+        (name, _, port) = host.strip().partition(':')
+        parsed.append({'host': name, 'port': int(port or 9200)})
+    return parsed
+
+
+def parse_args(argv=None):
+    """Parse the command-line arguments of ``lumberjack-ship``."""
+    parser = argparse.ArgumentParser(
+        prog='lumberjack-ship',
+        description='Send NDJSON files of Lumberjack actions (such as the '
+                    'fallback log) to Elasticsearch.')
+    parser.add_argument('files', nargs='+', metavar='FILE',
+                        help='NDJSON files to send, optionally gzipped.')
+    parser.add_argument('--hosts', default='localhost:9200',
+                        help='Comma-separated Elasticsearch nodes '
+                             '(default: %(default)s).')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Bulk requests to send at once '
+                             '(default: %(default)s).')
+    parser.add_argument('--chunk', type=int, default=500,
+                        help='Actions per bulk request '
+                             '(default: %(default)s).')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Maximum actions per second (default: no '
+                             'limit).')
+    parser.add_argument('--state', default=None,
+                        help='File to save offsets in, to resume an '
+                             'interrupted run.')
+    parser.add_argument('--fallback-log',
+                        default='/tmp/lumberjack_ship_fallback.log',
+                        help='Where to write actions which could not be '
+                             'sent (default: %(default)s).')
+    parser.add_argument('--rejected-log',
+                        default='/tmp/lumberjack_ship_rejected.log',
+                        help='Where to write actions Elasticsearch rejected '
+                             '(default: %(default)s).')
+    parser.add_argument('--quiet', action='store_true',
+                        help='Do not print a report at the end.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Entry point of the ``lumberjack-ship`` command."""
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    config = get_default_config()
+    config['bulk_workers'] = args.workers
+    config['fallback_log_file'] = args.fallback_log
+    config['rejected_log_file'] = args.rejected_log
+
+    from elasticsearch import Elasticsearch
+    action_queue = ActionQueue(Elasticsearch(hosts=parse_hosts(args.hosts)),
+                               config)
+    shipper = Shipper(action_queue, chunk_size=args.chunk,
+                      workers=args.workers, rate=args.rate,
+                      state_file=args.state)
+    try:
+        shipper.ship(args.files)
+    finally:
+        action_queue.close_writers()
+    if not args.quiet:
+        shipper.report()
+    return 1 if shipper.stats['fallback'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Provide the Spool class."""
+
+from __future__ import absolute_import
+
+from json import dumps, loads
+from threading import Lock
+import logging
+import os
+import struct
+import time
+import zlib
+
+SEGMENT_SUFFIX = '.spool'
+CHECKPOINT_FILE = 'checkpoint'
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+# Each record is its length and CRC32, followed by the JSON document.
+_HEADER = struct.Struct('>II')
+
+
+class Spool(object):
+
+    """A durable, append-only log of actions on disk.
+
+    The spool is a directory of segment files.  Each segment is a sequence of
+    length-prefixed, checksummed JSON records.  A checkpoint file records the
+    position up to which the records have been acknowledged (i.e. dealt with
+    by Elasticsearch); segments entirely before the checkpoint are deleted.
+
+    Positions are ``(segment, offset)`` tuples, which compare in the order in
+    which records were written.
+
+    The records after the checkpoint can be read back a chunk at a time with
+    ``read()``, or all at once with ``replay()``.  New records always go into
+    a fresh segment, so a record torn by a crash never has valid records after
+    it.
+
+    :param directory: The directory holding the spool.  It is created if it
+        does not exist.
+
+    :param segment_bytes: The size after which a new segment is started.
+
+    :param fsync: When to ``fsync`` the segment after writing: ``'always'``,
+        at most every ``fsync_interval`` seconds (``'interval'``), or
+        ``'never'``, leaving it to the operating system.
+
+    :param fsync_interval: See ``fsync``.
+
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024,
+                 fsync='interval', fsync_interval=1):
+        """Init method.  See class docstring."""
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown spool fsync policy %r.' % fsync)
+
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = Lock()
+        self._file = None
+        self._last_fsync = time.time()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        segments = self._segments()
+        self._segment = segments[-1] + 1 if segments else 0
+        self._offset = 0
+
+    def _segments(self):
+        """The numbers of the segments on disk, in order."""
+        segments = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(SEGMENT_SUFFIX):
+                try:
+                    segments.append(int(filename[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    pass
+        return sorted(segments)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory,
+                            '%020d%s' % (segment, SEGMENT_SUFFIX))
+
+    def _checkpoint_path(self):
+        return os.path.join(self.directory, CHECKPOINT_FILE)
+
+    def checkpoint(self):
+        """The last acknowledged position, or ``(0, 0)``."""
+        try:
+            with open(self._checkpoint_path(), 'r') as checkpoint_file:
+                checkpoint = loads(checkpoint_file.read())
+        except (IOError, OSError, ValueError):
+            return (0, 0)
+        return (checkpoint['segment'], checkpoint['offset'])
+
+    def tell(self):
+        """The position just after the last record written."""
+        with self._lock:
+            return (self._segment, self._offset)
+
+    def _read_segment(self, segment, offset, max_docs=None, end=None):
+        """Read the records of a segment, starting at ``offset``.
+
+        Stops after ``max_docs`` records, or at offset ``end``.  Returns the
+        records and the offset just after them.
+
+        """
+        docs = []
+        with open(self._segment_path(segment), 'rb') as segment_file:
+            segment_file.seek(offset)
+            while (max_docs is None or len(docs) < max_docs) and \
+                    (end is None or offset < end):
+                header = segment_file.read(_HEADER.size)
+                if len(header) == 0:
+                    break
+                if len(header) < _HEADER.size:
+                    self.logger.warning('Truncated record in spool segment '
+                                        '%d.', segment)
+                    break
+                (length, checksum) = _HEADER.unpack(header)
+                data = segment_file.read(length)
+                if len(data) < length or \
+                        zlib.crc32(data) & 0xffffffff != checksum:
+                    self.logger.warning('Torn record in spool segment %d.',
+                                        segment)
+                    break
+                docs.append(loads(data.decode('utf-8')))
+                offset += _HEADER.size + length
+        return (docs, offset)
+
+    def read(self, position, max_docs, end=None):
+        """Read up to ``max_docs`` records, starting at ``position``.
+
+        Returns the records and the position just after them, from which to
+        read next, and up to which to ``ack()`` once they have been dealt
+        with.  Records from ``end`` on, by default the end of the spool, are
+        not read; once everything before it has been, the position returned
+        is ``end``.
+
+        """
+        if end is None:
+            end = self.tell()
+        (segment, offset) = position
+        docs = []
+        for next_segment in self._segments():
+            if next_segment < segment:
+                continue
+            if next_segment > segment:
+                (segment, offset) = (next_segment, 0)
+            if (segment, offset) >= end:
+                break
+            (segment_docs, offset) = self._read_segment(
+                segment, offset,
+                max_docs=None if max_docs is None else max_docs - len(docs),
+                end=end[1] if segment == end[0] else None)
+            docs.extend(segment_docs)
+            if max_docs is not None and len(docs) >= max_docs:
+                return (docs, (segment, offset))
+        return (docs, end)
+
+    def replay(self):
+        """Read back every record written after the checkpoint.
+
+        Only records from previous runs are returned; ``replay()`` should be
+        called before anything is appended.
+
+        """
+        (docs, _) = self.read(self.checkpoint(), None,
+                              end=(self._segment, 0))
+        self.logger.debug('Replayed %d records from the spool.', len(docs))
+        return docs
+
+    def append(self, docs):
+        """Append documents to the spool and return the position after them.
+
+        :param docs: A list of JSON-serialisable documents.
+
+        """
+        records = []
+        for doc in docs:
+            data = dumps(doc).encode('utf-8')
+            records.append(_HEADER.pack(len(data),
+                                        zlib.crc32(data) & 0xffffffff))
+            records.append(data)
+        buf = b''.join(records)
+
+        with self._lock:
+            if self._file is not None and self._offset > 0 and \
+                    self._offset + len(buf) > self.segment_bytes:
+                self._file.close()
+                self._file = None
+                self._segment += 1
+                self._offset = 0
+            if self._file is None:
+                self._file = open(self._segment_path(self._segment), 'ab')
+
+            self._file.write(buf)
+            self._file.flush()
+            self._offset += len(buf)
+
+            now = time.time()
+            if self.fsync == 'always' or (
+                    self.fsync == 'interval' and
+                    now - self._last_fsync >= self.fsync_interval):
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+
+            return (self._segment, self._offset)
+
+    def ack(self, position):
+        """Record that everything up to ``position`` has been dealt with.
+
+        The checkpoint is replaced atomically, and segments which are now
+        entirely acknowledged are deleted.
+
+        """
+        (segment, offset) = position
+        tmp_path = self._checkpoint_path() + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            checkpoint_file.write(dumps({'segment': segment,
+                                         'offset': offset}))
+            checkpoint_file.flush()
+            if self.fsync != 'never':
+                os.fsync(checkpoint_file.fileno())
+        os.rename(tmp_path, self._checkpoint_path())
+
+        for old_segment in self._segments():
+            if old_segment < segment:
+                try:
+                    os.remove(self._segment_path(old_segment))
+                except OSError:
+                    self.logger.warning('Could not remove spool segment %d.',
+                                        old_segment, exc_info=True)
+
+    def close(self):
+        """Close the current segment."""
+        with self._lock:
+            if self._file is not None:
+                if self.fsync != 'never':
+                    os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
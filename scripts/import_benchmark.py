@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script measures how long ``import lumberjack`` takes in a fresh
+# interpreter, and which heavy modules it pulls in.  Run it from the root of
+# the repository:
+#
+#     python scripts/import_benchmark.py [runs]
+
+from __future__ import print_function
+
+import subprocess
+import sys
+
+HEAVY_MODULES = ('elasticsearch', 'urllib3', 'multiprocessing', 'geoip')
+
+MEASURE = '''
+import sys, time
+start = time.time()
+import lumberjack
+elapsed = time.time() - start
+heavy = [name for name in %r if name in sys.modules]
+print('%%f %%s' %% (elapsed, ','.join(heavy)))
+''' % (HEAVY_MODULES,)
+
+
+def measure():
+    output = subprocess.check_output([sys.executable, '-c', MEASURE])
+    (elapsed, heavy) = (output.decode('utf-8').strip().split(' ') + [''])[:2]
+    return (float(elapsed), heavy)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    results = [measure() for _ in range(runs)]
+    times = sorted(elapsed for (elapsed, _) in results)
+
+    print('import lumberjack, %d runs:' % runs)
+    print('  min    %.1f ms' % (times[0] * 1000))
+    print('  median %.1f ms' % (times[len(times) // 2] * 1000))
+    print('  max    %.1f ms' % (times[-1] * 1000))
+    print('Heavy modules imported: %s' % (results[0][1] or 'none'))
+
+
+if __name__ == '__main__':
+    main()
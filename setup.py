@@ -49,6 +49,11 @@ setup(
     extras_require={
         "docs": "sphinx"
     },
+    entry_points={
+        'console_scripts': [
+            'lumberjack-ship = lumberjack.ship:main',
+        ],
+    },
     classifiers=[
         'Environment :: Plugins',
         'Intended Audience :: Developers',
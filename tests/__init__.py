@@ -18,7 +18,20 @@
 
 from __future__ import absolute_import
 
+import sys
+
 from .log import *
 from .schema import *
 from .actions import *
 from .postprocessors import *
+from .controller import *
+from .spool import *
+from .fallback import *
+from .pipeline import *
+from .emitter import *
+from .ship import *
+from .ipc import *
+from .ringbuffer import *
+
+if sys.version_info >= (3, 7):
+    from .aio import *
@@ -22,8 +22,9 @@ import time
 import elasticsearch
 import logging
 import json
-from mock import MagicMock
-from contextlib import contextmanager
+import os
+import threading
+from mock import MagicMock, patch
 
 import lumberjack
 
@@ -204,6 +205,498 @@ class ActionsTestCase(LumberjackTestCase):
 
         self.assertEqual(len(actions_list), MAX_QUEUE_LENGTH)
 
+    def test_swap_queue(self):
+        self.lj.action_queue.config['interval'] = None
+        self.lj.trigger_flush()
+        time.sleep(INTERVAL_JUMP_THREAD)
+
+        self.lj.action_queue.queue_index(suffix='test',
+                                         doc_type=__name__,
+                                         body={'message': 'testF'})
+        active = self.lj.action_queue.queue
+
+        swapped = self.lj.action_queue._swap_queue()
+
+        # The old buffer is handed over as-is, not copied.
+        self.assertIs(swapped, active)
+        self.assertEqual(len(swapped), 1)
+        self.assertIsNot(self.lj.action_queue.queue, active)
+        self.assertEqual(len(self.lj.action_queue.queue), 0)
+
+    @skipIfNotMock
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Needs fork().')
+    def test_fork(self):
+        (read_fd, write_fd) = os.pipe()
+        flushed = []
+
+        def mock_bulk_f(es, actions):
+            flushed.extend([action['_source']['message']
+                            for action in actions])
+
+        self.lj.action_queue._bulk = mock_bulk_f
+        self.lj.action_queue.queue_index(suffix='test', doc_type=__name__,
+                                         body={'message': 'parent'})
+
+        # As if another thread were queueing a document at the time.
+        with self.lj.action_queue.queue_lock:
+            pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                self.lj.action_queue.queue_index(
+                    suffix='test', doc_type=__name__,
+                    body={'message': 'child'})
+                # No trigger: the restarted thread flushes on its interval.
+                deadline = time.time() + 5
+                while not flushed and time.time() < deadline:
+                    time.sleep(0.01)
+                os.write(write_fd, json.dumps({
+                    'flushed': flushed,
+                    'alive': self.lj.action_queue.is_alive()
+                }).encode('utf-8'))
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_fd, 'rb') as pipe:
+            child = json.loads(pipe.read().decode('utf-8'))
+        self.assertEqual(child['flushed'], ['child'])
+        self.assertTrue(child['alive'])
+        # The parent's document is only ever the parent's to send.
+        self.assertTrue(self.lj.action_queue.is_alive())
+        self._stop_action_queue()
+        self.assertEqual(flushed, ['parent'])
+
+    def test_after_fork(self):
+        action_queue = lumberjack.ActionQueue(self.elasticsearch, self.config)
+        action_queue.queue_index(suffix='test', doc_type=__name__,
+                                 body={'message': 'a'})
+        action_queue.stats['retried'] = 1
+        action_queue.queue_lock.acquire()
+
+        # As if in a child process, without os.register_at_fork.
+        action_queue._check_pid = True
+        action_queue._pid = -1
+        action_queue.queue_index(suffix='test', doc_type=__name__,
+                                 body={'message': 'b'})
+
+        self.assertEqual([action['_source']['message']
+                          for (action, _, _) in action_queue.queue], ['b'])
+        self.assertEqual(action_queue.stats['retried'], 0)
+        self.assertEqual(action_queue._pid, os.getpid())
+        # It was never started, so is not started now.
+        self.assertFalse(action_queue.is_alive())
+
+    def _stop_action_queue(self):
+        """Stop the thread so that nothing is flushed behind our backs."""
+        self.lj.action_queue.running = False
+        self.lj.action_queue.trigger_flush()
+        self.lj.action_queue.join()
+
+    def _queue_messages(self, messages):
+        for message in messages:
+            self.lj.action_queue.queue_index(suffix='test',
+                                             doc_type=__name__,
+                                             body={'message': message})
+
+    def _queued_messages(self):
+        return [action['_source']['message']
+                for (action, _, _) in self.lj.action_queue.queue]
+
+    def test_queue_capacity_drop_newest(self):
+        self._stop_action_queue()
+        self.lj.config['queue_capacity'] = 2
+        self.lj.config['queue_full_policy'] = 'drop_newest'
+
+        self._queue_messages(['a', 'b', 'c'])
+
+        self.assertEqual(self._queued_messages(), ['a', 'b'])
+        self.assertEqual(self.lj.action_queue.stats['dropped_newest'], 1)
+
+    def test_queue_capacity_drop_oldest(self):
+        self._stop_action_queue()
+        self.lj.config['queue_capacity'] = 2
+        self.lj.config['queue_full_policy'] = 'drop_oldest'
+
+        self._queue_messages(['a', 'b', 'c'])
+
+        self.assertEqual(self._queued_messages(), ['b', 'c'])
+        self.assertEqual(self.lj.action_queue.stats['dropped_oldest'], 1)
+
+    def test_queue_capacity_bytes(self):
+        self._stop_action_queue()
+        doc_size = len(json.dumps({'message': 'a'}))
+        self.lj.config['queue_capacity_bytes'] = 2 * doc_size
+        self.lj.config['queue_full_policy'] = 'drop_oldest'
+
+        self._queue_messages(['a', 'b', 'c'])
+
+        self.assertEqual(self._queued_messages(), ['b', 'c'])
+        self.assertEqual(self.lj.action_queue.queue_bytes, 2 * doc_size)
+
+    def test_queue_capacity_block_timeout(self):
+        self._stop_action_queue()
+        self.lj.config['queue_capacity'] = 1
+        self.lj.config['queue_full_policy'] = 'block'
+        self.lj.config['queue_block_timeout'] = INTERVAL_JUMP_THREAD
+
+        self._queue_messages(['a'])
+        start = time.time()
+        self._queue_messages(['b'])
+
+        self.assertGreaterEqual(time.time() - start, INTERVAL_JUMP_THREAD)
+        self.assertEqual(self._queued_messages(), ['a'])
+        self.assertEqual(self.lj.action_queue.stats['dropped_newest'], 1)
+
+    def test_queue_capacity_block_until_flushed(self):
+        self.lj.config['queue_capacity'] = 1
+        self.lj.config['queue_full_policy'] = 'block'
+        self.lj.config['queue_block_timeout'] = INTERVAL_LONG
+        self.lj.action_queue.config['interval'] = None
+        self.lj.trigger_flush()
+        time.sleep(INTERVAL_JUMP_THREAD)
+
+        # The second call blocks until the (triggered) flush frees space.
+        self._queue_messages(['a', 'b'])
+
+        self.assertEqual(self._queued_messages(), ['b'])
+        self.assertEqual(self.lj.action_queue.stats['dropped_newest'], 0)
+
+    def test_queue_capacity_spill(self):
+        self._stop_action_queue()
+        self.lj.config['queue_capacity'] = 1
+        self.lj.config['queue_full_policy'] = 'spill'
+
+        file_ = MagicMock()
+        def my_open(filename, mode):
+            return file_
+        self.lj.action_queue._open = my_open
+
+        self._queue_messages(['a', 'b'])
+
+        self.assertEqual(self._queued_messages(), ['a'])
+        self.assertEqual(self.lj.action_queue.stats['spilled'], 1)
+        written = json.loads(file_.write.call_args[0][0])
+        self.assertEqual(written['_source'], {'message': 'b'})
+
+    def test_thread_local_buffers(self):
+        self._stop_action_queue()
+        self.lj.config['thread_local_buffers'] = True
+
+        def queue_messages(messages):
+            self._queue_messages(messages)
+            # Nothing went through the shared queue.
+            self.assertEqual(len(self.lj.action_queue.queue), 0)
+
+        self._queue_messages(['a'])
+        threads = [threading.Thread(target=queue_messages, args=([m, m],))
+                   for m in ['b', 'c']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.lj.action_queue._thread_buffers), 3)
+        self.assertEqual(self.lj.action_queue._queued(), 5)
+
+        queue = self.lj.action_queue._swap_queue()
+        self.assertEqual(
+            sorted([action['_source']['message']
+                    for (action, _, _) in queue]),
+            ['a', 'b', 'b', 'c', 'c'])
+        # Only this thread's buffer is left.
+        self.assertEqual(len(self.lj.action_queue._thread_buffers), 1)
+        self.assertEqual(self.lj.action_queue._queued(), 0)
+
+    def test_thread_local_buffers_raw_thread(self):
+        self._stop_action_queue()
+        self.lj.config['thread_local_buffers'] = True
+        try:
+            from _thread import start_new_thread
+        except ImportError:
+            from thread import start_new_thread
+        done = threading.Event()
+
+        def queue_message():
+            self._queue_messages(['a'])
+            done.set()
+
+        # Not started by threading, so its Thread object never dies.
+        start_new_thread(queue_message, ())
+        self.assertTrue(done.wait(1))
+        # Its local storage is freed just after it returns.
+        queued = []
+        for _ in range(100):
+            queued.extend(self.lj.action_queue._swap_queue())
+            if not self.lj.action_queue._thread_buffers:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(queued), 1)
+        self.assertEqual(self.lj.action_queue._thread_buffers, [])
+
+    def test_thread_local_buffers_flush(self):
+        actions_list = []
+
+        def mock_bulk_f(es, actions):
+            actions_list.extend(actions)
+
+        self.lj.config['thread_local_buffers'] = True
+        self.lj.action_queue._bulk = mock_bulk_f
+        self._queue_messages(['m%d' % i for i in range(MAX_QUEUE_LENGTH)])
+        time.sleep(INTERVAL_JUMP_THREAD)
+
+        self.assertEqual(len(actions_list), MAX_QUEUE_LENGTH)
+
+    def test_thread_local_buffers_with_capacity(self):
+        self._stop_action_queue()
+        self.lj.config['thread_local_buffers'] = True
+        self.lj.config['queue_capacity'] = 1
+
+        self._queue_messages(['a', 'b'])
+
+        # A capacity needs the shared queue.
+        self.assertEqual(self._queued_messages(), ['a'])
+        self.assertEqual(self.lj.action_queue._thread_buffers, [])
+
+    def test_queue_full_policy_unknown(self):
+        self.config['queue_full_policy'] = 'explode'
+        with self.assertRaises(ValueError):
+            lumberjack.Lumberjack(hosts=HOSTS, config=self.config)
+        self.config['queue_full_policy'] = 'drop_newest'
+
+    @skipIfNotMock
+    def test_max_queue_bytes(self):
+        actions_list = []
+        def mock_bulk_f(es, actions):
+            actions_list.extend(actions)
+
+        self.lj.action_queue._bulk = mock_bulk_f
+        self.lj.action_queue.config['interval'] = None
+        self.lj.trigger_flush()
+        time.sleep(INTERVAL_JUMP_THREAD)
+
+        doc = {'message': 'testG'}
+        self.lj.config['max_queue_bytes'] = 3 * len(json.dumps(doc))
+
+        self._queue_messages(['testG', 'testG'])
+        time.sleep(INTERVAL_JUMP_THREAD)
+        self.assertEqual(len(actions_list), 0)
+
+        self._queue_messages(['testG'])
+        time.sleep(INTERVAL_JUMP_THREAD)
+        self.assertEqual(len(actions_list), 3)
+
+    @skipIfNotMock
+    def test_max_bulk_bytes(self):
+        self._stop_action_queue()
+        chunks = []
+        def mock_bulk_f(es, actions):
+            chunks.append(list(actions))
+        self.lj.action_queue._bulk = mock_bulk_f
+
+        self._queue_messages(['a', 'b', 'c', 'd', 'e'])
+        action_size = self.lj.action_queue._estimate_size(
+            self.lj.action_queue.queue[0][0])
+        self.lj.config['max_bulk_bytes'] = 2 * action_size
+        self.lj.action_queue._flush()
+
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+
+    @skipIfNotMock
+    def test_serialised_once(self):
+        client = elasticsearch.Elasticsearch(hosts=HOSTS)
+        client.transport.perform_request = MagicMock(
+            return_value=(200, {'items': [{'index': {'status': 201}},
+                                          {'index': {'status': 201}}]}))
+        serializer = client.transport.serializer
+        dumps = MagicMock(side_effect=serializer.dumps)
+        serializer.dumps = dumps
+        action_queue = lumberjack.ActionQueue(client, self.config)
+        action_queue.queue_index(suffix='test', doc_type=__name__,
+                                 body={'message': 'a'})
+        action_queue.queue_index(suffix='test', doc_type=__name__,
+                                 body={'message': 'b'})
+
+        with patch('lumberjack.actions.dumps') as estimate:
+            action_queue._flush()
+
+        # Once for each action line and document, and not to estimate sizes;
+        # the lines are sent as they are.
+        self.assertFalse(estimate.called)
+        self.assertEqual(
+            len([call for call in dumps.call_args_list
+                 if not isinstance(call[0][0], str)]), 4)
+        body = client.transport.perform_request.call_args[1]['body']
+        self.assertEqual([json.loads(line) for line in body.splitlines()][1::2],
+                         [{'message': 'a'}, {'message': 'b'}])
+
+    @skipIfNotMock
+    def test_bulk_workers(self):
+        self._stop_action_queue()
+        sent = []
+        threads = set()
+        def mock_bulk_f(es, actions):
+            threads.add(threading.current_thread().name)
+            # Give the other workers a chance to pick up a chunk.
+            time.sleep(INTERVAL_JUMP_THREAD)
+            sent.extend(action['_source']['message'] for action in actions)
+        self.lj.action_queue._bulk = mock_bulk_f
+
+        messages = [str(i) for i in range(6)]
+        self._queue_messages(messages)
+        action_size = self.lj.action_queue._estimate_size(
+            self.lj.action_queue.queue[0][0])
+        self.lj.config['max_bulk_bytes'] = action_size
+        self.lj.config['bulk_workers'] = 3
+        self.lj.action_queue._flush()
+
+        self.assertEqual(sorted(sent), messages)
+        self.assertEqual(len(threads), 3)
+        self.lj.action_queue._close_sender_pool()
+
+    @skipIfNotMock
+    def test_index_many(self):
+        self._stop_action_queue()
+        self.lj.config['index_many_chunk'] = 3
+        consumed = []
+        def generate():
+            for i in range(10):
+                consumed.append(i)
+                yield {'message': str(i)}
+
+        requests = []
+        def mock_bulk_f(es, actions):
+            requests.append((len(consumed), [action['_source']['message']
+                                             for action in actions]))
+            if actions[0]['_source']['message'] == '9':
+                return [(actions[0], 400, 'mapper_parsing_exception')]
+        self.lj.action_queue._bulk = mock_bulk_f
+        self.lj.action_queue._open = MagicMock()
+
+        stats = self.lj.action_queue.index_many(
+            generate(), __name__, lambda doc: 'suffix-' + doc['message'],
+            postprocessors=[lambda doc: dict(doc, processed=True)])
+
+        # The generator is only consumed a chunk ahead.
+        self.assertEqual(requests, [(3, ['0', '1', '2']), (6, ['3', '4', '5']),
+                                    (9, ['6', '7', '8']), (10, ['9'])])
+        self.assertEqual(stats['indexed'], 9)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['fallback'], 0)
+        self.assertEqual(len(self.lj.action_queue.queue), 0)
+
+    @skipIfNotMock
+    def test_index_many_suffix(self):
+        self._stop_action_queue()
+        actions = []
+        self.lj.action_queue._bulk = lambda es, chunk: actions.extend(chunk)
+        docs = [{'@timestamp': 1451606400000 - 1},
+                {'@timestamp': 1451606400000},
+                {'message': 'no timestamp'}]
+
+        stats = self.lj.index_many(iter(docs), __name__)
+
+        prefix = self.config['index_prefix']
+        self.assertEqual([action['_index'] for action in actions],
+                         [prefix + '2015.12', prefix + '2016.01',
+                          prefix + time.strftime('%Y.%m', time.gmtime())])
+        self.assertEqual(stats['indexed'], 3)
+
+    @skipIfNotMock
+    def test_index_many_workers(self):
+        self._stop_action_queue()
+        self.lj.config['index_many_chunk'] = 1
+        self.lj.config['bulk_workers'] = 2
+        self.lj.action_queue._bulk = MagicMock(
+            side_effect=elasticsearch.TransportError(500, 'Test exception'))
+        self.lj.action_queue._open = MagicMock()
+
+        stats = self.lj.index_many(({'message': str(i)} for i in range(5)),
+                                   __name__, suffix='test')
+
+        self.assertEqual(self.lj.action_queue._bulk.call_count, 5)
+        self.assertEqual(stats['fallback'], 5)
+        self.assertEqual(stats['indexed'], 0)
+
+    def _mock_open_files(self):
+        files = {}
+        def my_open(filename, mode):
+            files.setdefault(filename, MagicMock())
+            return files[filename]
+        self.lj.action_queue._open = my_open
+        return files
+
+    def _written_docs(self, file_):
+        return [json.loads(line) for call in file_.write.call_args_list
+                for line in call[0][0].splitlines()]
+
+    @skipIfNotMock
+    def test_partial_failure_retry(self):
+        self._stop_action_queue()
+        files = self._mock_open_files()
+        sleeps = []
+        self.lj.action_queue._sleep = sleeps.append
+
+        calls = []
+        def mock_bulk_f(es, actions):
+            calls.append([action['_source']['message'] for action in actions])
+            if len(calls) > 1:
+                return []
+            return [(actions[0], 429, 'es_rejected_execution_exception'),
+                    (actions[1], 400, 'mapper_parsing_exception')]
+        self.lj.action_queue._bulk = mock_bulk_f
+
+        self._queue_messages(['a', 'b', 'c'])
+        self.lj.action_queue._flush()
+
+        # Only the document rejected with a 429 is sent again.
+        self.assertEqual(calls, [['a', 'b', 'c'], ['a']])
+        self.assertEqual(len(sleeps), 1)
+        self.assertLessEqual(sleeps[0], self.config['bulk_retry_backoff'])
+        self.assertEqual(self.lj.action_queue.stats['retried'], 1)
+
+        rejected = self._written_docs(
+            files[self.config['rejected_log_file']])
+        self.assertEqual(len(rejected), 1)
+        self.assertEqual(rejected[0]['_source'], {'message': 'b'})
+        self.assertEqual(rejected[0]['_status'], 400)
+        self.assertEqual(rejected[0]['_error'], 'mapper_parsing_exception')
+        self.assertEqual(self.lj.action_queue.stats['rejected'], 1)
+        self.assertNotIn(self.config['fallback_log_file'], files)
+
+    @skipIfNotMock
+    def test_partial_failure_retry_budget(self):
+        self._stop_action_queue()
+        files = self._mock_open_files()
+        sleeps = []
+        self.lj.action_queue._sleep = sleeps.append
+        self.lj.config['bulk_max_retries'] = 2
+
+        calls = []
+        def mock_bulk_f(es, actions):
+            calls.append(len(actions))
+            return [(action, 429, 'es_rejected_execution_exception')
+                    for action in actions]
+        self.lj.action_queue._bulk = mock_bulk_f
+
+        self._queue_messages(['a'])
+        self.lj.action_queue._flush()
+
+        self.assertEqual(calls, [1, 1, 1])
+        self.assertEqual(len(sleeps), 2)
+        fallback = self._written_docs(
+            files[self.config['fallback_log_file']])
+        self.assertEqual([doc['_source'] for doc in fallback],
+                         [{'message': 'a'}])
+
+    def test_retry_backoff(self):
+        self.lj.config['bulk_retry_backoff'] = 1
+        self.lj.config['bulk_retry_max_backoff'] = 5
+        for attempt in range(1, 10):
+            backoff = self.lj.action_queue._retry_backoff(attempt)
+            self.assertGreaterEqual(backoff, 0)
+            self.assertLessEqual(backoff, min(5, 2 ** (attempt - 1)))
+
     @skipIfNotMock
     def test_transport_error(self):
         my_handler = TestHandler()
@@ -240,11 +733,10 @@ class ActionsTestCase(LumberjackTestCase):
 
         args = {}
         file_ = MagicMock(spec=file)
-        @contextmanager
         def my_open(filename, mode):
             args['filename'] = filename
             args['mode'] = mode
-            yield file_
+            return file_
         self.lj.action_queue._open = my_open
 
         completed_actions = []
@@ -287,11 +779,10 @@ class ActionsTestCase(LumberjackTestCase):
 
         args = {}
         file_ = MagicMock(spec=file)
-        @contextmanager
         def my_open(filename, mode):
             args['filename'] = filename
             args['mode'] = mode
-            yield file_
+            return file_
         self.lj.action_queue._open = my_open
 
         completed_actions = []
@@ -323,9 +814,11 @@ class ActionsTestCase(LumberjackTestCase):
             def write(self, str_):
                 raise my_ioerror
 
-        @contextmanager
+            def close(self):
+                pass
+
         def my_open(filename, mode):
-            yield BadFile()
+            return BadFile()
 
         self.getLumberjackObject()
         self.lj.action_queue._open = my_open
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import lumberjack
+from lumberjack.aio import AsyncLumberjack, BulkError, HTTPBulkClient
+
+LOGGER_NAME = 'test.aio'
+
+
+class FakeClient(object):
+    """Records bulk requests, and answers with the given statuses."""
+
+    def __init__(self, statuses=None, error=None):
+        self.requests = []
+        self.statuses = list(statuses or [])
+        self.error = error
+
+    async def bulk(self, body):
+        lines = body.decode('utf-8').splitlines()
+        actions = [json.loads(line) for line in lines[1::2]]
+        self.requests.append(actions)
+        if self.error is not None:
+            raise self.error
+        statuses = self.statuses.pop(0) if self.statuses else \
+            [201] * len(actions)
+        items = []
+        for status in statuses:
+            result = {'status': status}
+            if status >= 300:
+                result['error'] = 'error %d' % status
+            items.append({'index': result})
+        return {'errors': any(status >= 300 for status in statuses),
+                'items': items}
+
+    def sent(self):
+        return [doc['a'] for request in self.requests for doc in request]
+
+
+class AsyncLumberjackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.config = lumberjack.get_default_config()
+        self.config['fallback_log_file'] = os.path.join(self.directory,
+                                                        'fallback.log')
+        self.config['rejected_log_file'] = os.path.join(self.directory,
+                                                        'rejected.log')
+        self.config['bulk_retry_backoff'] = 0
+
+        self.logger = logging.getLogger(LOGGER_NAME)
+        self.addCleanup(setattr, self.logger, 'handlers', [])
+
+    def _lumberjack(self, client):
+        lj = AsyncLumberjack(elasticsearch=client, config=self.config)
+        self.logger.addHandler(lj.get_handler())
+        return lj
+
+    def _read_log(self, config_key):
+        with open(self.config[config_key]) as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_flush(self):
+        client = FakeClient()
+
+        async def main():
+            async with self._lumberjack(client) as lj:
+                self.logger.error({'a': 1})
+                lj.get_emitter(LOGGER_NAME)({'a': 2})
+                await lj.flush()
+                self.assertEqual(client.sent(), [1, 2])
+        asyncio.run(main())
+
+        self.assertEqual(client.requests[0][0]['level'], logging.ERROR)
+
+    def test_max_queue_length(self):
+        self.config['max_queue_length'] = 2
+        client = FakeClient()
+
+        async def main():
+            async with self._lumberjack(client):
+                self.logger.error({'a': 1})
+                self.logger.error({'a': 2})
+                for _ in range(100):
+                    if client.requests:
+                        break
+                    await asyncio.sleep(0.01)
+                self.assertEqual(client.sent(), [1, 2])
+        asyncio.run(main())
+
+    def test_close_sends_the_rest(self):
+        client = FakeClient()
+
+        async def main():
+            lj = self._lumberjack(client)
+            lj.start()
+            self.logger.error({'a': 1})
+            await lj.close()
+        asyncio.run(main())
+
+        self.assertEqual(client.sent(), [1])
+
+    def test_log_after_close(self):
+        client = FakeClient()
+
+        async def main():
+            lj = self._lumberjack(client)
+            lj.start()
+            await lj.close()
+            self.logger.error({'a': 1})
+            self.assertIsNone(lj.action_queue._task)
+            await asyncio.sleep(0)
+            return lj
+        lj = asyncio.run(main())
+
+        self.assertEqual(client.sent(), [])
+        self.assertEqual(lj.action_queue.stats['dropped_closed'], 1)
+
+    def test_cancel_sends_the_rest(self):
+        client = FakeClient()
+
+        async def main():
+            self._lumberjack(client).start()
+            await asyncio.sleep(0)
+            self.logger.error({'a': 1})
+            # asyncio.run() cancels the flush task on the way out.
+        asyncio.run(main())
+
+        self.assertEqual(client.sent(), [1])
+
+    def test_other_thread(self):
+        client = FakeClient()
+
+        async def main():
+            async with self._lumberjack(client) as lj:
+                thread = threading.Thread(target=self.logger.error,
+                                          args=({'a': 1},))
+                thread.start()
+                thread.join()
+                # Let the loop pick the document up.
+                await asyncio.sleep(0)
+                await lj.flush()
+                self.assertEqual(client.sent(), [1])
+        asyncio.run(main())
+
+    def test_postprocessors(self):
+        client = FakeClient()
+
+        def postprocessor(doc):
+            doc['a'] += 10
+            return doc
+
+        async def main():
+            async with self._lumberjack(client) as lj:
+                lj.get_emitter(LOGGER_NAME,
+                               postprocessors=[postprocessor])({'a': 1})
+        asyncio.run(main())
+
+        self.assertEqual(client.sent(), [11])
+
+    def test_retry_and_reject(self):
+        client = FakeClient(statuses=[[201, 429, 400], [201]])
+
+        async def main():
+            async with self._lumberjack(client) as lj:
+                for a in [1, 2, 3]:
+                    self.logger.error({'a': a})
+        asyncio.run(main())
+
+        self.assertEqual(client.sent(), [1, 2, 3, 2])
+        rejected = self._read_log('rejected_log_file')
+        self.assertEqual([doc['_source']['a'] for doc in rejected], [3])
+        self.assertEqual(rejected[0]['_status'], 400)
+
+    def test_give_up_retrying(self):
+        self.config['bulk_max_retries'] = 1
+        client = FakeClient(statuses=[[429], [429]])
+
+        async def main():
+            async with self._lumberjack(client):
+                self.logger.error({'a': 1})
+        asyncio.run(main())
+
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual([doc['_source']['a'] for doc in
+                          self._read_log('fallback_log_file')], [1])
+
+    def test_transport_error(self):
+        client = FakeClient(error=BulkError('Down.'))
+
+        async def main():
+            async with self._lumberjack(client):
+                self.logger.error({'a': 1})
+        asyncio.run(main())
+
+        self.assertEqual([doc['_source']['a'] for doc in
+                          self._read_log('fallback_log_file')], [1])
+
+    def test_max_bulk_bytes(self):
+        self.config['max_bulk_bytes'] = 1
+        client = FakeClient()
+
+        async def main():
+            async with self._lumberjack(client):
+                self.logger.error({'a': 1})
+                self.logger.error({'a': 2})
+        asyncio.run(main())
+
+        self.assertEqual(len(client.requests), 2)
+
+
+class HTTPBulkClientTestCase(unittest.TestCase):
+    def _serve(self, status, response):
+        requests = []
+
+        async def handle(reader, writer):
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = [int(line.split(b':')[1])
+                      for line in head.split(b'\r\n')
+                      if line.lower().startswith(b'content-length')][0]
+            requests.append((head, await reader.readexactly(length)))
+            body = json.dumps(response).encode('utf-8')
+            writer.write(b'HTTP/1.0 %d OK\r\nContent-Length: %d\r\n\r\n' %
+                         (status, len(body)) + body)
+            await writer.drain()
+            writer.close()
+        return (requests, handle)
+
+    def test_bulk(self):
+        (requests, handle) = self._serve(200, {'errors': False, 'items': []})
+
+        async def main():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            client = HTTPBulkClient([{'host': '127.0.0.1', 'port': port}])
+            try:
+                return await client.bulk(body=b'{}\n{}\n')
+            finally:
+                server.close()
+        self.assertEqual(asyncio.run(main()), {'errors': False, 'items': []})
+
+        (head, body) = requests[0]
+        self.assertTrue(head.startswith(b'POST /_bulk '))
+        self.assertEqual(body, b'{}\n{}\n')
+
+    def test_error_status(self):
+        (_, handle) = self._serve(503, {})
+
+        async def main():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            client = HTTPBulkClient(['http://127.0.0.1:%d' % port])
+            try:
+                await client.bulk(body=b'{}\n{}\n')
+            finally:
+                server.close()
+        self.assertRaises(BulkError, asyncio.run, main())
+
+    def test_parse_hosts(self):
+        client = HTTPBulkClient(['es1', 'https://es2:9201/prefix/',
+                                 {'host': 'es3', 'port': 9202}])
+        self.assertEqual(client.hosts, [('http', 'es1', 9200, ''),
+                                        ('https', 'es2', 9201, '/prefix'),
+                                        ('http', 'es3', 9202, '')])
@@ -17,6 +17,8 @@
 # along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import absolute_import
+import subprocess
+import sys
 import unittest
 from .common import LumberjackTestCase, HOSTS, MOCK, patchLumberjackObject
 
@@ -28,6 +30,14 @@ class APITestCase(LumberjackTestCase):
         from lumberjack import version
         self.assertTrue(hasattr(version, '__version__'))
 
+    def test_import_is_lazy(self):
+        # In a fresh interpreter, since this one has imported everything.
+        imported = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, lumberjack; '
+            'print(\'elasticsearch\' in sys.modules)'])
+        self.assertEqual(imported.strip(), b'False')
+
     def test_init_hosts(self):
         lj = lumberjack.Lumberjack(hosts=HOSTS,
                                    config=self.config)
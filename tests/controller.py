@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import unittest
+
+import lumberjack
+from lumberjack.controller import FlushController
+
+from .common import LumberjackTestCase
+
+MIN_BATCH = 10
+MAX_BATCH = 40
+MIN_INTERVAL = 1
+MAX_INTERVAL = 8
+TARGET_LATENCY = 0.5
+
+
+class FlushControllerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = lumberjack.get_default_config()
+        self.config['adaptive_flush'] = True
+        self.config['adaptive_min_batch'] = MIN_BATCH
+        self.config['adaptive_max_batch'] = MAX_BATCH
+        self.config['adaptive_min_interval'] = MIN_INTERVAL
+        self.config['adaptive_max_interval'] = MAX_INTERVAL
+        self.config['adaptive_target_latency'] = TARGET_LATENCY
+        self.config['max_queue_length'] = 20
+        self.config['interval'] = 2
+
+        self.controller = FlushController(self.config)
+
+    def _healthy(self, queue_depth=MAX_BATCH):
+        self.controller.update(latency=TARGET_LATENCY / 2, sent=10,
+                               rejected=0, queue_depth=queue_depth)
+
+    def test_initial_values(self):
+        self.assertEqual(self.controller.batch_size, 20)
+        self.assertEqual(self.controller.interval, 2)
+
+    def test_initial_values_clamped(self):
+        self.config['max_queue_length'] = None
+        self.config['interval'] = None
+        controller = FlushController(self.config)
+        self.assertEqual(controller.batch_size, MIN_BATCH)
+        self.assertEqual(controller.interval, MAX_INTERVAL)
+
+    def test_additive_increase(self):
+        self._healthy()
+        self.assertEqual(self.controller.batch_size, 20 + MIN_BATCH)
+        self.assertEqual(self.controller.interval, 1)
+
+        for _ in range(10):
+            self._healthy()
+        self.assertEqual(self.controller.batch_size, MAX_BATCH)
+        self.assertEqual(self.controller.interval, MIN_INTERVAL)
+
+    def test_no_increase_when_queue_is_shallow(self):
+        self._healthy(queue_depth=5)
+        self.assertEqual(self.controller.batch_size, 20)
+        self.assertEqual(self.controller.interval, 4)
+
+        for _ in range(10):
+            self._healthy(queue_depth=5)
+        self.assertEqual(self.controller.batch_size, 20)
+        self.assertEqual(self.controller.interval, MAX_INTERVAL)
+
+    def test_decrease_on_latency(self):
+        self.controller.update(latency=TARGET_LATENCY * 2, sent=10,
+                               rejected=0, queue_depth=20)
+        self.assertEqual(self.controller.batch_size, 10)
+        self.assertEqual(self.controller.interval, 4)
+
+        for _ in range(10):
+            self.controller.update(latency=TARGET_LATENCY * 2, sent=10,
+                                   rejected=0, queue_depth=20)
+        self.assertEqual(self.controller.batch_size, MIN_BATCH)
+        self.assertEqual(self.controller.interval, MAX_INTERVAL)
+
+    def test_decrease_on_rejections(self):
+        self.controller.update(latency=0, sent=10, rejected=1,
+                               queue_depth=20)
+        self.assertEqual(self.controller.batch_size, 10)
+        self.assertEqual(self.controller.interval, 4)
+
+    def test_empty_flush_ignored(self):
+        self.controller.update(latency=TARGET_LATENCY * 2, sent=0,
+                               rejected=0, queue_depth=0)
+        self.assertEqual(self.controller.batch_size, 20)
+        self.assertEqual(self.controller.interval, 2)
+
+
+class AdaptiveActionQueueTestCase(LumberjackTestCase):
+    def test_controller_used(self):
+        self.config['adaptive_flush'] = True
+        self.getLumberjackObject()
+        action_queue = self.lj.action_queue
+
+        self.assertIsInstance(action_queue.controller, FlushController)
+        action_queue.controller.batch_size = 123
+        action_queue.controller.interval = 4.5
+        self.assertEqual(action_queue._max_queue_length(), 123)
+        self.assertEqual(action_queue._interval(), 4.5)
+
+    def test_controller_disabled(self):
+        self.getLumberjackObject()
+        self.assertIsNone(self.lj.action_queue.controller)
+        self.assertEqual(self.lj.action_queue._interval(),
+                         self.config['interval'])
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import logging
+import time
+from mock import MagicMock
+
+from .common import LumberjackTestCase, skipIfNotMock
+
+LOGGER_NAME = 'test.emitter'
+
+
+class EmitterTestCase(LumberjackTestCase):
+    def setUp(self):
+        super(EmitterTestCase, self).setUp()
+        self.getLumberjackObject()
+
+    def _sent_actions(self):
+        self.lj.action_queue._flush()
+        return self.lj.action_queue._bulk.call_args[0][1]
+
+    @skipIfNotMock
+    def test_same_as_handler(self):
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.addHandler(self.lj.get_handler())
+        self.addCleanup(setattr, logger, 'handlers', [])
+
+        logger.warning({'a': 1})
+        self.lj.get_emitter(LOGGER_NAME)({'a': 1}, level=logging.WARNING)
+        self.lj.log(LOGGER_NAME, {'a': 1}, level=logging.WARNING)
+
+        actions = self._sent_actions()
+        self.assertEqual(len(actions), 3)
+        for action in actions:
+            self.assertLess(abs(action['_source'].pop('@timestamp') -
+                                time.time() * 1000), 10000)
+        self.assertEqual(actions[1], actions[0])
+        self.assertEqual(actions[2], actions[0])
+
+    @skipIfNotMock
+    def test_copy(self):
+        fields = {'a': {'b': 1}}
+        self.lj.log(LOGGER_NAME, fields)
+        fields['a']['b'] = 2
+
+        self.assertEqual(self._sent_actions()[0]['_source']['a'], {'b': 1})
+        self.assertNotIn('level', fields)
+
+    @skipIfNotMock
+    def test_message(self):
+        self.lj.log(LOGGER_NAME, 'a message', level=logging.ERROR)
+        source = self._sent_actions()[0]['_source']
+        self.assertEqual(source['message'], 'a message')
+        self.assertEqual(source['level'], logging.ERROR)
+
+    @skipIfNotMock
+    def test_postprocessors(self):
+        first = MagicMock(side_effect=lambda doc: dict(doc, first=True))
+        second = MagicMock(side_effect=lambda doc: dict(doc, second=True))
+        emitter = self.lj.get_emitter(LOGGER_NAME, postprocessors=[first])
+        emitter({'a': 1})
+        emitter({'a': 2}, postprocessors=[second])
+
+        sources = [action['_source'] for action in self._sent_actions()]
+        self.assertTrue(sources[0]['first'])
+        self.assertNotIn('second', sources[0])
+        self.assertTrue(sources[1]['first'])
+        self.assertTrue(sources[1]['second'])
+
+    @skipIfNotMock
+    def test_suffix_format(self):
+        self.lj.log(LOGGER_NAME, {'a': 1}, suffix_format='%Y')
+        self.assertEqual(self._sent_actions()[0]['_index'],
+                         self.config['index_prefix'] +
+                         time.strftime('%Y', time.gmtime()))
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import gc
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from threading import Lock
+from mock import MagicMock, patch
+
+import elasticsearch
+import lumberjack
+from lumberjack.fallback import FallbackReplayer, FallbackWriter, open_log
+
+from .common import LumberjackTestCase, skipIfNotMock
+
+
+def write_actions(path, messages, mode='a'):
+    with open(path, mode) as log_file:
+        for message in messages:
+            log_file.write(json.dumps({'_index': 'test', '_type': 'test',
+                                       '_source': {'message': message}}) +
+                           '\n')
+
+
+def make_actions(messages):
+    return [{'_index': 'test', '_type': 'test',
+             '_source': {'message': message}} for message in messages]
+
+
+class FallbackWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'fallback.log')
+
+    def _messages(self, path):
+        with open_log(path) as log_file:
+            return [json.loads(line.decode('utf-8'))['_source']['message']
+                    for line in log_file]
+
+    def test_write(self):
+        opener = MagicMock(side_effect=open)
+        writer = FallbackWriter(self.path, opener=opener)
+        writer.write(make_actions(['a', 'b']))
+        writer.write(make_actions(['c']))
+
+        # The file is opened once, and is readable while still open.
+        self.assertEqual(opener.call_count, 1)
+        self.assertEqual(self._messages(self.path), ['a', 'b', 'c'])
+        self.assertEqual(writer.size(), os.path.getsize(self.path))
+        writer.close()
+
+    def test_compress(self):
+        writer = FallbackWriter(self.path, compress=True)
+        writer.write(make_actions(['a']))
+        writer.write(make_actions(['b']))
+        writer.close()
+
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self._messages(self.path + '.gz'), ['a', 'b'])
+
+    def test_abandon(self):
+        writer = FallbackWriter(self.path, compress=True)
+        writer.write(make_actions(['a']))
+        size = os.path.getsize(writer.active_path)
+        writer.abandon()
+        gc.collect()
+
+        # Not even the gzip trailer was written to the file.
+        self.assertEqual(os.path.getsize(writer.active_path), size)
+
+    def test_rotate_max_bytes(self):
+        writer = FallbackWriter(self.path, max_bytes=150)
+        for message in ['a', 'b', 'c', 'd']:
+            writer.write(make_actions([message]))
+        writer.close()
+
+        rotated = writer.rotated_files()
+        self.assertEqual(len(rotated), 1)
+        self.assertEqual(self._messages(rotated[0]), ['a', 'b'])
+        self.assertEqual(self._messages(self.path), ['c', 'd'])
+
+    def test_rotate_max_age(self):
+        writer = FallbackWriter(self.path, max_age=60)
+        writer.write(make_actions(['a']))
+        writer._opened_at -= 60
+        writer.write(make_actions(['b']))
+        writer.close()
+
+        self.assertEqual([self._messages(path)
+                          for path in writer.rotated_files()], [['a']])
+        self.assertEqual(self._messages(self.path), ['b'])
+
+    def test_backup_count(self):
+        writer = FallbackWriter(self.path, compress=True, backup_count=2)
+        for message in ['a', 'b', 'c']:
+            writer.write(make_actions([message]))
+            writer.rotate()
+
+        self.assertEqual([self._messages(path)
+                          for path in writer.rotated_files()],
+                         [['b'], ['c']])
+
+    def test_rotate_empty(self):
+        writer = FallbackWriter(self.path)
+        writer.rotate()
+        self.assertEqual(writer.rotated_files(), [])
+
+
+class FallbackReplayerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'fallback.log')
+        self.writer = FallbackWriter(self.path)
+
+    def _messages(self, docs):
+        return [doc['_source']['message'] for doc in docs]
+
+    def test_read_and_commit(self):
+        write_actions(self.path, ['a', 'b', 'c'])
+        replayer = FallbackReplayer(self.writer, Lock())
+        self.assertTrue(replayer.pending())
+
+        (docs, offset) = replayer.read(2)
+        self.assertEqual(self._messages(docs), ['a', 'b'])
+        replayer.commit(offset)
+        replayer.close()
+
+        # The offset survives a restart.
+        replayer = FallbackReplayer(self.writer, Lock())
+        (docs, offset) = replayer.read(10)
+        self.assertEqual(self._messages(docs), ['c'])
+        replayer.commit(offset)
+
+        self.assertFalse(replayer.pending())
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_uncommitted_read_again(self):
+        write_actions(self.path, ['a', 'b'])
+        replayer = FallbackReplayer(self.writer, Lock())
+        replayer.read(1)
+        self.assertEqual(self._messages(replayer.read(10)[0]), ['a', 'b'])
+
+    def test_writes_during_replay(self):
+        write_actions(self.path, ['a', 'b'])
+        replayer = FallbackReplayer(self.writer, Lock())
+        (docs, offset) = replayer.read(1)
+        replayer.commit(offset)
+
+        # New documents go to a fresh file, replayed after the current one.
+        self.writer.write(make_actions(['c']))
+        (docs, offset) = replayer.read(10)
+        self.assertEqual(self._messages(docs), ['b'])
+        replayer.commit(offset)
+        self.assertEqual(self._messages(replayer.read(10)[0]), ['c'])
+
+    def test_compressed(self):
+        writer = FallbackWriter(self.path, compress=True)
+        writer.write(make_actions(['a', 'b']))
+        replayer = FallbackReplayer(writer, Lock())
+
+        (docs, offset) = replayer.read(1)
+        self.assertEqual(self._messages(docs), ['a'])
+        replayer.commit(offset)
+        replayer.close()
+
+        replayer = FallbackReplayer(writer, Lock())
+        (docs, offset) = replayer.read(10)
+        self.assertEqual(self._messages(docs), ['b'])
+        replayer.commit(offset)
+        self.assertFalse(replayer.pending())
+
+    def test_compressed_unclosed(self):
+        writer = FallbackWriter(self.path + '.tmp', compress=True)
+        writer.write(make_actions(['a', 'b']))
+        # As if the process had died while writing.
+        os.rename(writer.active_path, self.path + '.20150801T120000.000000.gz')
+
+        replayer = FallbackReplayer(self.writer, Lock())
+        (docs, offset) = replayer.read(10)
+        self.assertEqual(self._messages(docs), ['a', 'b'])
+        replayer.commit(offset)
+        self.assertFalse(replayer.pending())
+        writer.close()
+
+    def test_partial_line(self):
+        write_actions(self.path, ['a'])
+        with open(self.path, 'a') as log_file:
+            log_file.write('{"_source": ')
+
+        replayer = FallbackReplayer(self.writer, Lock())
+        (docs, offset) = replayer.read(10)
+        self.assertEqual(self._messages(docs), ['a'])
+        replayer.commit(offset)
+        self.assertFalse(replayer.pending())
+
+    def test_open_error(self):
+        write_actions(self.path, ['a'])
+        replayer = FallbackReplayer(self.writer, Lock())
+        with patch('lumberjack.fallback.open_log', side_effect=IOError):
+            self.assertEqual(replayer.read(10), ([], 0))
+        replayer.commit(0)
+
+        # It is opened again on the next read.
+        (docs, offset) = replayer.read(10)
+        self.assertEqual(self._messages(docs), ['a'])
+        replayer.commit(offset)
+        self.assertFalse(replayer.pending())
+
+    def test_allowance(self):
+        replayer = FallbackReplayer(self.writer, Lock(), rate=100)
+        replayer._last_allowance -= 0.5
+        self.assertEqual(replayer.allowance(), 50)
+        replayer._last_allowance -= 10
+        self.assertEqual(replayer.allowance(), 100)
+
+
+class FallbackReplayActionQueueTestCase(LumberjackTestCase):
+    def setUp(self):
+        super(FallbackReplayActionQueueTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.config['fallback_log_file'] = os.path.join(self.directory,
+                                                        'fallback.log')
+        self.config['fallback_replay'] = True
+        self.config['fallback_replay_chunk'] = 2
+
+        self.action_queue = lumberjack.ActionQueue(MagicMock(), self.config)
+        # Plenty of allowance.
+        self.action_queue.replayer._last_allowance -= 10
+
+    @skipIfNotMock
+    def test_replay(self):
+        write_actions(self.config['fallback_log_file'], ['a', 'b', 'c'])
+        calls = []
+        def mock_bulk_f(es, actions):
+            calls.append([action['_source']['message']
+                          for action in actions])
+        self.action_queue._bulk = mock_bulk_f
+
+        self.action_queue._flush()
+
+        self.assertEqual(calls, [['a', 'b'], ['c']])
+        self.assertEqual(self.action_queue.stats['replayed'], 3)
+        self.assertFalse(self.action_queue.replayer.pending())
+
+    @skipIfNotMock
+    def test_replay_not_in_flush_latency(self):
+        write_actions(self.config['fallback_log_file'], ['a'])
+        def mock_bulk_f(es, actions):
+            if actions[0]['_source']['message'] == 'a':
+                time.sleep(0.2)
+        self.action_queue._bulk = mock_bulk_f
+        self.action_queue.controller = MagicMock(batch_size=100)
+        self.action_queue.queue_index(suffix='test', doc_type='test',
+                                      body={'message': 'new'})
+
+        self.action_queue._flush()
+
+        self.assertFalse(self.action_queue.replayer.pending())
+        latency = self.action_queue.controller.update.call_args[1]['latency']
+        self.assertLess(latency, 0.1)
+
+    @skipIfNotMock
+    def test_no_replay_while_unhealthy(self):
+        write_actions(self.config['fallback_log_file'], ['a'])
+        self.action_queue._bulk = MagicMock(
+            side_effect=elasticsearch.TransportError(500, 'Test exception'))
+        self.action_queue.queue_index(suffix='test', doc_type=__name__,
+                                      body={'message': 'b'})
+        self.action_queue._flush()
+
+        # Only the live document was tried, and went to the fallback log.
+        self.assertEqual(self.action_queue._bulk.call_count, 1)
+        self.assertEqual(self.action_queue.replayer.offset, 0)
+        with open(self.config['fallback_log_file']) as log_file:
+            self.assertEqual(len(log_file.readlines()), 2)
+
+        self.action_queue._bulk = MagicMock(return_value=[])
+        self.action_queue.queue_index(suffix='test', doc_type=__name__,
+                                      body={'message': 'c'})
+        self.action_queue._flush()
+
+        self.assertEqual(self.action_queue._bulk.call_count, 2)
+        self.assertFalse(self.action_queue.replayer.pending())
+
+    @skipIfNotMock
+    def test_replay_retryable_failures_queued(self):
+        write_actions(self.config['fallback_log_file'], ['a'])
+        def mock_bulk_f(es, actions):
+            return [(actions[0], 429, 'es_rejected_execution_exception')]
+        self.action_queue._bulk = mock_bulk_f
+
+        self.action_queue._replay_fallback()
+
+        self.assertEqual([action['_source']['message'] for (action, _, _)
+                          in self.action_queue.queue], ['a'])
+        self.assertFalse(self.action_queue.replayer.pending())
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from mock import MagicMock
+
+from lumberjack.ipc import ForwardingHandler, ForwardingServer
+
+from .common import LumberjackTestCase, skipIfNotMock
+
+LOGGER_NAME = 'test.ipc'
+
+
+class ForwardingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'lumberjack.sock')
+
+        self.handler = ForwardingHandler(self.path)
+        self.addCleanup(self.handler.close)
+        self.logger = logging.getLogger(LOGGER_NAME)
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def _start_server(self, **kwargs):
+        self.action_queue = MagicMock()
+        server = ForwardingServer(self.action_queue, self.path, **kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def _wait_for(self, server, count):
+        deadline = time.time() + 5
+        while server.received < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_forward(self):
+        postprocessor = MagicMock()
+        server = self._start_server(
+            postprocessors={LOGGER_NAME: [postprocessor]})
+
+        self.logger.error({'a': 1})
+        self._wait_for(server, 1)
+
+        kwargs = self.action_queue.queue_index.call_args[1]
+        self.assertEqual(kwargs['doc_type'], LOGGER_NAME)
+        self.assertEqual(kwargs['suffix'],
+                         time.strftime('%Y.%m', time.gmtime()))
+        self.assertEqual(kwargs['body']['a'], 1)
+        self.assertEqual(kwargs['body']['level'], logging.ERROR)
+        self.assertEqual(kwargs['postprocessors'], [postprocessor])
+
+    def test_no_server(self):
+        self.logger.error({'a': 1})
+        self.assertEqual(self.handler.dropped, 1)
+
+    def test_too_big(self):
+        server = self._start_server()
+        self.logger.error({'a': 'x' * (1024 * 1024)})
+        self.logger.error({'a': 1})
+        self._wait_for(server, 1)
+
+        self.assertEqual(self.handler.dropped, 1)
+        self.assertEqual(self.action_queue.queue_index.call_count, 1)
+
+    def test_malformed(self):
+        server = self._start_server()
+        self.handler._get_socket().sendto(b'not json', self.path)
+        self.logger.error({'a': 1})
+        self._wait_for(server, 1)
+
+        self.assertEqual(self.action_queue.queue_index.call_count, 1)
+
+    def test_stop_removes_socket(self):
+        server = self._start_server()
+        server.stop()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class ServeTestCase(LumberjackTestCase):
+    @skipIfNotMock
+    def test_serve(self):
+        self.getLumberjackObject()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'lumberjack.sock')
+        server = self.lj.serve(path)
+        self.addCleanup(server.stop)
+
+        handler = ForwardingHandler(path)
+        self.addCleanup(handler.close)
+        handler.emit(logging.makeLogRecord({'name': LOGGER_NAME,
+                                            'msg': {'a': 1}}))
+        deadline = time.time() + 5
+        while server.received < 1 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(len(self.lj.action_queue.queue), 1)
@@ -20,6 +20,7 @@ from __future__ import absolute_import
 import unittest
 
 import lumberjack
+import lumberjack.handler
 
 import logging
 import elasticsearch
@@ -27,7 +28,7 @@ import sys
 import time
 from random import randint
 
-from .common import LumberjackTestCase, MOCK
+from .common import LumberjackTestCase, MOCK, TestHandler, skipIfNotMock
 
 LOGGER_NAME = 'test'
 LOGGER_CHILD_NAME = 'test.child'
@@ -98,6 +99,58 @@ class LogTestCase(LumberjackTestCase):
     def test_log_message(self):
         self._test_log(log_dict='a message')
 
+    def _sent_source(self):
+        return self.lj.action_queue._bulk.call_args[0][1][0]['_source']
+
+    @skipIfNotMock
+    def test_copy_mode_deep(self):
+        log_dict = {'a': {'b': 1}}
+        self.logger.error(log_dict)
+        log_dict['a']['b'] = 2
+        self.lj.action_queue._flush()
+
+        self.assertEqual(self._sent_source()['a'], {'b': 1})
+        self.assertNotIn('level', log_dict)
+
+    @skipIfNotMock
+    def test_copy_mode_shallow(self):
+        self.handler.setFormatter(
+            lumberjack.handler.ElasticsearchFormatter(copy_mode='shallow'))
+
+        log_dict = {'a': {'b': 1}, 'c': 1}
+        self.logger.error(log_dict)
+        log_dict['c'] = 2
+        self.lj.action_queue._flush()
+
+        # The top level was copied, and the fields were added to the copy.
+        self.assertEqual(self._sent_source()['c'], 1)
+        self.assertNotIn('level', log_dict)
+
+    def test_copy_mode_unknown(self):
+        with self.assertRaises(ValueError):
+            self.lj.get_handler(copy_mode='frozen')
+
+    @skipIfNotMock
+    def test_check_mutation(self):
+        self.logger.handlers = []
+        self.logger.addHandler(self.lj.get_handler(copy_mode='shallow',
+                                                   check_mutation=True))
+        my_handler = TestHandler()
+        logging.getLogger('lumberjack.handler').addHandler(my_handler)
+        self.addCleanup(logging.getLogger('lumberjack.handler').removeHandler,
+                        my_handler)
+
+        self.logger.error({'a': {'b': 1}})
+        log_dict = {'a': {'b': 1}}
+        self.logger.error(log_dict)
+        log_dict['a']['b'] = 2
+        self.lj.action_queue._flush()
+
+        warnings = [record for record in my_handler.records
+                    if record.levelno == logging.WARNING]
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("'b': 2", warnings[0].getMessage())
+
     def _test_log(self, level=logging.ERROR, log_dict={'a': 1, 'b': 2}):
         if MOCK:
             def mock_bulk_f(es, actions):
@@ -149,3 +202,42 @@ class LogTestCase(LumberjackTestCase):
                     }
                 })
             self.assertGreater(res['hits']['total'], 0)
+
+
+class SuffixCacheTestCase(unittest.TestCase):
+    def _check(self, suffix_format, timestamps):
+        cache = lumberjack.handler.SuffixCache(suffix_format)
+        for timestamp in timestamps:
+            self.assertEqual(
+                cache.suffix(timestamp),
+                time.strftime(suffix_format, time.gmtime(timestamp)))
+
+    def test_granularity(self):
+        granularity = lumberjack.handler.format_granularity
+        self.assertEqual(granularity('%Y.%m'), lumberjack.handler.MONTH)
+        self.assertEqual(granularity('%Y.%m.%d'), lumberjack.handler.DAY)
+        self.assertEqual(granularity('%Y%%%H'), lumberjack.handler.HOUR)
+        self.assertEqual(granularity('static'), lumberjack.handler.YEAR)
+        self.assertIsNone(granularity('%Y.%Q'))
+
+    def test_boundaries(self):
+        # Around the end of 2015, including a leap day and month ends.
+        start = 1451606400 - 2 * 86400
+        timestamps = [start + offset for offset in
+                      range(0, 4 * 86400, 3599)]
+        timestamps += [1456704000 - 0.5, 1456704000, 1456790400 - 0.001,
+                       1456790400, 1451606399.999, 1451606400]
+        for suffix_format in ['%Y.%m', '%Y.%m.%d', '%Y.%m.%d.%H', '%Y-W%W',
+                              '%Y', 'static']:
+            self._check(suffix_format, timestamps)
+            self._check(suffix_format, reversed(timestamps))
+
+    def test_unknown_directive_not_cached(self):
+        cache = lumberjack.handler.SuffixCache('%Y.%Q')
+        cache.suffix(1451606400)
+        self.assertIsNone(cache._bucket[2])
+
+    def test_handler_suffix_format(self):
+        handler = lumberjack.handler.ElasticsearchHandler(None)
+        handler.suffix_format = '%Y'
+        self.assertEqual(handler._suffix_cache.suffix(1451606400), '2016')
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import logging
+import multiprocessing
+import os
+import time
+import unittest
+from multiprocessing import current_process
+from mock import MagicMock
+
+import lumberjack
+from lumberjack.pipeline import BatchPostprocessor, run_postprocessors
+
+from .common import LumberjackTestCase
+
+PARENT_PID = os.getpid()
+
+
+class Tag(BatchPostprocessor):
+    copy_mode = 'shallow'
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.calls = []
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.tag == self.tag
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.tag)
+
+    def batch(self, docs):
+        self.calls.append(len(docs))
+        for doc in docs:
+            doc.setdefault('tags', []).append(self.tag)
+        return docs
+
+
+def add_pid(doc):
+    doc['pid'] = os.getpid()
+    return doc
+
+
+def slow_in_worker(doc):
+    # Workers import this module afresh, so PARENT_PID would be their own.
+    if current_process().name != 'MainProcess':
+        time.sleep(5)
+    return add_pid(doc)
+
+
+def make_item(message, postprocessors):
+    return ({'_source': {'message': message}}, postprocessors, 0)
+
+
+class PipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.logger = MagicMock(spec=logging.Logger)
+
+    def test_batched(self):
+        first = Tag('a')
+        items = [make_item('x', [first]), make_item('y', [Tag('a')]),
+                 make_item('z', [])]
+        actions = run_postprocessors(items, self.logger)
+
+        # Equal postprocessors are called once for all their documents.
+        self.assertEqual(first.calls, [2])
+        self.assertEqual([action['_source'].get('tags') for action in actions],
+                         [['a'], ['a'], None])
+
+    def test_chain_order(self):
+        def per_doc(doc):
+            doc['tags'] = doc.get('tags', []) + ['b']
+            return doc
+
+        items = [make_item('x', [Tag('a'), per_doc, Tag('c')]),
+                 make_item('y', [per_doc, Tag('a')])]
+        actions = run_postprocessors(items, self.logger)
+
+        self.assertEqual([action['_source']['tags'] for action in actions],
+                         [['a', 'b', 'c'], ['b', 'a']])
+
+    def test_batch_error(self):
+        class Bad(Tag):
+            def batch(self, docs):
+                for doc in docs:
+                    doc['canary'] = True
+                raise ValueError('Test exception')
+
+        items = [make_item('x', [Bad('a'), Tag('b')])]
+        actions = run_postprocessors(items, self.logger)
+
+        self.assertEqual(actions[0]['_source'],
+                         {'message': 'x', 'tags': ['b']})
+        self.assertEqual(self.logger.error.call_count, 1)
+
+    def test_batch_wrong_length(self):
+        class Short(Tag):
+            def batch(self, docs):
+                return docs[1:]
+
+        items = [make_item('x', [Short('a')]), make_item('y', [Short('a')])]
+        actions = run_postprocessors(items, self.logger)
+
+        self.assertEqual([action['_source'] for action in actions],
+                         [{'message': 'x'}, {'message': 'y'}])
+        self.assertEqual(self.logger.error.call_count, 1)
+
+    def test_call_single(self):
+        self.assertEqual(Tag('a')({'message': 'x'}),
+                         {'message': 'x', 'tags': ['a']})
+
+
+class PostprocessorProcessesTestCase(LumberjackTestCase):
+    def setUp(self):
+        super(PostprocessorProcessesTestCase, self).setUp()
+        self.config['postprocessor_processes'] = 2
+        self.action_queue = lumberjack.ActionQueue(MagicMock(), self.config)
+        self.addCleanup(self.action_queue._close_postprocessor_pool, True)
+
+    def test_processes(self):
+        items = [make_item(str(i), [add_pid] if i % 2 else [])
+                 for i in range(10)]
+        actions = self.action_queue._postprocess(items)
+
+        self.assertEqual([action['_source']['message'] for action in actions],
+                         [str(i) for i in range(10)])
+        pids = set(action['_source'].pop('pid') for action in actions[1::2])
+        self.assertNotIn(PARENT_PID, pids)
+        self.assertNotIn('pid', actions[0]['_source'])
+
+    @unittest.skipIf(not hasattr(multiprocessing, 'get_context'),
+                     'Python 2 can only fork.')
+    def test_workers_not_forked(self):
+        from lumberjack.actions import _process_context
+        self.assertIn(_process_context().get_start_method(),
+                      ('forkserver', 'spawn'))
+
+    def test_not_picklable(self):
+        def local_postprocessor(doc):
+            return add_pid(doc)
+
+        actions = self.action_queue._postprocess(
+            [make_item('x', [local_postprocessor])])
+        self.assertEqual(actions[0]['_source']['pid'], PARENT_PID)
+
+        # No new pool is forked for the next flush.
+        actions = self.action_queue._postprocess(
+            [make_item('y', [add_pid])])
+        self.assertEqual(actions[0]['_source']['pid'], PARENT_PID)
+        self.assertIsNone(self.action_queue._postprocessor_pool)
+
+    def test_timeout(self):
+        self.config['postprocessor_timeout'] = 0.5
+        actions = self.action_queue._postprocess(
+            [make_item('x', [slow_in_worker])])
+
+        self.assertEqual(actions[0]['_source']['pid'], PARENT_PID)
+        self.assertIsNone(self.action_queue._postprocessor_pool)
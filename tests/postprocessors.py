@@ -17,8 +17,10 @@
 # along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import absolute_import
+from importlib import import_module
 import logging
-from mock import MagicMock
+import unittest
+from mock import MagicMock, patch
 
 import lumberjack
 
@@ -70,7 +72,7 @@ class PostprocessorsTestCase(LumberjackTestCase):
         postprocessor = MagicMock(return_value=postprocessor_return)
 
         data = {'a': 1}
-        self.logger.info(data, {'postprocessors': [postprocessor]})
+        self.logger.error(data, {'postprocessors': [postprocessor]})
         self.lj.action_queue._flush()
 
         try:
@@ -119,12 +121,54 @@ class PostprocessorsTestCase(LumberjackTestCase):
             raise MyException('This exception should be handled and logged')
 
         data = {'a': 1}
-        self.logger.info(data, {'postprocessors': [my_postprocessor]})
+        self.logger.error(data, {'postprocessors': [my_postprocessor]})
+        self.lj.action_queue._flush()
+
+        queue_source = self.lj.action_queue._bulk.call_args[0][1][0]['_source']
+        self.assertNotIn('canary', queue_source)
+
+    @skipIfNotMock
+    def test_postprocessors_inplace(self):
+        self._disable_action_queue()
+        self.lj.action_queue._bulk = MagicMock()
+
+        def my_postprocessor(doc):
+            doc['b'] = 2
+            return doc
+        my_postprocessor.copy_mode = 'shallow'
+
+        def my_bad_postprocessor(doc):
+            doc['canary'] = 'shouldn\'t be here'
+            raise MyException('This exception should be handled and logged')
+        my_bad_postprocessor.copy_mode = 'shallow'
+
+        data = {'a': {'nested': 1}}
+        self.logger.error(data, {'postprocessors': [my_postprocessor,
+                                                    my_bad_postprocessor]})
         self.lj.action_queue._flush()
 
         queue_source = self.lj.action_queue._bulk.call_args[0][1][0]['_source']
+        self.assertEqual(queue_source['b'], 2)
         self.assertNotIn('canary', queue_source)
 
+    @skipIfNotMock
+    def test_postprocessors_pure(self):
+        self._disable_action_queue()
+        self.lj.action_queue._bulk = MagicMock()
+
+        sources = []
+        def my_postprocessor(doc):
+            sources.append(doc)
+            return doc
+        my_postprocessor.copy_mode = 'none'
+
+        self.logger.error({'a': 1}, {'postprocessors': [my_postprocessor]})
+        self.lj.action_queue._flush()
+
+        # The document itself was passed, not a copy.
+        queue_source = self.lj.action_queue._bulk.call_args[0][1][0]['_source']
+        self.assertIs(sources[0], queue_source)
+
     @skipIfNotMock
     def test_geoip(self):
         from lumberjack.postprocessors import geoip
@@ -151,3 +195,130 @@ class PostprocessorsTestCase(LumberjackTestCase):
                 'location': geopoint
             }
         })
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        from lumberjack.postprocessors.cache import LRUCache
+        self.cache = LRUCache(max_size=2, ttl=10)
+        self.now = 1000
+        self.cache._time = lambda: self.now
+
+    def test_lru(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', None)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.set('c', 3)
+
+        # 'b' was least recently used.
+        self.assertEqual(self.cache.get('b', 'missing'), 'missing')
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_negative(self):
+        self.cache.set('a', None)
+        self.assertIsNone(self.cache.get('a', 'missing'))
+
+    def test_ttl(self):
+        self.cache.set('a', 1)
+        self.now += 10
+        self.assertEqual(self.cache.get('a', 'missing'), 'missing')
+        self.assertEqual(len(self.cache), 0)
+
+
+class GeoIPCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        # lumberjack.postprocessors.geoip is shadowed by the function.
+        geoip_module = import_module('lumberjack.postprocessors.geoip')
+        self.geoip = geoip_module.geoip
+
+        self.geolite2 = MagicMock()
+        self.geolite2.lookup.side_effect = self._lookup
+        patcher = patch.object(geoip_module, 'open_database',
+                               return_value=self.geolite2)
+        self.open_database = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _lookup(self, ip):
+        if ip.startswith('10.'):
+            return None
+        if ip == 'unknown':
+            raise ValueError('Invalid IP address.')
+        return MagicMock(country='CH', location=(46.1956, 6.1481))
+
+    def test_cache(self):
+        postprocessor = self.geoip(field='ip', cache_size=100)
+        postprocessor.cache.clear()
+
+        for ip in ['128.141.43.1', '10.0.0.1', '128.141.43.1', '10.0.0.1']:
+            postprocessor.batch([{'ip': ip}])
+
+        self.assertEqual(self.geolite2.lookup.call_count, 2)
+        self.assertEqual((postprocessor.cache.hits,
+                          postprocessor.cache.misses), (2, 2))
+
+    def test_cache_shared(self):
+        first = self.geoip(field='ip', cache_size=100)
+        first.cache.clear()
+        first({'ip': '128.141.43.1'})
+        self.geoip(field='ip', cache_size=100)({'ip': '128.141.43.1'})
+
+        self.assertEqual(self.geolite2.lookup.call_count, 1)
+
+    def test_cache_not_shared_between_databases(self):
+        first = self.geoip(field='ip', database='/a.mmdb', cache_size=100)
+        self.assertIsNot(
+            self.geoip(field='ip', database='/b.mmdb', cache_size=100).cache,
+            first.cache)
+        self.assertIsNot(
+            self.geoip(field='ip', database='/a.mmdb', cache_size=100,
+                       cache_by_prefix=True).cache,
+            first.cache)
+
+    def test_cache_by_prefix(self):
+        postprocessor = self.geoip(field='ip', cache_size=100,
+                                   cache_by_prefix=True)
+        postprocessor.cache.clear()
+
+        docs = postprocessor.batch([{'ip': '128.141.43.1'},
+                                    {'ip': '128.141.43.2'},
+                                    {'ip': '2001:db8:1:2::1'},
+                                    {'ip': '2001:db8:1:3::1'},
+                                    {'ip': 'not an ip'}])
+
+        self.assertEqual(self.geolite2.lookup.call_count, 3)
+        self.assertEqual(docs[1]['geoip']['country_code'], 'CH')
+
+    def test_bad_address(self):
+        postprocessor = self.geoip(field='ip', cache_size=100)
+        postprocessor.cache.clear()
+
+        docs = postprocessor.batch([{'ip': '128.141.43.1'},
+                                    {'ip': 'unknown'},
+                                    {'ip': '128.141.43.2'}])
+
+        self.assertEqual(docs[0]['geoip']['country_code'], 'CH')
+        self.assertNotIn('geoip', docs[1])
+        self.assertEqual(docs[2]['geoip']['country_code'], 'CH')
+        # The failure is cached like an address not found.
+        postprocessor.batch([{'ip': 'unknown'}])
+        self.assertEqual(self.geolite2.lookup.call_count, 3)
+
+    def test_unhashable_address(self):
+        postprocessor = self.geoip(field='ip', cache_size=100)
+        postprocessor.cache.clear()
+
+        docs = postprocessor.batch([{'ip': ['128.141.43.1', '10.0.0.1']},
+                                    {'ip': '128.141.43.2'}])
+
+        self.assertNotIn('geoip', docs[0])
+        self.assertEqual(docs[1]['geoip']['country_code'], 'CH')
+
+    def test_lazy_database(self):
+        postprocessor = self.geoip(field='ip', database='/tmp/GeoIP.mmdb',
+                                   cache_size=0)
+        self.assertFalse(self.open_database.called)
+
+        postprocessor({'ip': '128.141.43.1'})
+        postprocessor({'ip': '128.141.43.2'})
+        self.open_database.assert_called_once_with('/tmp/GeoIP.mmdb')
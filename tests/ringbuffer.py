@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from mock import MagicMock
+
+from lumberjack.ringbuffer import RingBuffer, RingBufferConsumer, \
+    RingBufferHandler
+
+from .common import LumberjackTestCase, skipIfNotMock
+
+LOGGER_NAME = 'test.ringbuffer'
+
+
+class RingBufferTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'lumberjack.ring')
+
+    def _buffer(self, capacity=None):
+        ring_buffer = RingBuffer(self.path, capacity=capacity)
+        self.addCleanup(ring_buffer.close)
+        return ring_buffer
+
+    def test_put_get(self):
+        ring_buffer = self._buffer(1024)
+        self.assertTrue(ring_buffer.put(b'one'))
+        self.assertTrue(ring_buffer.put(b'two'))
+        self.assertEqual(ring_buffer.get_all(), [b'one', b'two'])
+        self.assertEqual(ring_buffer.get_all(), [])
+
+    def test_shared(self):
+        consumer = self._buffer(1024)
+        producer = self._buffer()
+        producer.put(b'one')
+        self.assertEqual(consumer.get_all(), [b'one'])
+
+    def test_wrap_around(self):
+        ring_buffer = self._buffer(32)
+        for i in range(20):
+            record = ('record %02d' % i).encode('ascii')
+            self.assertTrue(ring_buffer.put(record))
+            self.assertEqual(ring_buffer.get_all(), [record])
+
+    def test_full(self):
+        ring_buffer = self._buffer(32)
+        self.assertTrue(ring_buffer.put(b'x' * 20))
+        self.assertFalse(ring_buffer.put(b'y' * 20))
+        self.assertFalse(ring_buffer.put(b'z' * 100))
+        self.assertEqual(ring_buffer.dropped, 2)
+        # The newest documents are the ones dropped.
+        self.assertEqual(ring_buffer.get_all(), [b'x' * 20])
+        self.assertTrue(ring_buffer.put(b'y' * 20))
+
+    def test_reopen_keeps_records(self):
+        ring_buffer = self._buffer(1024)
+        ring_buffer.put(b'one')
+        self.assertEqual(self._buffer(1024).get_all(), [b'one'])
+        self._buffer(2048)
+        self.assertEqual(self._buffer().get_all(), [])
+
+    def test_missing(self):
+        self.assertRaises(IOError, RingBuffer, self.path)
+
+    def test_not_a_buffer(self):
+        with open(self.path, 'wb') as not_a_buffer:
+            not_a_buffer.write(b'x' * 1024)
+        self.assertRaises(ValueError, RingBuffer, self.path)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Needs fork().')
+    def test_many_processes(self):
+        ring_buffer = self._buffer(64 * 1024)
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    producer = RingBuffer(self.path)
+                    for j in range(100):
+                        producer.put(('%d-%d' % (i, j)).encode('ascii'))
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        records = ring_buffer.get_all()
+        self.assertEqual(len(records), 400)
+        self.assertEqual(
+            sorted(records),
+            sorted([('%d-%d' % (i, j)).encode('ascii')
+                    for i in range(4) for j in range(100)]))
+
+
+class RingBufferForwardingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'lumberjack.ring')
+
+        self.handler = RingBufferHandler(self.path)
+        self.addCleanup(self.handler.close)
+        self.logger = logging.getLogger(LOGGER_NAME)
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def _start_consumer(self, **kwargs):
+        self.action_queue = MagicMock()
+        consumer = RingBufferConsumer(self.action_queue, self.path,
+                                      interval=0.01, **kwargs)
+        consumer.start()
+        self.addCleanup(consumer.stop)
+        return consumer
+
+    def _wait_for(self, consumer, count):
+        deadline = time.time() + 5
+        while consumer.received < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_forward(self):
+        postprocessor = MagicMock()
+        consumer = self._start_consumer(
+            postprocessors={LOGGER_NAME: [postprocessor]})
+
+        self.logger.error({'a': 1})
+        self._wait_for(consumer, 1)
+
+        kwargs = self.action_queue.queue_index.call_args[1]
+        self.assertEqual(kwargs['doc_type'], LOGGER_NAME)
+        self.assertEqual(kwargs['suffix'],
+                         time.strftime('%Y.%m', time.gmtime()))
+        self.assertEqual(kwargs['body']['a'], 1)
+        self.assertEqual(kwargs['body']['level'], logging.ERROR)
+        self.assertEqual(kwargs['postprocessors'], [postprocessor])
+
+    def test_no_buffer(self):
+        self.logger.error({'a': 1})
+        self.assertEqual(self.handler.dropped, 1)
+
+    def test_full(self):
+        consumer = self._start_consumer(capacity=256)
+        self.logger.error({'a': 'x' * 1024})
+        self.logger.error({'a': 1})
+        self._wait_for(consumer, 1)
+
+        self.assertEqual(self.handler.dropped, 1)
+        self.assertEqual(consumer.dropped, 1)
+        self.assertEqual(self.action_queue.queue_index.call_count, 1)
+
+    def test_stop_drains(self):
+        consumer = self._start_consumer()
+        consumer.interval = 60
+        time.sleep(0.05)
+        self.logger.error({'a': 1})
+        consumer.stop()
+        self.assertEqual(self.action_queue.queue_index.call_count, 1)
+
+
+class ServeRingBufferTestCase(LumberjackTestCase):
+    @skipIfNotMock
+    def test_serve_ring_buffer(self):
+        self.getLumberjackObject()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'lumberjack.ring')
+        consumer = self.lj.serve_ring_buffer(path, capacity=4096)
+        self.addCleanup(consumer.stop)
+
+        handler = RingBufferHandler(path)
+        self.addCleanup(handler.close)
+        handler.emit(logging.makeLogRecord({'name': LOGGER_NAME,
+                                            'msg': {'a': 1}}))
+        deadline = time.time() + 5
+        while consumer.received < 1 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(len(self.lj.action_queue.queue), 1)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock
+
+import elasticsearch
+import lumberjack
+from lumberjack.fallback import FallbackWriter
+from lumberjack.ship import Shipper, parse_hosts
+
+from .common import LumberjackTestCase, skipIfNotMock
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+def action_line(message, **extra):
+    action = {'_op_type': 'index', '_index': 'test', '_type': 'test',
+              '_source': {'message': message}}
+    action.update(extra)
+    return json.dumps(action) + '\n'
+
+
+class ShipperTestCase(LumberjackTestCase):
+    def setUp(self):
+        super(ShipperTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.config['fallback_log_file'] = os.path.join(self.directory,
+                                                        'fallback.log')
+        self.config['rejected_log_file'] = os.path.join(self.directory,
+                                                        'rejected.log')
+
+        self.action_queue = lumberjack.ActionQueue(MagicMock(), self.config)
+        self.sent = []
+        self.action_queue._bulk = self._bulk
+
+    def _bulk(self, es, actions):
+        self.sent.append([action['_source']['message'] for action in actions])
+
+    def _write(self, name, lines, opener=open):
+        path = os.path.join(self.directory, name)
+        with opener(path, 'wb') as log_file:
+            log_file.write(''.join(lines).encode('utf-8'))
+        return path
+
+    def test_ship(self):
+        plain = self._write('a.log', [action_line(str(i)) for i in range(3)])
+        compressed = self._write('b.log.gz', [action_line('3')], gzip.open)
+
+        shipper = Shipper(self.action_queue, chunk_size=2)
+        stats = shipper.ship([plain, compressed])
+
+        self.assertEqual(self.sent, [['0', '1'], ['2'], ['3']])
+        self.assertEqual(stats['files'], 2)
+        self.assertEqual(stats['read'], 4)
+        self.assertEqual(stats['indexed'], 4)
+
+    def test_rejected_fields_stripped(self):
+        path = self._write('rejected.log', [
+            action_line('a', _status=429, _error='es_rejected')])
+        actions = []
+        self.action_queue._bulk = lambda es, chunk: actions.extend(chunk)
+
+        Shipper(self.action_queue).ship([path])
+
+        self.assertNotIn('_status', actions[0])
+        self.assertNotIn('_error', actions[0])
+
+    def test_corrupt_and_partial_lines(self):
+        path = self._write('a.log', [action_line('a'), '{"corrupt\n',
+                                     '1\n', '"x"\n', action_line('b'),
+                                     '{"partial'])
+
+        shipper = Shipper(self.action_queue, state_file=os.path.join(
+            self.directory, 'state.json'))
+        stats = shipper.ship([path])
+
+        self.assertEqual(self.sent, [['a', 'b']])
+        self.assertEqual(stats['corrupt'], 3)
+        # The partial line is left to be read when it is complete.
+        self.assertEqual(shipper.offsets[os.path.abspath(path)],
+                         os.path.getsize(path) - len('{"partial'))
+
+    def test_compressed_unclosed(self):
+        writer = FallbackWriter(os.path.join(self.directory, 'a.log'),
+                                compress=True)
+        writer.write([json.loads(action_line(str(i))) for i in range(3)])
+        # As if the process had died while writing.
+        writer.abandon()
+        plain = self._write('b.log', [action_line('3')])
+
+        shipper = Shipper(self.action_queue)
+        stats = shipper.ship([writer.active_path, plain])
+
+        self.assertEqual(self.sent, [['0', '1', '2'], ['3']])
+        self.assertEqual(stats['read'], 4)
+        self.assertEqual(shipper.offsets[os.path.abspath(writer.active_path)],
+                         len(''.join([action_line(str(i))
+                                      for i in range(3)])))
+
+    def test_resume(self):
+        state_file = os.path.join(self.directory, 'state.json')
+        path = self._write('a.log', [action_line(str(i)) for i in range(4)])
+
+        def failing_bulk(es, actions):
+            if actions[0]['_source']['message'] == '2':
+                raise KeyboardInterrupt()
+            self._bulk(es, actions)
+        self.action_queue._bulk = failing_bulk
+        with self.assertRaises(KeyboardInterrupt):
+            Shipper(self.action_queue, chunk_size=2,
+                    state_file=state_file).ship([path])
+
+        self.action_queue._bulk = self._bulk
+        Shipper(self.action_queue, chunk_size=2,
+                state_file=state_file).ship([path])
+
+        self.assertEqual(self.sent, [['0', '1'], ['2', '3']])
+
+    @skipIfNotMock
+    def test_workers_and_fallback(self):
+        path = self._write('a.log', [action_line(str(i)) for i in range(5)])
+        self.action_queue._bulk = MagicMock(
+            side_effect=elasticsearch.TransportError(500, 'Test exception'))
+
+        stats = Shipper(self.action_queue, chunk_size=1,
+                        workers=2).ship([path])
+        self.action_queue.close_writers()
+
+        self.assertEqual(self.action_queue._bulk.call_count, 5)
+        self.assertEqual(stats['fallback'], 5)
+        with open(self.config['fallback_log_file']) as fallback_log:
+            self.assertEqual(len(fallback_log.readlines()), 5)
+
+    def test_rate(self):
+        path = self._write('a.log', [action_line(str(i)) for i in range(4)])
+        shipper = Shipper(self.action_queue, chunk_size=2, rate=1)
+        sleeps = []
+        shipper._sleep = sleeps.append
+
+        shipper.ship([path])
+
+        self.assertEqual(len(sleeps), 2)
+        self.assertGreater(sleeps[0], 1)
+        self.assertGreater(sleeps[1], 3)
+
+    def test_report(self):
+        path = self._write('a.log', [action_line('a')])
+        shipper = Shipper(self.action_queue)
+        shipper.ship([path])
+
+        output = StringIO()
+        shipper.report(output)
+        self.assertIn('indexed   1', output.getvalue())
+
+
+class ParseHostsTestCase(unittest.TestCase):
+    def test_parse_hosts(self):
+        self.assertEqual(parse_hosts('es1:9201, es2'),
+                         [{'host': 'es1', 'port': 9201},
+                          {'host': 'es2', 'port': 9200}])
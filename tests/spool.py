@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Lumberjack.
+# Copyright 2015 CERN.
+#
+# Lumberjack is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Lumberjack is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Lumberjack.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock
+
+import elasticsearch
+import lumberjack
+from lumberjack.spool import Spool
+
+from .common import LumberjackTestCase, skipIfNotMock
+
+
+class SpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _segment_files(self):
+        return sorted(filename for filename in os.listdir(self.directory)
+                      if filename.endswith('.spool'))
+
+    def test_replay(self):
+        spool = Spool(self.directory, fsync='always')
+        spool.append([{'a': 1}, {'a': 2}])
+        spool.append([{'a': 3}])
+        spool.close()
+
+        self.assertEqual(Spool(self.directory).replay(),
+                         [{'a': 1}, {'a': 2}, {'a': 3}])
+
+    def test_ack(self):
+        spool = Spool(self.directory)
+        position = spool.append([{'a': 1}])
+        spool.append([{'a': 2}])
+        spool.ack(position)
+        spool.close()
+
+        self.assertEqual(Spool(self.directory).replay(), [{'a': 2}])
+
+    def test_new_segment_per_run(self):
+        spool = Spool(self.directory)
+        spool.append([{'a': 1}])
+        spool.close()
+
+        spool = Spool(self.directory)
+        spool.append([{'a': 2}])
+        spool.close()
+
+        self.assertEqual(len(self._segment_files()), 2)
+        self.assertEqual(Spool(self.directory).replay(),
+                         [{'a': 1}, {'a': 2}])
+
+    def test_rotation_and_cleanup(self):
+        spool = Spool(self.directory, segment_bytes=1)
+        for i in range(3):
+            spool.append([{'a': i}])
+        self.assertEqual(len(self._segment_files()), 3)
+
+        spool.ack(spool.tell())
+        spool.close()
+        self.assertEqual(len(self._segment_files()), 1)
+        self.assertEqual(Spool(self.directory).replay(), [])
+
+    def test_torn_record(self):
+        spool = Spool(self.directory)
+        spool.append([{'a': 1}, {'a': 2}])
+        spool.close()
+
+        segment = os.path.join(self.directory, self._segment_files()[0])
+        with open(segment, 'rb+') as segment_file:
+            segment_file.truncate(os.path.getsize(segment) - 3)
+
+        self.assertEqual(Spool(self.directory).replay(), [{'a': 1}])
+
+    def test_bad_fsync_policy(self):
+        with self.assertRaises(ValueError):
+            Spool(self.directory, fsync='sometimes')
+
+
+class SpoolActionQueueTestCase(LumberjackTestCase):
+    def setUp(self):
+        super(SpoolActionQueueTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.config['spool_dir'] = self.directory
+        self.config['interval'] = None
+
+    def _new_action_queue(self):
+        action_queue = lumberjack.ActionQueue(MagicMock(), self.config)
+        action_queue._bulk = MagicMock()
+        return action_queue
+
+    def _queue(self, action_queue, message):
+        action_queue.queue_index(suffix='test', doc_type=__name__,
+                                 body={'message': message})
+
+    def _sent(self, action_queue):
+        return [action['_source']['message']
+                for call in action_queue._bulk.call_args_list
+                for action in call[0][1]]
+
+    def test_enqueue_replay(self):
+        action_queue = self._new_action_queue()
+        self._queue(action_queue, 'a')
+        action_queue._flush()
+        self._queue(action_queue, 'b')
+        action_queue.spool.close()
+
+        # As if the process died before 'b' was flushed.
+        replayed = self._new_action_queue()
+        self.assertEqual(len(replayed.queue), 0)
+        self._queue(replayed, 'c')
+        replayed._flush()
+        self.assertEqual(self._sent(replayed), ['c', 'b'])
+        replayed.spool.close()
+
+        action_queue = self._new_action_queue()
+        action_queue._flush()
+        self.assertEqual(self._sent(action_queue), [])
+
+    def test_replay_in_chunks(self):
+        self.config['spool_replay_chunk'] = 2
+        self.config['queue_capacity'] = 1
+        spool = Spool(self.directory)
+        spool.append([{'_source': {'message': i}} for i in range(5)])
+        spool.close()
+
+        action_queue = self._new_action_queue()
+        self.assertEqual(len(action_queue.queue), 0)
+        self.assertEqual(action_queue._interval(), 1)
+        for _ in range(3):
+            action_queue._flush()
+        self.assertEqual([len(call[0][1]) for call
+                          in action_queue._bulk.call_args_list], [2, 2, 1])
+        self.assertEqual(self._sent(action_queue), list(range(5)))
+        self.assertIsNone(action_queue._interval())
+
+        # Only acknowledged once sent.
+        action_queue.spool.close()
+        self.assertEqual(Spool(self.directory).replay(), [])
+
+    def test_replay_acknowledged_as_sent(self):
+        self.config['spool_replay_chunk'] = 2
+        spool = Spool(self.directory)
+        spool.append([{'_source': {'message': i}} for i in range(3)])
+        spool.close()
+
+        action_queue = self._new_action_queue()
+        action_queue._flush()
+        action_queue.spool.close()
+
+        # As if the process died half way through.
+        self.assertEqual(Spool(self.directory).replay(),
+                         [{'_source': {'message': 2}}])
+
+    @skipIfNotMock
+    def test_failure_mode(self):
+        self.config['spool_mode'] = 'failure'
+        action_queue = self._new_action_queue()
+        action_queue._bulk = MagicMock(
+            side_effect=elasticsearch.TransportError(500, 'Test exception'))
+        action_queue._open = MagicMock()
+
+        self._queue(action_queue, 'a')
+        action_queue._flush()
+        action_queue.spool.close()
+
+        self.assertFalse(action_queue._open.called)
+        replayed = self._new_action_queue()
+        self.assertEqual(len(replayed.queue), 0)
+        replayed._flush()
+        self.assertEqual(self._sent(replayed), ['a'])
+        replayed.spool.close()
+
+        action_queue = self._new_action_queue()
+        action_queue._flush()
+        self.assertEqual(self._sent(action_queue), [])
+
+    @skipIfNotMock
+    def test_failure_mode_drained_once_healthy(self):
+        self.config['spool_mode'] = 'failure'
+        action_queue = self._new_action_queue()
+        action_queue._bulk = MagicMock(
+            side_effect=elasticsearch.TransportError(500, 'Test exception'))
+
+        self._queue(action_queue, 'a')
+        action_queue._flush()
+        self.assertFalse(action_queue._healthy)
+        # Not replayed while unhealthy.
+        self.assertEqual(action_queue._bulk.call_count, 1)
+
+        action_queue._bulk = MagicMock(return_value=[])
+        self._queue(action_queue, 'b')
+        action_queue._flush()
+        self.assertEqual(self._sent(action_queue), ['b', 'a'])
+        action_queue.spool.close()
+        self.assertEqual(Spool(self.directory).replay(), [])